@@ -1,5 +1,3 @@
-import pkg_resources
-
-
 def get_version():  # pragma: no cover
+    import pkg_resources
     return pkg_resources.require("gordon")[0].version
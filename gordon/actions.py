@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
+import time
 import json
+import hashlib
 import tempfile
 import zipfile
 import shutil
-from collections import Iterable
+import threading
+from collections import Iterable, OrderedDict
 
 import six
-import boto3
 import troposphere
-from clint.textui import colored, puts
+from clint.textui import colored
 
 from gordon import utils, exceptions
 
@@ -126,9 +129,46 @@ class ActionsTemplate(Serializable):
         self.outputs[output.name] = output
 
     def apply(self, context, project):
+        return self._get_outputs(self._run('apply', context, project))
+
+    def plan(self, context, project):
+        """Returns the outputs ``apply`` would return, without changing
+        anything."""
+        return self._get_outputs(self._run('plan', context, project))
+
+    def _run(self, method, context, project):
+        """Calls ``method`` of every action, and returns their outputs by
+        name. Actions of parallelizable templates are run concurrently using
+        up to ``project.jobs`` threads, but their output is shown in the same
+        order as if they had been run sequentially."""
+        jobs = min(getattr(project, 'jobs', 1) or 1, len(self.actions)) if self.parallelizable else 1
+        if jobs < 2:
+            return dict([(action.name, getattr(action, method)(context, project)) for action in self.actions])
+
+        from multiprocessing.pool import ThreadPool
+
+        def _run_action(action):
+            buffered = BufferedProject(project)
+            try:
+                return getattr(action, method)(context, buffered), buffered.lines, None
+            except Exception:
+                return None, buffered.lines, sys.exc_info()
+
         action_outputs = {}
-        for action in self.actions:
-            action_outputs[action.name] = action.apply(context, project)
+        pool = ThreadPool(jobs)
+        try:
+            for action, (outputs, lines, exc_info) in zip(self.actions, pool.imap(_run_action, self.actions)):
+                for args, kwargs in lines:
+                    project.puts(*args, **kwargs)
+                if exc_info:
+                    six.reraise(*exc_info)
+                action_outputs[action.name] = outputs
+        finally:
+            pool.terminate()
+            pool.join()
+        return action_outputs
+
+    def _get_outputs(self, action_outputs):
         outputs = {}
         for name, output in six.iteritems(self.outputs):
             if isinstance(output.value, GetAttr):
@@ -145,11 +185,81 @@ class ActionsTemplate(Serializable):
         return bool(self.actions)
 
 
+class BufferedProject(object):
+    """Proxy of ``project`` which keeps everything actions output instead of
+    showing it, so the output of actions run concurrently doesn't get
+    mixed."""
+
+    def __init__(self, project):
+        self._project = project
+        self.lines = []
+
+    def puts(self, *args, **kwargs):
+        self.lines.append((args, kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._project, name)
+
+
+class UploadProgress(object):
+    """Reports the progress of the files being uploaded: how much of each of
+    them and of all of them together has been uploaded. Uploads report their
+    progress from several threads, so it is shown as it happens (at most
+    every ``interval`` seconds) instead of through the output of actions."""
+
+    def __init__(self, puts_function, interval=2):
+        self.puts = puts_function
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._uploading = OrderedDict()
+        self._sent = self._size = 0
+        self._last = None
+
+    def start(self, name, size):
+        with self._lock:
+            self._uploading[name] = [0, size]
+            self._size += size
+            if self._last is None:
+                self._last = time.time()
+
+    def finish(self, name):
+        with self._lock:
+            sent, size = self._uploading.pop(name)
+            self._sent += size - sent
+
+    def callback(self, name):
+        """Returns the function boto3 calls with the number of bytes of
+        ``name`` uploaded since it was last called."""
+        def _callback(amount):
+            self.update(name, amount)
+        return _callback
+
+    def update(self, name, amount):
+        with self._lock:
+            if name in self._uploading:
+                self._uploading[name][0] += amount
+                self._sent += amount
+            if time.time() - self._last < self.interval:
+                return
+            self._last = time.time()
+            line = u"↑ {} of {} ({:.0f}%) {}".format(
+                utils.format_size(self._sent),
+                utils.format_size(self._size),
+                100.0 * self._sent / max(self._size, 1),
+                ', '.join([u"{} {:.0f}%".format(n, 100.0 * s / max(t, 1))
+                           for n, (s, t) in six.iteritems(self._uploading)])
+            )
+        self.puts(colored.white(line))
+
+
 class BaseAction(Serializable):
 
     def apply(self):
         return {}
 
+    def plan(self, context, project):
+        return {}
+
     def _get(self, name, context):
         value = getattr(self, name, None)
         if isinstance(value, Ref):
@@ -170,36 +280,18 @@ class UploadToS3(BaseAction):
     def apply(self, context, project):
         """
         Check if this file needs to get uploaded or not. In order to do so,
-        we could rely on ETAG for normal files, but one of the mainline
-        cases of gordon is to upload .zip files, and identical source folders
-        don't have consistent hashes when you zip them, so we need to
-        workaround this by generating our own hash by reading the zip content
-        in a particular order."""
-
-        self.project = project
-        self.context = context
-        self.bucket = self._get('bucket', self.context)
-        self.key = self._get('key', self.context)
-
-        self.filename = self._friendly_name = os.path.join(
-            project.build_path,
-            self._get('filename', context)
-        )
-
-        self.filename = self.prepare_file(self.filename)
-
-        s3client = boto3.client('s3')
-        try:
-            obj = s3client.head_object(Bucket=self.bucket, Key=self.key)
-        except Exception:
-            obj = None
-
-        # Calculate the hash of this file
-        file_hash = utils.get_file_hash(self.filename)
+        we could rely on ETAG for normal files, but ETAGs of multipart uploads
+        are not a digest of the content, so we store our own hash in the
+        metadata of the object. Zip files built by gordon are reproducible,
+        so identical source folders produce identical hashes.
+        The file is only prepared (e.g. the context injected into it) if it
+        needs to be uploaded, as its hash is known beforehand."""
+        file_hash = self._prepare(context, project)
+        obj = self._get_uploaded_object(file_hash)
 
         # If the object is present, and the hash in the metadata is the same
         # we don't need to upload it.
-        if obj and file_hash == obj['Metadata'].get('sha1'):
+        if obj:
             self._success(file_hash, project.puts)
             if self.project.debug:
                 project.puts(colored.white(u"✸ File with hash {} already present in {}/{}.".format(
@@ -213,10 +305,88 @@ class UploadToS3(BaseAction):
                 file_hash[:8], self.bucket, self.key))
             )
 
-        obj = boto3.resource('s3').Object(self.bucket, self.key)
-        obj.upload_file(self.filename, ExtraArgs={'Metadata': {'sha1': file_hash}})
+        name = os.path.relpath(self._friendly_name, self.project.build_path)
+        filename = self.prepare_file(self.filename)
+        size = os.path.getsize(filename)
+        config = project.transfer_config
+        s3client = project.get_s3_client()
+        project.upload_progress.start(name, size)
+        try:
+            if size < config.multipart_threshold and not config.max_bandwidth:
+                # Single part uploads return the version of the object they
+                # create, so it doesn't need to be fetched again.
+                with open(filename, 'rb') as f:
+                    obj = s3client.put_object(Bucket=self.bucket, Key=self.key, Body=f,
+                                              Metadata={'sha1': file_hash})
+                project.upload_progress.callback(name)(size)
+            else:
+                s3client.upload_file(
+                    filename,
+                    self.bucket,
+                    self.key,
+                    ExtraArgs={'Metadata': {'sha1': file_hash}},
+                    Config=config,
+                    Callback=project.upload_progress.callback(name)
+                )
+                # upload_file doesn't return the version it created. If some
+                # other apply uploads the same key meanwhile, this could be
+                # its version instead.
+                obj = s3client.head_object(Bucket=self.bucket, Key=self.key)
+        finally:
+            project.upload_progress.finish(name)
+            if filename != self.filename:
+                os.remove(filename)
+
         self._success(file_hash, project.puts)
-        return self.output(obj.version_id)
+        return self.output(obj['VersionId'])
+
+    def plan(self, context, project):
+        """Returns the outputs ``apply`` would return without uploading the
+        file. If it is not uploaded yet, its version is unknown until it is
+        applied."""
+        file_hash = self._prepare(context, project)
+        obj = self._get_uploaded_object(file_hash) if self.bucket != utils.PLAN_PENDING_VALUE else None
+        if obj:
+            self._success(file_hash, project.puts)
+            return self.output(obj['VersionId'])
+
+        project.puts(colored.yellow(u"~ {} ({}) will be uploaded".format(
+            os.path.relpath(self._friendly_name, self.project.build_path), file_hash[:8]))
+        )
+        return self.output(utils.PLAN_PENDING_VALUE)
+
+    def _prepare(self, context, project):
+        """Resolves the properties of this action within ``context`` and
+        returns the hash of the file to upload."""
+        self.project = project
+        self.context = context
+        self.bucket = self._get('bucket', self.context)
+        self.key = self._get('key', self.context)
+
+        self.filename = self._friendly_name = os.path.join(
+            project.build_path,
+            self._get('filename', context)
+        )
+
+        return self.get_hash()
+
+    def get_hash(self):
+        """Returns the hash of the file to upload. ``gordon build`` records
+        the hash of the artifacts it generates, so they don't need to be
+        hashed again."""
+        return self.project.get_artifact_hash(self.filename) or utils.get_file_hash(self.filename)
+
+    def _get_uploaded_object(self, file_hash):
+        """Returns the object in ``bucket/key`` if it was uploaded with the
+        same hash."""
+        s3client = self.project.get_s3_client()
+        try:
+            obj = s3client.head_object(Bucket=self.bucket, Key=self.key)
+        except Exception:
+            return None
+        if file_hash == obj['Metadata'].get('sha1'):
+            return obj
+        return None
 
     def output(self, version):
         return {
@@ -229,6 +399,8 @@ class UploadToS3(BaseAction):
         }
 
     def prepare_file(self, filename):
+        """Returns the path of the file to upload, which might be a modified
+        copy of ``filename``."""
         return filename
 
     def _success(self, metadata, puts_function):
@@ -258,15 +430,32 @@ class InjectContextAndUploadToS3(UploadToS3):
         ('context_destinaton', None, False),
     )
 
+    def get_hash(self):
+        """The hash of the file to upload combines the hash of the artifact
+        and the context injected into it, so it is known without injecting
+        it."""
+        digest = hashlib.sha1(super(InjectContextAndUploadToS3, self).get_hash().encode('utf-8'))
+        digest.update(self._get_context_destination().encode('utf-8'))
+        digest.update(self._get_context_data().encode('utf-8'))
+        return digest.hexdigest()
+
+    def _get_context_destination(self):
+        return self.context_destinaton or '.context'
+
+    def _get_context_data(self):
+        return json.dumps(enrich_references(self.context_to_inject or {}, self.context), sort_keys=True)
+
     def prepare_file(self, filename):
-        context_to_inject = enrich_references(self.context_to_inject or {}, self.context)
-        context_destinaton = self.context_destinaton or '.context'
-        _, tmpfile = tempfile.mkstemp(suffix='.{}'.format(self.filename.rsplit('.', 1)[1]))
-        shutil.copyfile(self.filename, tmpfile)
+        fd, tmpfile = tempfile.mkstemp(suffix='.{}'.format(filename.rsplit('.', 1)[1]))
+        os.close(fd)
+        shutil.copyfile(filename, tmpfile)
         zfile = zipfile.ZipFile(tmpfile, 'a')
 
-        context_info = zipfile.ZipInfo(context_destinaton)
-        context_info.external_attr = 0o444 << 16
-        zfile.writestr(context_info, json.dumps(context_to_inject))
+        utils.write_zip_data(
+            zfile,
+            self._get_context_destination(),
+            self._get_context_data(),
+            mode=0o444
+        )
         zfile.close()
         return tmpfile
@@ -2,12 +2,15 @@ import os
 import re
 import sys
 import argparse
+import importlib
 
 from clint.textui import colored, puts
 
-from .core import Bootstrap, ProjectBuild, ProjectApply, ProjectDelete, ProjectRun
 from .exceptions import BaseGordonException
 
+# Commands which can run in several regions at once.
+MULTI_REGION_COMMANDS = ('apply', 'plan', 'delete')
+
 
 def stage_validator(s):
     """Stage names must be between 2 and 16 characters long."""
@@ -17,6 +20,15 @@ def stage_validator(s):
         raise argparse.ArgumentTypeError("Stage names can only contain alphanumeric characters")
 
 
+def get_command_class(path):
+    """Imports and returns the class ``path`` (e.g. ``gordon.core.ProjectBuild``).
+    Commands are only imported once selected, so every command only pays the
+    cost of importing what it needs (e.g. ``startproject`` doesn't import
+    ``boto3``)."""
+    module, name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
 def main(argv=None, stdin=None):
     stdin = stdin or sys.stdin
     argv = (argv or sys.argv)[1:]
@@ -30,7 +42,8 @@ def main(argv=None, stdin=None):
     def add_default_arguments(p):
         p.add_argument("--region",
                        dest="region",
-                       help="AWS region where this project should be applied")
+                       help=("AWS region where this project should be applied. apply, plan and delete accept a comma "
+                             "separated list of regions, which are run concurrently."))
 
         p.add_argument("--debug",
                        dest="debug",
@@ -39,7 +52,7 @@ def main(argv=None, stdin=None):
 
     startproject_parser = subparsers.add_parser('startproject', description='Start a new project')
     add_default_arguments(startproject_parser)
-    startproject_parser.set_defaults(cls=Bootstrap)
+    startproject_parser.set_defaults(cls='gordon.bootstrap.Bootstrap')
     startproject_parser.set_defaults(func="startproject")
     startproject_parser.add_argument("project_name",
                                      type=str,
@@ -47,7 +60,7 @@ def main(argv=None, stdin=None):
 
     startapp_parser = subparsers.add_parser('startapp', description='Start a new app')
     add_default_arguments(startapp_parser)
-    startapp_parser.set_defaults(cls=Bootstrap)
+    startapp_parser.set_defaults(cls='gordon.bootstrap.Bootstrap')
     startapp_parser.set_defaults(func="startapp")
     startapp_parser.add_argument("app_name",
                                  type=str,
@@ -61,12 +74,34 @@ def main(argv=None, stdin=None):
 
     build_parser = subparsers.add_parser('build', description='Build')
     add_default_arguments(build_parser)
-    build_parser.set_defaults(cls=ProjectBuild)
+    build_parser.set_defaults(cls='gordon.core.ProjectBuild')
     build_parser.set_defaults(func="build")
+    build_parser.add_argument("-j", "--jobs",
+                              dest="jobs",
+                              type=int,
+                              default=1,
+                              help="Number of lambdas to package concurrently.")
+    build_parser.add_argument("--no-cache",
+                              dest="use_cache",
+                              action="store_false",
+                              help="Don't use the build cache. All lambdas will be built from scratch.")
+    build_parser.add_argument("--incremental",
+                              dest="incremental",
+                              action="store_true",
+                              help="Keep the build directory and only regenerate what changed since the last build.")
+    build_parser.add_argument("--watch",
+                              dest="cls",
+                              action="store_const",
+                              const='gordon.watch.ProjectWatch',
+                              help="Keep rebuilding the project every time any of its files change.")
+    build_parser.add_argument("--profile",
+                              dest="profile",
+                              action="store_true",
+                              help="Measure how long each step of the build takes.")
 
     apply_parser = subparsers.add_parser('apply', description='Apply')
     add_default_arguments(apply_parser)
-    apply_parser.set_defaults(cls=ProjectApply)
+    apply_parser.set_defaults(cls='gordon.core.ProjectApply')
     apply_parser.set_defaults(func="apply")
     apply_parser.add_argument("-s", "--stage",
                               dest="stage",
@@ -78,10 +113,44 @@ def main(argv=None, stdin=None):
                               type=int,
                               default=15,
                               help="CloudFormation timeout.")
+    apply_parser.add_argument("--wait-timeout",
+                              dest="wait_timeout",
+                              type=int,
+                              default=15,
+                              help="Minutes to wait for each stack to be created or updated.")
+    apply_parser.add_argument("-j", "--jobs",
+                              dest="jobs",
+                              type=int,
+                              default=None,
+                              help="Number of actions (e.g. lambda uploads) to apply concurrently.")
+    apply_parser.add_argument("--plan",
+                              dest="plan",
+                              action="store_true",
+                              help="Apply the plan saved by gordon plan.")
+
+    plan_parser = subparsers.add_parser('plan', description='Show the changes apply would make')
+    add_default_arguments(plan_parser)
+    plan_parser.set_defaults(cls='gordon.core.ProjectPlan')
+    plan_parser.set_defaults(func="plan")
+    plan_parser.add_argument("-s", "--stage",
+                             dest="stage",
+                             type=stage_validator,
+                             default='dev',
+                             help="Stage where to plan this project")
+    plan_parser.add_argument("--wait-timeout",
+                             dest="wait_timeout",
+                             type=int,
+                             default=15,
+                             help="Minutes to wait for CloudFormation to compute the changes of each stack.")
+    plan_parser.add_argument("-j", "--jobs",
+                             dest="jobs",
+                             type=int,
+                             default=None,
+                             help="Number of actions (e.g. lambda hashes) to plan concurrently.")
 
     run_parser = subparsers.add_parser('run', description='Run lambda locally')
     add_default_arguments(run_parser)
-    run_parser.set_defaults(cls=ProjectRun)
+    run_parser.set_defaults(cls='gordon.core.ProjectRun')
     run_parser.set_defaults(func="run")
     run_parser.add_argument("lambda_name",
                             type=str,
@@ -89,7 +158,7 @@ def main(argv=None, stdin=None):
 
     delete_parser = subparsers.add_parser('delete', description='Delete this project stacks')
     add_default_arguments(delete_parser)
-    delete_parser.set_defaults(cls=ProjectDelete)
+    delete_parser.set_defaults(cls='gordon.core.ProjectDelete')
     delete_parser.set_defaults(func="delete")
     delete_parser.add_argument("-s", "--stage",
                                dest="stage",
@@ -101,11 +170,35 @@ def main(argv=None, stdin=None):
                                action="store_false",
                                help="Confirm the deletion of the resources")
 
+    cache_parser = subparsers.add_parser('cache', description='Inspect and prune the build cache')
+    add_default_arguments(cache_parser)
+    cache_parser.set_defaults(cls='gordon.cache.Cache')
+    cache_parser.set_defaults(func="inspect")
+    cache_parser.add_argument("--prune",
+                              dest="prune",
+                              action="store_true",
+                              help="Evict least recently used entries until each cache fits in --max-size.")
+    cache_parser.add_argument("--max-size",
+                              dest="max_size",
+                              type=int,
+                              help="Maximum size of each cache in MB.")
+    cache_parser.add_argument("--clear",
+                              dest="clear",
+                              action="store_true",
+                              help="Remove all cached artifacts.")
+
     options, args = parser.parse_known_args(argv)
 
+    # Commands run in several regions are run by ``MultiRegion``, which runs
+    # the selected command concurrently in each of them.
+    if options.func in MULTI_REGION_COMMANDS and len((options.region or '').split(',')) > 1:
+        from .regions import parse_regions
+        options.command, options.cls = options.cls, 'gordon.regions.MultiRegion'
+        options.region = parse_regions(options.region)
+
     path = os.getcwd()
     try:
-        obj = options.cls(path=path, stdin=stdin, **vars(options))
+        obj = get_command_class(options.cls)(path=path, stdin=stdin, **vars(options))
         getattr(obj, options.func)()
     except BaseGordonException as exc:
         puts(colored.red("\n{}".format(exc.get_hint())))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import random
+import hashlib
+
+import six
+import jinja2
+
+from . import exceptions
+from . import utils
+
+
+class Bootstrap(object):
+    """Project and apps bootstraper"""
+
+    valid_extensions = (
+        '.gradle',
+        '.java',
+        '.yml',
+        '.js',
+        '.py'
+    )
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.region = utils.setup_region(kwargs.pop('region', None))
+        self.project_name = self._clean_name(kwargs.pop('project_name', ''))
+        self.app_name = self._clean_name(kwargs.pop('app_name', ''))
+        self.runtime = kwargs.pop('runtime', None)
+        self.root = os.path.dirname(os.path.abspath(__file__))
+
+    def _clean_name(self, name):
+        name = name.lower()
+        name = [p for p in re.split(r'[^a-zA-Z0-9]', name) if p]
+        return u'-'.join(name)
+
+    def startproject(self):
+        """Create a new project called ``project_name``."""
+
+        path = os.path.join(self.path, self.project_name)
+        if os.path.exists(path):
+            raise exceptions.ProjectDirectoryAlreadyExistsError(self.project_name)
+        else:
+            os.makedirs(path)
+
+        context = {
+            'project_name': self.project_name,
+            'default_region': self.region,
+            'random': hashlib.sha1(six.text_type(random.random()).encode('utf-8')).hexdigest()[:8]
+        }
+
+        self._clone_defaults(
+            os.path.join(self.root, 'defaults', 'project'),
+            path,
+            context
+        )
+
+    def startapp(self):
+        """Create a new application called ``app_name``."""
+
+        path = os.path.join(self.path, self.app_name)
+        if os.path.exists(path):
+            raise exceptions.AppDirectoryAlreadyExistsError(self.app_name)
+        else:
+            os.makedirs(path)
+
+        context = {
+            'app_name': self.app_name,
+        }
+
+        self._clone_defaults(
+            os.path.join(self.root, 'defaults', 'app_{}'.format(self.runtime)),
+            path,
+            context
+        )
+
+    def _clone_defaults(self, source, dest, context):
+        """Clone ``source`` directory into ``dest`` directory and enrich
+        files assuming they are jinja2 templates"""
+
+        for base, dirs, files in os.walk(source):
+            relative = os.path.relpath(base, source)
+
+            for d in dirs:
+                os.makedirs(os.path.join(dest, relative, d))
+
+            for filename in files:
+
+                if not filename.endswith(self.valid_extensions):
+                    continue
+
+                with open(os.path.join(base, filename), 'r') as f:
+                    data = f.read()
+
+                with open(os.path.join(dest, relative, filename), 'w') as f:
+                    data = jinja2.Template(data).render(**context)
+                    f.write(data)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from clint.textui import colored, puts, indent
+
+from . import utils
+
+# Version of the format of the cached artifacts. Bump it every time the way
+# gordon builds artifacts changes, so stale entries are never reused.
+BUILD_CACHE_VERSION = 2
+
+# Default maximum size (in MB) of the build cache.
+DEFAULT_BUILD_CACHE_SIZE = 1024
+
+# Default maximum size (in MB) of the dependency cache.
+DEFAULT_DEPENDENCY_CACHE_SIZE = 2048
+
+
+class BaseCache(object):
+    """Base class of caches which evict their least recently used entries
+    once they grow over ``max_size`` bytes. Subclasses implement ``entries``
+    and ``_remove``."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+
+    def entries(self):
+        """Returns a list of ``(key, size, last_used)`` for all entries in
+        the cache, sorted from the most to the least recently used one."""
+        raise NotImplementedError()
+
+    def _remove(self, key):
+        raise NotImplementedError()
+
+    def size(self):
+        return sum([size for _, size, _ in self.entries()])
+
+    def prune(self, max_size=None):
+        """Evicts least recently used entries until the cache is not bigger
+        than ``max_size`` bytes. Returns the list of evicted entries."""
+        max_size = self.max_size if max_size is None else max_size
+        total, evicted = 0, []
+        for key, size, last_used in self.entries():
+            total += size
+            if total > max_size:
+                self._remove(key)
+                evicted.append((key, size, last_used))
+        return evicted
+
+    def clear(self):
+        return self.prune(max_size=0)
+
+
+class BuildCache(BaseCache):
+    """Content-addressed cache of lambda artifacts.
+
+    Artifacts are stored as ``<key>.zip`` files in ``path``, where ``key`` is
+    a hash of everything which affects the content of the artifact. The
+    modification time of each entry is used as its last access time, so once
+    the cache grows over ``max_size`` bytes, least recently used entries are
+    evicted first."""
+
+    def __init__(self, path, max_size=DEFAULT_BUILD_CACHE_SIZE * 1024 * 1024):
+        super(BuildCache, self).__init__(path, max_size)
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.path, '{}.zip'.format(key))
+
+    def get(self, key, destination):
+        """Copies the artifact ``key`` into ``destination``. Returns ``True``
+        if the artifact was present in the cache."""
+        entry = self._get_entry_path(key)
+        try:
+            shutil.copyfile(entry, destination)
+        except (IOError, OSError):
+            return False
+        try:
+            os.utime(entry, None)
+        except OSError:
+            # The entry was pruned meanwhile, but it has already been copied.
+            pass
+        return True
+
+    def put(self, key, filename):
+        """Stores ``filename`` as the artifact ``key``. Entries are written
+        to a temporary file first, so concurrent builds never read partially
+        written artifacts."""
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(filename, tmp)
+            os.rename(tmp, self._get_entry_path(key))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def entries(self):
+        """Returns a list of ``(key, size, last_used)`` for all artifacts in
+        the cache, sorted from the most to the least recently used one."""
+        if not os.path.isdir(self.path):
+            return []
+
+        entries = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.zip'):
+                continue
+            stat = os.stat(os.path.join(self.path, filename))
+            entries.append((filename[:-4], stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2], reverse=True)
+
+    def _remove(self, key):
+        os.remove(self._get_entry_path(key))
+
+
+class DependencyCache(BaseCache):
+    """Cache of installed dependency sets (e.g. the output of
+    ``pip install -t``) shared by all lambdas with identical dependencies.
+
+    Each dependency set is a directory named after its key in ``path``. Sets
+    are installed into a temporary directory and renamed once complete, so
+    lambdas never use partially installed dependencies. As with the build
+    cache, least recently used sets are evicted first once the cache grows
+    over ``max_size`` bytes."""
+
+    def __init__(self, path, max_size=DEFAULT_DEPENDENCY_CACHE_SIZE * 1024 * 1024):
+        super(DependencyCache, self).__init__(path, max_size)
+
+    def get(self, key, install):
+        """Returns the path of the dependency set ``key``. If it is not
+        present, ``install`` is called with a directory where it must install
+        the dependencies first."""
+        entry = os.path.join(self.path, key)
+        if os.path.isdir(entry):
+            os.utime(entry, None)
+            return entry
+
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+
+        tmp = tempfile.mkdtemp(dir=self.path, suffix='.tmp')
+        try:
+            install(tmp)
+        except Exception:
+            shutil.rmtree(tmp)
+            raise
+
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Other build installed the same dependency set concurrently.
+            shutil.rmtree(tmp)
+            if not os.path.isdir(entry):
+                raise
+        return entry
+
+    def entries(self):
+        """Returns a list of ``(key, size, last_used)`` for all dependency
+        sets in the cache, sorted from the most to the least recently used
+        one."""
+        if not os.path.isdir(self.path):
+            return []
+
+        entries = []
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            if key.endswith('.tmp') or not os.path.isdir(entry):
+                continue
+            entries.append((key, utils.get_tree_size(entry), os.stat(entry).st_mtime))
+        return sorted(entries, key=lambda e: e[2], reverse=True)
+
+    def _remove(self, key):
+        shutil.rmtree(os.path.join(self.path, key))
+
+
+class Cache(object):
+    """Inspect and prune gordon's build and dependency caches."""
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.max_size = kwargs.pop('max_size', None)
+        self.prune = kwargs.pop('prune', False)
+        self.clear = kwargs.pop('clear', False)
+        self.build_cache = BuildCache(os.path.join(utils.get_workspace(), 'cache'))
+        self.dependency_cache = DependencyCache(os.path.join(utils.get_workspace(), 'dependencies'))
+
+    def inspect(self):
+        if self.clear:
+            self._evicted(self.build_cache.clear() + self.dependency_cache.clear())
+        elif self.prune:
+            max_size = self.max_size * 1024 * 1024 if self.max_size is not None else None
+            self._evicted(self.build_cache.prune(max_size) + self.dependency_cache.prune(max_size))
+
+        self._list("Build cache", self.build_cache, "artifacts")
+        self._list("Dependency cache", self.dependency_cache, "dependency sets")
+
+    def _list(self, title, cache, kind):
+        entries = cache.entries()
+        puts(colored.blue("{} ({})".format(title, cache.path)))
+        with indent(2):
+            for key, size, last_used in entries:
+                puts(u"{}  {:>10}  {}".format(
+                    key[:8],
+                    utils.format_size(size),
+                    datetime.fromtimestamp(last_used).strftime("%Y-%m-%d %H:%M")
+                ))
+            puts(colored.cyan("{} {}, {}".format(
+                len(entries),
+                kind,
+                utils.format_size(sum([size for _, size, _ in entries]))
+            )))
+
+    def _evicted(self, entries):
+        puts(colored.green(u"✓ Evicted {} entries ({})".format(
+            len(entries),
+            utils.format_size(sum([size for _, size, _ in entries]))
+        )))
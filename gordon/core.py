@@ -2,25 +2,36 @@
 import os
 import re
 import json
-import random
 import hashlib
 import shutil
-from collections import defaultdict
+import threading
+import traceback
+import multiprocessing
+from collections import defaultdict, OrderedDict
 
 import six
-import boto3
-import jinja2
 import troposphere
 from clint.textui import colored, puts, indent
-from botocore.exceptions import ClientError
 
 from . import exceptions
 from . import utils
 from . import actions
 from . import resources
 from . import protocols
+from . import stacks
+from .cache import BuildCache, DependencyCache, DEFAULT_BUILD_CACHE_SIZE, DEFAULT_DEPENDENCY_CACHE_SIZE
+from .profiler import Profiler, NullProfiler, PROFILE_FILE
+from .bootstrap import Bootstrap  # noqa
+from .registry import ResourceRegistry, SortedResources
 
 SETTINGS_FILE = 'settings.yml'
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+PLAN_FILE = 'plan-{stage}-{region}.json'
+PLAN_VERSION = 1
+
+# Actions of parallelizable custom templates applied concurrently by default.
+DEFAULT_APPLY_JOBS = 4
 
 # Lambda region list updated on Nov 28, 2017 from
 # http://docs.aws.amazon.com/general/latest/gr/rande.html
@@ -53,37 +64,90 @@ AVAILABLE_RESOURCES = {
 }
 
 
+# How each kind of change is shown in plans.
+PLAN_ACTIONS = {
+    'Add': (u'+', colored.green),
+    'Modify': (u'~', colored.yellow),
+    'Replace': (u'±', colored.red),
+    'Remove': (u'-', colored.red),
+}
+
+# Project being built by the current packaging worker process. Workers are
+# forked, so they inherit the fully loaded project instead of pickling it.
+_packaging_project = None
+
+
+def _init_packaging_worker(project):
+    global _packaging_project
+    _packaging_project = project
+
+
+def _package_lambda(grn):
+    """Package the lambda ``grn`` of the project this worker is building.
+    Returns ``grn``, the hint of the error raised while packaging it (if
+    any) so failures can be reported per lambda, and the profiled sections of
+    its packaging. Errors are never
+    raised, as they would discard the results of all other lambdas."""
+    lambda_ = _packaging_project.get_resource(grn)
+    profiler = _packaging_project.profiler = _packaging_project.profiler.detached()
+    try:
+        lambda_.package()
+    except exceptions.BaseGordonException as exc:
+        return grn, exc.get_hint(), profiler.root['children']
+    except Exception:
+        hint = u"Error packaging lambda {}:\n{}".format(grn, traceback.format_exc())
+        return grn, hint, profiler.root['children']
+    return grn, None, profiler.root['children']
+
+
+def _get_fork_context():
+    """Returns the ``multiprocessing`` context which forks its workers, or
+    ``None`` where processes can't be forked (e.g. Windows)."""
+    if not hasattr(os, 'fork'):
+        return None
+    if not hasattr(multiprocessing, 'get_context'):
+        return multiprocessing
+    try:
+        return multiprocessing.get_context('fork')
+    except ValueError:
+        return None
+
+
 class BaseResourceContainer(object):
     """Base abstraction about types which can define resources in their settings."""
 
     def __init__(self, *args, **kwargs):
-        self._resources = defaultdict(list)
-        self._load_resources()
+        self._resources = defaultdict(SortedResources)
+        self._load_resources(resource_types=kwargs.pop('resource_types', None))
 
-    def _load_resources(self):
+    def _load_resources(self, resource_types=None):
         """Load resources defined in ``self.settings`` and stores them in
-        ``self._resources`` map."""
-        puts = (getattr(self, 'project', None) or self).puts
-        for resource_type, resource_cls in six.iteritems(AVAILABLE_RESOURCES):
-            for name in self.settings.get(resource_type, {}):
-                extra = {
-                    'project': getattr(self, 'project', None) or self,
-                    'app': self if hasattr(self, 'project') else None,
-                }
-
-                with indent(4 if hasattr(self, 'project') else 2):
-                    puts(colored.green(u"✓ {}:{}".format(resource_type, name)))
-
-                self._resources[resource_type].append(
-                    resource_cls.factory(
-                        name=name,
-                        settings=self.settings.get(resource_type, {})[name],
-                        **extra
+        ``self._resources`` map. If ``resource_types`` is provided, only
+        resources of those types are loaded."""
+        project = getattr(self, 'project', None) or self
+        with project.profiler.section('load {}'.format(getattr(self, 'name', 'project'))):
+            for resource_type, resource_cls in six.iteritems(AVAILABLE_RESOURCES):
+                if resource_types is not None and resource_type not in resource_types:
+                    continue
+                for name in self.settings.get(resource_type, {}):
+                    extra = {
+                        'project': project,
+                        'app': self if hasattr(self, 'project') else None,
+                    }
+
+                    with indent(4 if hasattr(self, 'project') else 2):
+                        project.puts(colored.green(u"✓ {}:{}".format(resource_type, name)))
+
+                    self._resources[resource_type].append(
+                        resource_cls.factory(
+                            name=name,
+                            settings=self.settings.get(resource_type, {})[name],
+                            **extra
+                        )
                     )
-                )
 
     def get_resources(self, resource_type):
-        for r in sorted(self._resources[resource_type], key=lambda r: r.name):
+        for r in self._resources[resource_type]:
             yield r
 
 
@@ -112,6 +176,7 @@ class BaseProject(object):
 
     DEFAULT_SETTINS = {}
     quiet = False
+    profiler = NullProfiler()
 
     def __init__(self, path, stdin, *args, **kwargs):
         self.path = path
@@ -132,12 +197,28 @@ class BaseProject(object):
             os.makedirs(self.get_workspace())
 
     def get_workspace(self):
-        return os.path.join(os.path.expanduser("~"), '.gordon')
+        return utils.get_workspace()
 
     def puts(self, *args, **kwargs):
         if not self.quiet:
             puts(*args, **kwargs)
 
+    def _get_manifest_path(self):
+        return os.path.join(self.build_path, MANIFEST_FILE)
+
+    def _load_manifest(self):
+        """Returns the manifest of the previous build. The manifest maps each
+        file in the build directory to a hash of the inputs used to generate
+        it, and the hash of its content for artifacts."""
+        try:
+            with open(self._get_manifest_path(), 'r') as f:
+                manifest = json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest.get('files', {})
+
 
 class ProjectBuild(BaseProject, BaseResourceContainer):
     """Representation of a project on build time. This type initializes
@@ -148,17 +229,53 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
     }
 
     def __init__(self, *args, **kwargs):
+        self.jobs = max(kwargs.pop('jobs', None) or 1, 1)
+        self.incremental = kwargs.pop('incremental', False)
+        use_cache = kwargs.pop('use_cache', True)
+        if kwargs.pop('profile', False):
+            self.profiler = Profiler()
         self.applications = []
-        self._in_project_resource_references = {}
-        self._in_project_cf_resource_references = {}
+        self.registry = ResourceRegistry()
+        # Artifacts packaged during this build, by build key.
+        self.packaged_artifacts = {}
         BaseProject.__init__(self, *args, **kwargs)
+        self.build_cache = None
+        if use_cache and utils.get_true_false(self.settings, 'build-cache'):
+            self.build_cache = BuildCache(
+                os.path.join(self.get_workspace(), 'cache'),
+                max_size=int(self.settings.get('build-cache-size', DEFAULT_BUILD_CACHE_SIZE)) * 1024 * 1024
+            )
+        self.staging_mode = self.settings.get('staging-mode', 'copy')
+        if self.staging_mode not in utils.STAGING_MODES:
+            raise exceptions.ValidationError(
+                "staging-mode must be one of: {}".format(', '.join(utils.STAGING_MODES))
+            )
+        self.resources_stacks = self.settings.get('resources-stacks', 'single')
+        if self.resources_stacks not in stacks.MODES:
+            raise exceptions.ValidationError(
+                "resources-stacks must be one of: {}".format(', '.join(stacks.MODES))
+            )
+        self.resources_stack_max_resources = self.settings.get('resources-stack-max-resources')
+        if self.resources_stack_max_resources is not None and int(self.resources_stack_max_resources) < 1:
+            raise exceptions.ValidationError("resources-stack-max-resources must be a positive number")
+        self.dependency_cache = None
+        if use_cache:
+            self.dependency_cache = DependencyCache(
+                os.path.join(self.get_workspace(), 'dependencies'),
+                max_size=int(self.settings.get('dependencies-cache-size', DEFAULT_DEPENDENCY_CACHE_SIZE)) * 1024 * 1024
+            )
+        self._load(*args, **kwargs)
+
+    def _load(self, *args, **kwargs):
+        """Loads all project and application resources, and validates them."""
         self.puts(colored.blue("Loading project resources"))
         BaseResourceContainer.__init__(self, *args, **kwargs)
         self.puts(colored.blue("Loading installed applications"))
         self._load_installed_applications()
-        for resource_type in AVAILABLE_RESOURCES:
-            for resouce in self.get_resources(resource_type):
-                resouce.validate()
+        with self.profiler.section('validate'):
+            for resource_type in AVAILABLE_RESOURCES:
+                for resouce in self.get_resources(resource_type):
+                    resouce.validate()
 
     def _load_installed_applications(self):
         """Loads all installed applications.
@@ -175,6 +292,21 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
         assumed to be the name and the value of that key is assumed to be a
         settings dictionary that will override the default app settings.
         """
+        for application_name, settings, path in self._get_installed_applications():
+            with indent(2):
+                self.puts(colored.cyan("{}:".format(application_name)))
+
+            self.add_application(
+                App(
+                    name=application_name,
+                    settings=settings,
+                    project=self,
+                    path=path
+                )
+            )
+
+    def _get_installed_applications(self):
+        """Yields the name, settings and path of all installed applications."""
         for application in self.settings.get('apps', None) or []:
             path = None
             if isinstance(application, six.string_types):
@@ -189,18 +321,7 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
                 settings = application.values()[0]
             else:
                 raise exceptions.InvalidAppFormatError(application)
-
-            with indent(2):
-                self.puts(colored.cyan("{}:".format(application_name)))
-
-            self.add_application(
-                App(
-                    name=application_name,
-                    settings=settings,
-                    project=self,
-                    path=path
-                )
-            )
+            yield application_name, settings, path
 
     def add_application(self, new_app):
         for app in self.applications:
@@ -210,19 +331,11 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
 
     def register_resource_reference(self, name, cf_name, resource):
         """Register a resouce called ``name`` as ``cf_name``"""
-        if name in self._in_project_resource_references or \
-           name in self._in_project_cf_resource_references or \
-           cf_name in self._in_project_cf_resource_references.values():
-            raise exceptions.DuplicateResourceNameError(name, cf_name)
-
-        self._in_project_cf_resource_references[name] = cf_name
-        self._in_project_resource_references[name] = resource
+        self.registry.register(name, cf_name, resource)
 
     def reference(self, name):
         """Resolve ``name`` as a CloudFormation reference"""
-        if name in self._in_project_cf_resource_references:
-            return self._in_project_cf_resource_references[name]
-        raise exceptions.ResourceNotFoundError(name, self._in_project_cf_resource_references.keys())
+        return self.registry.get_cf_name(name)
 
     def get_resources(self, resource_type=None):
         """Returns all project and application resources"""
@@ -234,25 +347,108 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
             yield r
 
     def get_resource(self, grn):
-        if grn in self._in_project_resource_references:
-            return self._in_project_resource_references[grn]
-        raise exceptions.ResourceNotFoundError(grn, self._in_project_resource_references.keys())
+        if grn in self.registry:
+            return self.registry.get(grn)
+        raise exceptions.ResourceNotFoundError(grn, self.registry.similar(grn))
 
     def build(self):
-        """Build current current project"""
+        """Build current current project.
+        If ``incremental``, the build directory is kept, and only templates
+        and artifacts whose inputs changed since the previous build (according
+        to the build manifest) are written again."""
         self.puts(colored.blue("Building project..."))
 
-        if os.path.exists(self.build_path):
+        self._manifest = self._load_manifest() if self.incremental else {}
+        self._new_manifest = {}
+        # Artifacts of previous builds might have been removed since.
+        self.packaged_artifacts = {}
+
+        if os.path.exists(self.build_path) and not self._manifest:
             shutil.rmtree(self.build_path)
-        os.makedirs(self.build_path)
+            for lambda_ in self.get_resources('lambdas'):
+                lambda_.packaged = False
+        if not os.path.exists(self.build_path):
+            os.makedirs(self.build_path)
 
-        with indent(2):
-            self._reset_build_sequence_id()
-            self._build_pre_project_template()
-            self._build_project_template()
-            self._build_pre_resources_template()
-            self._build_resources_template()
-            self._build_post_resources_template()
+        with self.profiler.section('build'):
+            with indent(2):
+                self._reset_build_sequence_id()
+                with self.profiler.section('pre project template'):
+                    self._build_pre_project_template()
+                with self.profiler.section('project template'):
+                    self._build_project_template()
+                with self.profiler.section('pre resources template'):
+                    self._build_pre_resources_template()
+                with self.profiler.section('resources template'):
+                    self._build_resources_template()
+                with self.profiler.section('post resources template'):
+                    self._build_post_resources_template()
+
+            self._remove_stale_build_files()
+            self._save_manifest()
+
+            if self.build_cache:
+                with self.profiler.section('prune build cache'):
+                    self.build_cache.prune()
+            if self.dependency_cache:
+                with self.profiler.section('prune dependency cache'):
+                    self.dependency_cache.prune()
+
+        if isinstance(self.profiler, Profiler):
+            self.profiler.finish()
+            self.profiler.save(os.path.join(self.build_path, PROFILE_FILE))
+            self.profiler.summary(self.puts)
+
+    def _save_manifest(self):
+        with open(self._get_manifest_path(), 'w') as f:
+            f.write(json.dumps({'version': MANIFEST_VERSION, 'files': self._new_manifest}, indent=4, sort_keys=True))
+
+    def register_build_file(self, filename, inputs_hash):
+        """Register ``filename`` as part of the current build, generated
+        using inputs which hash is ``inputs_hash``."""
+        relative = os.path.relpath(filename, self.build_path)
+        self._new_manifest[relative] = {'inputs': inputs_hash}
+
+    def register_artifact(self, filename, inputs_hash):
+        """Register the artifact ``filename`` as part of the current build,
+        recording the hash of its content so ``apply`` doesn't need to
+        compute it. Artifacts generated by the previous build using the same
+        inputs keep their hash."""
+        relative = os.path.relpath(filename, self.build_path)
+        previous = self._manifest.get(relative, {})
+        if self.is_build_file_fresh(filename, inputs_hash) and previous.get('sha1'):
+            content_hash = previous['sha1']
+        else:
+            content_hash = utils.get_file_hash(filename)
+        self._new_manifest[relative] = {'inputs': inputs_hash, 'sha1': content_hash}
+
+    def is_build_file_fresh(self, filename, inputs_hash):
+        """Returns ``True`` if ``filename`` was generated by the previous
+        build using the same inputs, so it doesn't need to be generated
+        again."""
+        relative = os.path.relpath(filename, self.build_path)
+        previous = self._manifest.get(relative, {}).get('inputs')
+        return bool(inputs_hash) and previous == inputs_hash and os.path.exists(filename)
+
+    def _write_build_file(self, filename, content):
+        """Write ``content`` into ``filename`` within the build directory
+        unless the previous build already generated the same content."""
+        path = os.path.join(self.build_path, filename)
+        content_hash = hashlib.sha1(six.text_type(content).encode('utf-8')).hexdigest()
+        self.register_build_file(path, content_hash)
+        if self.is_build_file_fresh(path, content_hash):
+            return
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _remove_stale_build_files(self):
+        """Remove files generated by the previous build which are not part
+        of the current one."""
+        for relative in self._manifest:
+            if relative not in self._new_manifest:
+                path = os.path.join(self.build_path, relative)
+                if os.path.exists(path):
+                    os.remove(path)
 
     def _reset_build_sequence_id(self):
         self._build_sequence = 0
@@ -296,8 +492,7 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
         if template:
             output_filename = output_filename.format(self._get_next_build_sequence_id())
             self.puts(colored.cyan(output_filename))
-            with open(os.path.join(self.build_path, output_filename), 'w') as f:
-                f.write(template.to_json(indent=4))
+            self._write_build_file(output_filename, template.to_json(indent=4))
 
     def _build_project_template(self,  output_filename="{}_p.json"):
         """Collect registered hooks both for ``register_type_project_template``
@@ -314,14 +509,16 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
         template = utils.fix_troposphere_references(template)
 
         self.puts(colored.cyan(output_filename))
-        with open(os.path.join(self.build_path, output_filename), 'w') as f:
-            f.write(template.to_json())
+        self._write_build_file(output_filename, template.to_json())
 
     def _build_pre_resources_template(self, output_filename="{}_pr_r.json"):
         """Collect registered hooks both for ``register_type_pre_resources_template``
         and ``register_pre_resources_template``"""
         template = actions.ActionsTemplate()
 
+        if self.jobs > 1:
+            self._package_lambdas()
+
         for resource_type, resource_cls in six.iteritems(AVAILABLE_RESOURCES):
             resource_cls.register_type_pre_resources_template(self, template)
             for r in self.get_resources(resource_type):
@@ -330,8 +527,65 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
         if template:
             output_filename = output_filename.format(self._get_next_build_sequence_id())
             self.puts(colored.cyan(output_filename))
-            with open(os.path.join(self.build_path, output_filename), 'w') as f:
-                f.write(template.to_json(indent=4))
+            self._write_build_file(output_filename, template.to_json(indent=4))
+
+    def _package_lambdas(self):
+        """Package all lambdas concurrently using a pool of up to ``jobs``
+        processes. Templates are still generated sequentially afterwards, so
+        the output of the build doesn't depend on the packaging order. Where
+        processes can't be forked, lambdas are packaged sequentially while
+        generating templates."""
+        # Packaging workers need to be forked in order to inherit the project.
+        context = _get_fork_context()
+        lambdas = [lambda_ for lambda_ in self.get_resources('lambdas') if not lambda_.packaged]
+        if not lambdas or context is None:
+            return
+
+        code_path = os.path.dirname(lambdas[0].get_zip_filename())
+        if not os.path.exists(code_path):
+            os.makedirs(code_path)
+        self.create_workspace()
+
+        # Lambdas with the same build key produce the same artifact, so only
+        # one of them needs to be built. Keys are only computed if the build
+        # needs them anyway, and workers inherit them.
+        representatives = OrderedDict()
+        with self.profiler.section('build keys'):
+            for lambda_ in lambdas:
+                if self.build_cache or self.incremental:
+                    lambda_.build_key = lambda_.get_build_key()
+                    representatives.setdefault(lambda_.build_key, lambda_)
+                else:
+                    representatives[lambda_.in_project_name] = lambda_
+
+        pool = context.Pool(
+            processes=min(self.jobs, len(representatives)),
+            initializer=_init_packaging_worker,
+            initargs=(self,)
+        )
+        try:
+            results = pool.map(_package_lambda, [l.in_project_name for l in representatives.values()])
+        finally:
+            pool.close()
+            pool.join()
+
+        for _, _, sections in results:
+            self.profiler.attach(sections)
+
+        errors = [(grn, hint) for grn, hint, _ in results if hint]
+        for grn, hint in errors:
+            self.puts(colored.red(hint))
+        if errors:
+            raise exceptions.LambdaPackagingError(len(errors), ', '.join([grn for grn, _ in errors]))
+
+        for lambda_ in representatives.values():
+            lambda_.packaged = True
+            if lambda_.build_key:
+                self.packaged_artifacts[lambda_.build_key] = lambda_.get_zip_filename()
+
+        for lambda_ in lambdas:
+            if not lambda_.packaged:
+                lambda_.package()
 
     def _build_resources_template(self, output_filename="{}_r.json"):
         """Collect registered hooks both for ``register_type_resources_template``
@@ -339,18 +593,37 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
 
         template = self._base_troposphere_template()
 
+        # Group of each resource and output, used to split the template in
+        # several stacks.
+        groups = {}
         for resource_type, resource_cls in six.iteritems(AVAILABLE_RESOURCES):
             resource_cls.register_type_resources_template(self, template)
             for r in self.get_resources(resource_type):
+                registered = set(template.resources) | set(template.outputs)
                 r.register_resources_template(template)
+                if self.resources_stacks == 'app' and r.app:
+                    group = r.app.name.replace('_', '-')
+                    for name in (set(template.resources) | set(template.outputs)) - registered:
+                        groups[name] = group
 
         template = utils.fix_troposphere_references(template)
 
-        if template and template.resources:
+        if not (template and template.resources):
+            return
+
+        if self.resources_stacks == 'single' and not self.resources_stack_max_resources:
             output_filename = output_filename.format(self._get_next_build_sequence_id())
             self.puts(colored.cyan(output_filename))
-            with open(os.path.join(self.build_path, output_filename), 'w') as f:
-                f.write(template.to_json())
+            self._write_build_file(output_filename, template.to_json())
+            return
+
+        max_resources = int(self.resources_stack_max_resources or 0) or None
+        for name, shard in stacks.split_template(template.to_dict(), groups, max_resources=max_resources):
+            filename = output_filename.format(self._get_next_build_sequence_id())
+            if name:
+                filename = '{}-{}.json'.format(filename[:-5], name)
+            self.puts(colored.cyan(filename))
+            self._write_build_file(filename, json.dumps(shard, indent=4, sort_keys=True, separators=(',', ': ')))
 
     def _build_post_resources_template(self, output_filename="{}_ps_r.json"):
         """Collect registered hooks both for ``register_type_post_resources_template``
@@ -366,24 +639,52 @@ class ProjectBuild(BaseProject, BaseResourceContainer):
         if template:
             output_filename = output_filename.format(self._get_next_build_sequence_id())
             self.puts(colored.cyan(output_filename))
-            with open(os.path.join(self.build_path, output_filename), 'w') as f:
-                f.write(template.to_json(indent=4))
+            self._write_build_file(output_filename, template.to_json(indent=4))
 
 
 class ProjectRun(ProjectBuild):
+    """Runs one lambda locally. Running a lambda doesn't depend on any other
+    resource, so only the lambdas of its app are loaded. If the lambda can't
+    be found that way, the whole project is loaded."""
 
     quiet = True
 
     def __init__(self, *args, **kwargs):
-        super(ProjectRun, self).__init__(*args, **kwargs)
         self.lambda_friendly_name = kwargs['lambda_name']
+        super(ProjectRun, self).__init__(*args, **kwargs)
 
-    def run(self):
+    def _load(self, *args, **kwargs):
+        app_name = self.lambda_friendly_name.split('.', 1)[0]
+        for application_name, settings, path in self._get_installed_applications():
+            if application_name == app_name:
+                self._resources = defaultdict(SortedResources)
+                self.add_application(
+                    App(
+                        name=application_name,
+                        settings=settings,
+                        project=self,
+                        path=path,
+                        resource_types=('lambdas',)
+                    )
+                )
+                break
+
+        if self._get_lambda():
+            return
+
+        self.applications = []
+        self.registry = ResourceRegistry()
+        super(ProjectRun, self)._load(*args, **kwargs)
+
+    def _get_lambda(self):
         grn = utils.lambda_friendly_name_to_grn(self.lambda_friendly_name).rsplit(':', 1)[0]
-        lambdas = [l for l in self.get_resources('lambdas') if l.in_project_name == grn]
-        if not lambdas:
+        return self.registry.get(grn)
+
+    def run(self):
+        lambda_ = self._get_lambda()
+        if not lambda_:
             raise exceptions.LambdaNotFound(self.lambda_friendly_name)
-        lambdas[0].collect_and_run(stdin=self.stdin)
+        lambda_.collect_and_run(stdin=self.stdin)
 
 
 class ProjectApplyLoopBase(BaseProject):
@@ -392,6 +693,8 @@ class ProjectApplyLoopBase(BaseProject):
         super(ProjectApplyLoopBase, self).__init__(*args, **kwargs)
         self.stage = kwargs.pop('stage', None)
         self.timeout_in_minutes = kwargs.pop('timeout_in_minutes', 15)
+        self.wait_timeout = kwargs.pop('wait_timeout', None) or 15
+        self.jobs = kwargs.pop('jobs', None) or DEFAULT_APPLY_JOBS
         self.region = utils.setup_region(kwargs.pop('region', None), self.settings)
         if self.region not in AWS_LAMBDA_REGIONS:
             self.puts(
@@ -430,10 +733,36 @@ class ProjectApplyLoopBase(BaseProject):
 
 class ProjectApply(ProjectApplyLoopBase):
 
+    def __init__(self, *args, **kwargs):
+        super(ProjectApply, self).__init__(*args, **kwargs)
+        self.use_plan = kwargs.pop('plan', False)
+        self.plan_path = os.path.join(self.build_path, PLAN_FILE.format(stage=self.stage, region=self.region))
+        self._plan = None
+        self.transfer_config = utils.get_transfer_config(self.settings.get('s3-transfer'))
+        self.upload_progress = actions.UploadProgress(puts_function=self.puts)
+        self._s3_client = None
+        self._s3_client_lock = threading.Lock()
+        self._manifest = self._load_manifest()
+
+    def get_artifact_hash(self, filename):
+        """Returns the hash of the content of the artifact ``filename``
+        recorded when the project was built, or ``None`` if it wasn't."""
+        return self._manifest.get(os.path.relpath(filename, self.build_path), {}).get('sha1')
+
+    def get_s3_client(self):
+        """Returns the S3 client shared by all the actions of the project."""
+        with self._s3_client_lock:
+            if self._s3_client is None:
+                self._s3_client = utils.get_boto3_client('s3')
+        return self._s3_client
+
     def apply(self):
         self.puts(colored.blue("Applying project..."))
         context = self.get_initial_context()
         context.update(self.collect_parameters())
+        if self.use_plan:
+            self._plan = self._load_plan()
+            self._validate_plan(context)
 
         for (number, name, filename, template_type) in self.steps():
             with indent(2):
@@ -454,6 +783,8 @@ class ProjectApply(ProjectApplyLoopBase):
     def collect_parameters(self):
         """Collect parameters from both the ``common.yml`` parameters file and
         the specific parameters file for the selected stage."""
+        import boto3
+        from botocore.exceptions import ClientError
 
         parameters = {}
         parameters_paths = (
@@ -504,17 +835,235 @@ class ProjectApply(ProjectApplyLoopBase):
 
     def apply_cloudformation_template(self, name, filename, context):
         """Apply ``filename`` template with ``context``-"""
-        stack_name = utils.generate_stack_name(context['Stage'], self.name, name)
-        stack = utils.create_or_update_cf_stack(
-            name=stack_name,
+        if self._plan:
+            stack = self._apply_planned_cloudformation_template(name, filename, context)
+        else:
+            stack = self._create_or_update_stack(name, filename, context)
+
+        context.update(utils.get_stack_outputs(stack))
+
+    def _create_or_update_stack(self, name, filename, context):
+        return utils.create_or_update_cf_stack(
+            name=utils.generate_stack_name(context['Stage'], self.name, name),
             template_filename=os.path.join(self.build_path, filename),
             context=context,
             timeout_in_minutes=self.timeout_in_minutes,
+            wait_timeout=self.wait_timeout * 60,
             bucket=context.get('CodeBucket')
         )
 
-        for output in stack.get('Outputs', []):
-            context[output['OutputKey']] = output['OutputValue']
+    def _validate_plan(self, context):
+        """Checks that the parameters of every planned stack which don't come
+        from the outputs of other templates (e.g. the ones defined in the
+        parameters files) didn't change since the project was planned, before
+        applying anything."""
+        outputs = set()
+        for (number, name, filename, template_type) in self.steps():
+            with open(os.path.join(self.build_path, filename), 'r') as f:
+                template = json.loads(f.read())
+            outputs.update(template.get('Outputs', {}))
+            outputs.update(template.get('outputs', {}))
+
+        known = json.loads(json.dumps(
+            dict([(k, v) for k, v in six.iteritems(context) if k not in outputs]), default=six.text_type
+        ))
+        changed = []
+        for filename, step in sorted(six.iteritems(self._plan['steps'])):
+            for key, value in sorted(six.iteritems(step['parameters'])):
+                if key in known and value not in (known[key], utils.PLAN_PENDING_VALUE):
+                    changed.append("{} of {}".format(key, filename))
+        if changed:
+            raise exceptions.InvalidPlanError("parameters {} changed".format(', '.join(changed)))
+
+    def _apply_planned_cloudformation_template(self, name, filename, context):
+        """Apply ``filename`` template executing the change set of the saved
+        plan. Parameters which come from the outputs of previous templates
+        can't be checked before applying them (see ``_validate_plan``). If
+        any of them was unknown while planning (e.g. versions of lambdas which
+        weren't uploaded yet) or changed since (e.g. a previous stack of this
+        apply updated it), the change set is outdated, so gordon applies the
+        template directly instead."""
+        step = self._plan['steps'][filename]
+        with open(os.path.join(self.build_path, filename), 'r') as f:
+            parameters = json.loads(json.dumps(
+                utils.filter_context_for_template(context, f.read()), default=six.text_type
+            ))
+
+        names = set(parameters) | set(step['parameters'])
+        changed = sorted([n for n in names if parameters.get(n) != step['parameters'].get(n)])
+        if changed:
+            puts(colored.yellow("{} weren't known while planning or changed since. Applying {} directly.".format(
+                ', '.join(changed), filename)))
+            return self._create_or_update_stack(name, filename, context)
+
+        # Change sets without changes to resources still update the hash of
+        # the stack (see ``utils.add_template_hash``), so only the ones
+        # CloudFormation rejected as empty are skipped.
+        if not step['change_set']:
+            puts(colored.green(u'✓ No changes planned.'))
+            return utils.get_cf_stack(step['stack'])
+
+        return utils.execute_change_set(step['change_set'], wait_timeout=self.wait_timeout * 60)
+
+    def get_templates_hash(self):
+        """Returns a hash of all the templates of the project."""
+        digest = hashlib.sha1()
+        for (number, name, filename, template_type) in self.steps():
+            digest.update(filename.encode('utf-8'))
+            with open(os.path.join(self.build_path, filename), 'rb') as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def _load_plan(self):
+        """Loads the plan saved by ``gordon plan``, checking it was made for
+        the same stage, region and templates."""
+        if not os.path.exists(self.plan_path):
+            raise exceptions.InvalidPlanError("{} doesn't exist".format(self.plan_path))
+
+        with open(self.plan_path, 'r') as f:
+            plan = json.load(f)
+
+        if plan.get('version') != PLAN_VERSION:
+            raise exceptions.InvalidPlanError("it was made by another version of gordon")
+        elif (plan['stage'], plan['region']) != (self.stage, self.region):
+            raise exceptions.InvalidPlanError("it was made for stage {} in {}".format(plan['stage'], plan['region']))
+        elif plan['templates'] != self.get_templates_hash():
+            raise exceptions.InvalidPlanError("the project was built again after planning")
+        return plan
+
+
+class ProjectPlan(ProjectApply):
+    """Shows the changes applying the project would make. Custom templates
+    are applied in read-only mode, and a change set is created for each
+    CloudFormation template. Change sets are computed concurrently by
+    CloudFormation, and saved as a plan ``apply --plan`` can execute."""
+
+    def plan(self):
+        self.puts(colored.blue("Planning project..."))
+        context = self.get_initial_context()
+        context.update(self.collect_parameters())
+
+        change_set_name = utils.get_change_set_name()
+        planned = OrderedDict()
+        for (number, name, filename, template_type) in self.steps():
+            with indent(2):
+                puts(colored.cyan("{} ({})".format(filename, template_type)))
+            with indent(4):
+                if self.debug:
+                    puts(colored.white(u"✸ Planning template {} with context {}".format(filename, context)))
+                step = getattr(self, 'plan_{}_template'.format(template_type))(
+                    name, filename, context, change_set_name
+                )
+            if step:
+                planned[filename] = step
+
+        change_sets = utils.wait_for_change_sets(
+            [s['change_set'] for s in six.itervalues(planned) if s['change_set']],
+            timeout=self.wait_timeout * 60
+        )
+        for step in six.itervalues(planned):
+            if step['change_set']:
+                change_set = change_sets[step['change_set']]
+                step['changes'] = utils.get_change_set_changes(change_set)
+                if change_set['Status'] == 'FAILED':
+                    # Empty change sets are deleted, so there is nothing to execute.
+                    step['change_set'] = None
+
+        self._print_plan(planned)
+        with open(self.plan_path, 'w') as f:
+            json.dump({
+                'version': PLAN_VERSION,
+                'stage': self.stage,
+                'region': self.region,
+                'templates': self.get_templates_hash(),
+                'steps': planned
+            }, f, indent=4, sort_keys=True, separators=(',', ': '))
+        self.puts(colored.blue("Plan saved to {}. Apply it using gordon apply --plan".format(
+            os.path.relpath(self.plan_path, self.path))))
+
+    def plan_custom_template(self, name, filename, context, change_set_name):
+        """Plan ``filename`` template with ``context`` without applying it."""
+        with open(os.path.join(self.build_path, filename), 'r') as f:
+            template = actions.ActionsTemplate.from_dict(json.loads(f.read()))
+
+        outputs = template.plan(context, self)
+
+        for key, value in six.iteritems(outputs):
+            context[key] = value
+
+    def plan_cloudformation_template(self, name, filename, context, change_set_name):
+        """Create a change set for ``filename`` template with ``context``.
+        Subsequent templates get the current outputs of the stack, as the
+        new ones won't be known until it is applied. Templates with parameters
+        which won't be known until previous ones are applied (``pending``)
+        can't be planned, and are applied directly by ``apply --plan``."""
+        stack_name = utils.generate_stack_name(context['Stage'], self.name, name)
+        template_filename = os.path.join(self.build_path, filename)
+        with open(template_filename, 'r') as f:
+            template_body = f.read()
+
+        stack = utils.get_cf_stack(stack_name)
+        parameters = json.loads(json.dumps(
+            utils.filter_context_for_template(context, template_body), default=six.text_type
+        ))
+        step = {
+            'stack': stack_name,
+            'change_set': None,
+            'changes': [],
+            'parameters': parameters,
+            'pending': sorted([k for k, v in six.iteritems(parameters) if v == utils.PLAN_PENDING_VALUE]),
+            'new': not stack or stack['StackStatus'] == 'REVIEW_IN_PROGRESS',
+        }
+        if not step['pending'] and not utils.is_stack_up_to_date(stack, template_body, context):
+            bucket = context.get('CodeBucket')
+            step['change_set'] = utils.create_change_set(
+                stack_name,
+                change_set_name,
+                template_filename,
+                bucket=bucket if bucket != utils.PLAN_PENDING_VALUE else None,
+                context=context
+            )
+
+        for key in json.loads(template_body).get('Outputs', {}):
+            context[key] = utils.PLAN_PENDING_VALUE
+        if stack and stack['StackStatus'] != 'REVIEW_IN_PROGRESS':
+            context.update(utils.get_stack_outputs(stack))
+        return step
+
+    def _print_plan(self, planned):
+        self.puts(colored.blue("Changes:"))
+        counts = defaultdict(int)
+        for filename, step in six.iteritems(planned):
+            with indent(2):
+                puts(colored.cyan("{} ({})".format(filename, step['stack'])))
+            with indent(4):
+                if step.get('pending') and step['new']:
+                    counts['Create'] += 1
+                    puts(colored.green(u"+ Will be created once {} are known.".format(', '.join(step['pending']))))
+                elif step.get('pending'):
+                    counts['Unknown'] += 1
+                    puts(colored.yellow(u"~ Changes will be known once {} are known.".format(
+                        ', '.join(step['pending']))))
+                elif not step['changes']:
+                    puts(colored.green(u'✓ No changes.'))
+                for change in step['changes']:
+                    action = change['Action']
+                    if action == 'Modify' and change['Replacement'] == 'True':
+                        action = 'Replace'
+                    counts[action] += 1
+                    symbol, color = PLAN_ACTIONS[action]
+                    line = u"{} {} ({})".format(symbol, change['LogicalResourceId'], change['ResourceType'])
+                    if change['Properties']:
+                        line += u": {}".format(', '.join(change['Properties']))
+                    if action == 'Modify' and change['Replacement'] == 'Conditional':
+                        line += u" (might be replaced)"
+                    puts(color(line))
+
+        self.puts(colored.blue("Plan: {} to add, {} to change, {} to replace, {} to remove.".format(
+            counts['Add'], counts['Modify'], counts['Replace'], counts['Remove'])))
+        if counts['Create'] or counts['Unknown']:
+            self.puts(colored.blue("{} stacks to create and {} to update with changes known after apply.".format(
+                counts['Create'], counts['Unknown'])))
 
 
 class ProjectDelete(ProjectApplyLoopBase):
@@ -568,90 +1117,3 @@ class ProjectDelete(ProjectApplyLoopBase):
             name=stack_name,
             dry_run=self.dry_run
         )
-
-
-class Bootstrap(object):
-    """Project and apps bootstraper"""
-
-    valid_extensions = (
-        '.gradle',
-        '.java',
-        '.yml',
-        '.js',
-        '.py'
-    )
-
-    def __init__(self, path, **kwargs):
-        self.path = path
-        self.region = utils.setup_region(kwargs.pop('region', None))
-        self.project_name = self._clean_name(kwargs.pop('project_name', ''))
-        self.app_name = self._clean_name(kwargs.pop('app_name', ''))
-        self.runtime = kwargs.pop('runtime', None)
-        self.root = os.path.dirname(os.path.abspath(__file__))
-
-    def _clean_name(self, name):
-        name = name.lower()
-        name = [p for p in re.split(r'[^a-zA-Z0-9]', name) if p]
-        return u'-'.join(name)
-
-    def startproject(self):
-        """Create a new project called ``project_name``."""
-
-        path = os.path.join(self.path, self.project_name)
-        if os.path.exists(path):
-            raise exceptions.ProjectDirectoryAlreadyExistsError(self.project_name)
-        else:
-            os.makedirs(path)
-
-        context = {
-            'project_name': self.project_name,
-            'default_region': self.region,
-            'random': hashlib.sha1(six.text_type(random.random()).encode('utf-8')).hexdigest()[:8]
-        }
-
-        self._clone_defaults(
-            os.path.join(self.root, 'defaults', 'project'),
-            path,
-            context
-        )
-
-    def startapp(self):
-        """Create a new application called ``app_name``."""
-
-        path = os.path.join(self.path, self.app_name)
-        if os.path.exists(path):
-            raise exceptions.AppDirectoryAlreadyExistsError(self.app_name)
-        else:
-            os.makedirs(path)
-
-        context = {
-            'app_name': self.app_name,
-        }
-
-        self._clone_defaults(
-            os.path.join(self.root, 'defaults', 'app_{}'.format(self.runtime)),
-            path,
-            context
-        )
-
-    def _clone_defaults(self, source, dest, context):
-        """Clone ``source`` directory into ``dest`` directory and enrich
-        files assuming they are jinja2 templates"""
-
-        for base, dirs, files in os.walk(source):
-            relative = os.path.relpath(base, source)
-
-            for d in dirs:
-                os.makedirs(os.path.join(dest, relative, d))
-
-            for filename in files:
-
-                if not filename.endswith(self.valid_extensions):
-                    continue
-
-                with open(os.path.join(base, filename), 'r') as f:
-                    data = f.read()
-
-                with open(os.path.join(dest, relative, filename), 'w') as f:
-                    data = jinja2.Template(data).render(**context)
-                    f.write(data)
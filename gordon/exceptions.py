@@ -174,3 +174,41 @@ class LambdaNotFound(BaseGordonException):
 class ValidationError(BaseGordonException):
     hint = u"  Validation Error: {}"
     code = 24
+
+
+class LambdaPackagingError(BaseGordonException):
+    hint = u"{} lambda(s) failed to build: {}"
+    code = 25
+
+
+class ResourcesStacksCycleError(BaseGordonException):
+    hint = (u"Circular dependency between {}. Resources stacks can't depend on each other. Group these "
+            u"resources in the same app, or change your resources-stacks settings.")
+    code = 26
+
+
+class CloudFormationWaitTimeoutError(BaseGordonException):
+    hint = (u"Stack {} didn't finish updating after {} seconds. You can wait longer using --wait-timeout, "
+            u"or check its status in the CloudFormation console.")
+    code = 27
+
+
+class ChangeSetError(BaseGordonException):
+    hint = u"CloudFormation couldn't plan the changes of stack {}: {}"
+    code = 28
+
+
+class InvalidPlanError(BaseGordonException):
+    hint = u"The saved plan can't be applied: {}. Run gordon plan again."
+    code = 29
+
+
+class RegionsFailedError(BaseGordonException):
+    hint = u"{} of {} regions failed: {}"
+    code = 30
+
+
+class ResourcesStackLimitError(BaseGordonException):
+    hint = (u"Resources stack {} would have {} {}, but CloudFormation only allows {}. Use a lower "
+            u"resources-stack-max-resources, or group your resources in more apps.")
+    code = 31
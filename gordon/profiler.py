@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+from contextlib import contextmanager
+
+from clint.textui import colored, indent
+
+from . import utils
+
+PROFILE_FILE = 'profile.json'
+
+
+class Profiler(object):
+    """Collects a tree of timed sections of a build.
+
+    Every section records its wall time, the CPU time used by gordon itself
+    and the CPU time used by the subprocesses it waited for (build commands,
+    ``pip``, ``npm``...), plus any extra information (e.g. artifact sizes)
+    added to its ``info``."""
+
+    def __init__(self, name='gordon'):
+        self.root = self._node(name)
+        self._stack = [self.root]
+        self._start = (time.time(), os.times())
+
+    def _node(self, name, **info):
+        return {'name': name, 'info': info, 'children': []}
+
+    @contextmanager
+    def section(self, name, **info):
+        node = self._node(name, **info)
+        self._stack[-1]['children'].append(node)
+        self._stack.append(node)
+        start = (time.time(), os.times())
+        try:
+            yield node
+        finally:
+            self._stack.pop()
+            self._measure(node, start)
+
+    def _measure(self, node, start):
+        wall, times = start
+        end = os.times()
+        node['wall'] = time.time() - wall
+        node['cpu'] = (end[0] - times[0]) + (end[1] - times[1])
+        node['subprocess'] = (end[2] - times[2]) + (end[3] - times[3])
+
+    def detached(self):
+        """Returns a new profiler to measure work done in other process. Its
+        sections can be added to this profiler using ``attach``."""
+        return self.__class__(name=self.root['name'])
+
+    def attach(self, nodes):
+        """Adds ``nodes`` measured by a detached profiler to the current
+        section."""
+        self._stack[-1]['children'].extend(nodes)
+
+    def finish(self):
+        self._measure(self.root, self._start)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            f.write(json.dumps(self.root, indent=4, sort_keys=True))
+
+    def summary(self, puts, limit=25):
+        """Outputs the ``limit`` slowest sections."""
+        sections = []
+        self._flatten(self.root, [], sections)
+        sections.sort(key=lambda s: s[1]['wall'], reverse=True)
+
+        puts(colored.blue("Profile"))
+        with indent(2):
+            puts(u"{:>9}  {:>9}  {:>10}  {:>10}  {}".format('wall', 'cpu', 'subprocess', 'size', 'section'))
+            for path, node in sections[:limit]:
+                size = node['info'].get('size')
+                puts(u"{:>8.2f}s  {:>8.2f}s  {:>9.2f}s  {:>10}  {}".format(
+                    node['wall'],
+                    node['cpu'],
+                    node['subprocess'],
+                    utils.format_size(size) if size is not None else '-',
+                    ' > '.join(path)
+                ))
+
+    def _flatten(self, node, path, sections):
+        path = path + [node['name']]
+        if len(path) > 1:
+            sections.append((path[1:], node))
+        for child in node['children']:
+            self._flatten(child, path, sections)
+
+
+class NullProfiler(object):
+    """Profiler used when profiling is disabled. It doesn't measure
+    anything."""
+
+    @contextmanager
+    def section(self, name, **info):
+        yield self._node(name, **info)
+
+    def _node(self, name, **info):
+        return {'name': name, 'info': info, 'children': []}
+
+    def detached(self):
+        return self
+
+    def attach(self, nodes):
+        pass
+
+    @property
+    def root(self):
+        return self._node('gordon')
@@ -1,6 +1,5 @@
 import os
 import re
-import boto3
 from troposphere import Ref
 from gordon import exceptions
 
@@ -14,6 +13,7 @@ def env(value):
 
 
 def kinesis_match(value):
+    import boto3
     exp = re.compile(value)
     client = boto3.client('kinesis')
     paginator = client.get_paginator('list_streams')
@@ -41,6 +41,7 @@ def kinesis_endswith(value):
 
 
 def dynamodb_match(value):
+    import boto3
     exp = re.compile(value)
     client = boto3.client('dynamodb')
     paginator = client.get_paginator('list_tables')
@@ -68,6 +69,7 @@ def dynamodb_endswith(value):
 
 
 def dynamodb_stream_match(value):
+    import boto3
     exp = re.compile(value)
     client = boto3.client('dynamodbstreams')
     matches = []
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import select
+import traceback
+
+from clint.textui import colored, indent, puts
+
+from . import exceptions
+from .bin import get_command_class
+
+
+def parse_regions(value):
+    """Returns the list of regions in the comma separated list ``value``."""
+    regions = []
+    for region in (value or '').split(','):
+        region = region.strip()
+        if region and region not in regions:
+            regions.append(region)
+    return regions
+
+
+def _run_region(command, func, region, kwargs, read_fd, write_fd, color):
+    """Runs ``func`` of ``command`` in ``region`` within a forked process,
+    sending everything it outputs through ``write_fd``. Exits with the code of
+    the error which made it fail (if any)."""
+    os.close(read_fd)
+    for stream in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+        stream.flush()
+    os.dup2(write_fd, 1)
+    os.dup2(write_fd, 2)
+    os.close(write_fd)
+    # clint keeps writing to the original stdout, so it must write whole
+    # lines as they are printed.
+    if hasattr(sys.__stdout__, 'reconfigure'):
+        sys.__stdout__.reconfigure(line_buffering=True)
+    sys.stdout = os.fdopen(1, 'w', 1)
+    sys.stderr = os.fdopen(2, 'w', 1)
+    if color:
+        os.environ['CLINT_FORCE_COLOR'] = '1'
+
+    try:
+        code = _run_in_region(command, func, region, kwargs)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    sys.exit(code)
+
+
+def _run_in_region(command, func, region, kwargs):
+    """Runs ``func`` of ``command`` in ``region`` and returns the code of
+    the error which made it fail, or 0."""
+    # Every region gets its own boto3 session, using its region by default.
+    import boto3
+    boto3.setup_default_session(region_name=region)
+
+    try:
+        obj = get_command_class(command)(region=region, **kwargs)
+        getattr(obj, func)()
+    except exceptions.BaseGordonException as exc:
+        puts(colored.red(exc.get_hint()))
+        return exc.code
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+class MultiRegion(object):
+    """Runs ``func`` of a project command (e.g. ``apply``) concurrently in
+    several ``regions``. Each region is run in its own process, so they don't
+    share any state (``AWS_DEFAULT_REGION``, boto3 sessions, contexts...) and
+    one of them failing doesn't affect the others. Their output is shown line
+    by line, prefixed by the name of the region. Where processes can't be
+    forked (e.g. Windows), regions are run one after another instead."""
+
+    def __init__(self, path, stdin, command, region, func, **kwargs):
+        self.regions = region
+        self.command = command
+        self.func = func
+        kwargs.pop('cls', None)
+        self.kwargs = dict(kwargs, path=path, stdin=stdin, func=func)
+
+    def apply(self):
+        self.run()
+
+    def plan(self):
+        self.run()
+
+    def delete(self):
+        self.run()
+
+    def run(self):
+        from .core import _get_fork_context
+        puts(colored.blue("Running {} in {}".format(self.func, ', '.join(self.regions))))
+        context = _get_fork_context()
+        if context is None:
+            self._run_sequentially()
+            return
+
+        color = sys.stdout.isatty()
+        width = max([len(r) for r in self.regions])
+
+        processes, pipes, buffers, started = {}, {}, {}, {}
+        for region in self.regions:
+            read_fd, write_fd = os.pipe()
+            process = context.Process(
+                target=_run_region,
+                args=(self.command, self.func, region, self.kwargs, read_fd, write_fd, color)
+            )
+            process.start()
+            os.close(write_fd)
+            processes[region] = process
+            pipes[read_fd] = region
+            buffers[region] = b''
+            started[region] = time.time()
+
+        elapsed = {}
+        while pipes:
+            ready, _, _ = select.select(list(pipes), [], [])
+            for fd in ready:
+                region = pipes[fd]
+                data = os.read(fd, 64 * 1024)
+                if data:
+                    lines = (buffers[region] + data).split(b'\n')
+                    buffers[region] = lines.pop()
+                else:
+                    lines = [buffers[region]] if buffers[region] else []
+                for line in lines:
+                    self._puts(region, width, line)
+                if not data:
+                    os.close(fd)
+                    del pipes[fd]
+                    processes[region].join()
+                    elapsed[region] = time.time() - started[region]
+
+        self._summary(dict([(region, p.exitcode) for region, p in processes.items()]), elapsed)
+
+    def _run_sequentially(self):
+        codes, elapsed = {}, {}
+        for region in self.regions:
+            puts(colored.magenta(u"[{}]".format(region)))
+            started = time.time()
+            codes[region] = _run_in_region(self.command, self.func, region, self.kwargs)
+            elapsed[region] = time.time() - started
+        self._summary(codes, elapsed)
+
+    def _puts(self, region, width, line):
+        puts(u"{} {}".format(colored.magenta(u"[{}]".format(region.ljust(width))),
+                             line.decode('utf-8', 'replace')))
+
+    def _summary(self, codes, elapsed):
+        puts(colored.blue("Summary:"))
+        failed = []
+        for region in self.regions:
+            code = codes[region]
+            with indent(2):
+                if code == 0:
+                    puts(colored.green(u"✓ {} ({:.0f}s)".format(region, elapsed[region])))
+                else:
+                    failed.append(region)
+                    puts(colored.red(u"✗ {} failed with code {} ({:.0f}s)".format(region, code, elapsed[region])))
+
+        if failed:
+            raise exceptions.RegionsFailedError(len(failed), len(self.regions), ', '.join(failed))
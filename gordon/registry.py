@@ -0,0 +1,96 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from . import exceptions
+
+
+class SortedResources(object):
+    """List of resources kept sorted by name as they are added, so iterating
+    over them doesn't require sorting them every time. Resources with the same
+    name are kept in the order they were added."""
+
+    def __init__(self):
+        self._names = []
+        self._resources = []
+
+    def append(self, resource):
+        index = bisect_right(self._names, resource.name)
+        self._names.insert(index, resource.name)
+        self._resources.insert(index, resource)
+
+    def __iter__(self):
+        return iter(self._resources)
+
+    def __len__(self):
+        return len(self._resources)
+
+
+class ResourceRegistry(object):
+    """Index of all resources of a project by their in-project name (GRN, e.g.
+    ``lambda:app:name``) and by their CloudFormation name. Resources can be
+    added to other indexes (e.g. S3 notifications by bucket) using ``index``."""
+
+    def __init__(self):
+        self._indexes = defaultdict(lambda: defaultdict(list))
+        self._resources = {}
+        self._cf_names = {}
+        self._names_by_cf_name = {}
+        self._sorted_names = []
+
+    def register(self, name, cf_name, resource):
+        """Register a resource called ``name`` as ``cf_name``. Both names must
+        be unique within the project."""
+        if name in self._resources or name in self._cf_names or cf_name in self._names_by_cf_name:
+            raise exceptions.DuplicateResourceNameError(name, cf_name)
+
+        self._resources[name] = resource
+        self._cf_names[name] = cf_name
+        self._names_by_cf_name[cf_name] = name
+        self._sorted_names.insert(bisect_left(self._sorted_names, name), name)
+
+    def __contains__(self, name):
+        return name in self._resources
+
+    def __len__(self):
+        return len(self._resources)
+
+    def names(self):
+        return list(self._sorted_names)
+
+    def get(self, name, default=None):
+        return self._resources.get(name, default)
+
+    def get_cf_name(self, name):
+        """Returns the CloudFormation name of the resource ``name``."""
+        if name in self._cf_names:
+            return self._cf_names[name]
+        raise exceptions.ResourceNotFoundError(name, self.similar(name))
+
+    def get_by_cf_name(self, cf_name, default=None):
+        """Returns the resource registered as ``cf_name``."""
+        name = self._names_by_cf_name.get(cf_name)
+        return self._resources[name] if name is not None else default
+
+    def find(self, prefix):
+        """Returns all the names which start with ``prefix`` (e.g.
+        ``lambda:app:``) in alphabetical order."""
+        start = bisect_left(self._sorted_names, prefix)
+        names = []
+        for name in self._sorted_names[start:]:
+            if not name.startswith(prefix):
+                break
+            names.append(name)
+        return names
+
+    def index(self, index, key, resource):
+        """Adds ``resource`` to the index ``index`` under ``key``."""
+        self._indexes[index][key].append(resource)
+
+    def lookup(self, index, key):
+        """Returns all resources added to the index ``index`` under ``key``."""
+        return list(self._indexes[index].get(key, []))
+
+    def similar(self, name):
+        """Returns the names of the resources of the same type as ``name``, or
+        all names if there are none."""
+        return self.find(name.split(':', 1)[0] + ':') or self.names()
@@ -175,7 +175,7 @@ class BaseResource(object):
 
     def _get_true_false(self, field, default='t', settings=None):
         """Returns if this stream is enable or not."""
-        return str((settings or self.settings).get(field, default)).lower()[0] == 't'
+        return utils.get_true_false(settings or self.settings, field, default)
 
     def validate(self):
         """Check if the current resource can co-exist with the rest of the
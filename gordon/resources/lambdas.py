@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import json
 import shutil
+import hashlib
 import tempfile
-import zipfile
 import subprocess
 import platform
 
@@ -15,10 +16,15 @@ from clint.textui import colored, indent
 from gordon import actions
 from gordon import utils
 from gordon import exceptions
+from gordon.cache import BUILD_CACHE_VERSION
 from gordon.contrib.lambdas.resources import LambdaVersion
 from . import base
 
 
+# Name of the files defining which files must be excluded from artifacts.
+IGNORE_FILENAME = '.gordonignore'
+
+
 class Lambda(base.BaseResource):
     """Base Lambda Resource which defines all shared resources between
     runtimes.
@@ -27,6 +33,12 @@ class Lambda(base.BaseResource):
     REQUIRED_SETTINGS = ('code', )
     code_filename = 'code'
     grn_type = 'lambda'
+    packaged = False
+    build_key = None
+    # Directories within the code of the lambda which don't affect its artifact.
+    build_key_exclude = ()
+    # Files never included in artifacts built by gordon.
+    default_ignore = ('.git/', '__pycache__/', '*.pyc')
     _default_runtime = None
     _runtimes = {}
 
@@ -345,6 +357,12 @@ class Lambda(base.BaseResource):
                 )
             ])
 
+    @classmethod
+    def register_type_pre_resources_template(cls, project, template):
+        # Uploads of different lambdas don't depend on each other, so they
+        # can be applied concurrently.
+        template.parallelizable = True
+
     def register_pre_resources_template(self, template):
         """Register one UploadToS3 action into the pre_resources template, as
         well as several Outputs so subsequente templates can reference these
@@ -353,10 +371,6 @@ class Lambda(base.BaseResource):
         upload to s3 on apply time.
         """
 
-        code_path = os.path.join(self.project.build_path, 'code')
-        if not os.path.exists(code_path):
-            os.makedirs(code_path)
-
         # We need to know to which bucket we are uploading these files.
         template.add_parameter(
             actions.Parameter(
@@ -364,9 +378,12 @@ class Lambda(base.BaseResource):
             )
         )
 
-        filename = os.path.join(code_path, self.get_bucket_key())
-        with open(filename, 'wb') as f:
-            f.write(self.get_zip_file().read())
+        # The project might have already packaged this lambda (concurrently
+        # with others) before collecting the pre_resources hooks.
+        filename = self.get_zip_filename()
+        if not self.packaged:
+            self.package()
+        self.project.register_artifact(filename, self.build_key)
 
         context, context_key = {}, self.get_context_key()
         try:
@@ -406,6 +423,135 @@ class Lambda(base.BaseResource):
             )
         )
 
+    def get_zip_filename(self):
+        """Returns the path of the .zip file of this lambda within the build
+        directory."""
+        return os.path.join(self.project.build_path, 'code', self.get_bucket_key())
+
+    def package(self):
+        """Builds the .zip file of this lambda into the build directory and
+        returns its path."""
+        with self.project.profiler.section('lambda {}'.format(self.name)) as node:
+            filename = self.get_zip_filename()
+            code_path = os.path.dirname(filename)
+            if not os.path.exists(code_path):
+                os.makedirs(code_path)
+
+            build_cache = self.project.build_cache
+            # Hashing the inputs of the lambda is only worth it if the build
+            # cache or an incremental build can avoid building it.
+            if self.build_key is None and (build_cache or self.project.incremental):
+                with self.project.profiler.section('build key'):
+                    self.build_key = self.get_build_key()
+            artifact = self.build_key and self.project.packaged_artifacts.get(self.build_key)
+
+            if self.project.incremental and self.project.is_build_file_fresh(filename, self.build_key):
+                if self.project.debug:
+                    with indent(4):
+                        self.project.puts(colored.white(u"✸ Artifact of {} is up to date".format(self.name)))
+                node['info']['artifact'] = 'fresh'
+            elif artifact:
+                # Other lambda with exactly the same inputs (e.g. another handler
+                # of the same Gradle project) has already been built.
+                shutil.copyfile(artifact, filename)
+                if self.project.debug:
+                    with indent(4):
+                        self.project.puts(colored.white(u"✸ Reusing artifact {} for {}".format(
+                            os.path.basename(artifact), self.name)))
+                node['info']['artifact'] = 'reused'
+            elif build_cache and build_cache.get(self.build_key, filename):
+                if self.project.debug:
+                    with indent(4):
+                        self.project.puts(colored.white(u"✸ Using cached artifact {} for {}".format(
+                            self.build_key[:8], self.name)))
+                node['info']['artifact'] = 'cached'
+            else:
+                self.write_zip_file(filename)
+                if build_cache:
+                    with self.project.profiler.section('cache'):
+                        build_cache.put(self.build_key, filename)
+                node['info']['artifact'] = 'built'
+
+            if self.build_key:
+                self.project.packaged_artifacts[self.build_key] = filename
+            node['info']['size'] = os.path.getsize(filename)
+
+        self.packaged = True
+        return filename
+
+    def get_build_key(self):
+        """Returns a hash of everything which affects the artifact of this
+        lambda: the code tree (including requirements.txt, package.json or
+        build.gradle), the runtime, the build command and the
+        ``*-install-extra`` settings."""
+        digest = hashlib.sha1()
+        commands = self._get_build_command('{target}')
+        if isinstance(commands, six.string_types) or hasattr(commands, '__call__'):
+            commands = [commands]
+
+        # Ignored files are only left out of the artifact if gordon stages
+        # the code. Custom build commands might use any file.
+        ignore = None
+        if any([command == self._stage_code for command in commands]):
+            ignore = self.get_ignore_patterns()
+
+        parts = [
+            BUILD_CACHE_VERSION,
+            self.__class__.__name__,
+            self.get_runtime(),
+            self.settings['code'],
+        ]
+        for command in commands:
+            if hasattr(command, '__call__'):
+                parts.append(command.__name__)
+            else:
+                parts.append(self._format_build_command(command, '{target}'))
+        # Callables don't expose which settings they depend on.
+        parts.extend([
+            self._pip_path(), self._pip_install_extra(),
+            self._npm_path(), self._npm_install_extra(),
+            self._gradle_path(), self._gradle_build_extra(),
+        ])
+
+        if ignore:
+            parts.extend(ignore.patterns)
+
+        for part in parts:
+            digest.update(six.text_type(part).encode('utf-8'))
+        return utils.get_tree_hash(
+            os.path.join(self.get_root(), self.settings['code']),
+            digest=digest,
+            exclude=self.build_key_exclude,
+            ignore=ignore
+        )
+
+    def get_ignore_patterns(self):
+        """Returns the patterns of files which must not be included in the
+        artifact of this lambda: gordon's defaults, followed by the patterns
+        defined in the ``.gordonignore`` files of the project, the app and the
+        code directory of this lambda. Patterns are relative to the code
+        directory."""
+        ignore = utils.IgnorePatterns(self.default_ignore)
+        roots = [self.project.path, self.app and self.app.path, os.path.join(self.get_root(), self.settings['code'])]
+        for i, root in enumerate(roots):
+            if root and root not in roots[:i]:
+                ignore.load(os.path.join(root, IGNORE_FILENAME))
+        return ignore
+
+    def _stage_code(self, destination):
+        """Copies the code of this lambda into ``destination``, leaving out
+        ignored files."""
+        excluded_files, excluded_bytes = utils.stage_tree(
+            os.path.join(self.get_root(), self.settings['code']),
+            destination,
+            ignore=self.get_ignore_patterns(),
+            mode=self.get_staging_mode()
+        )
+        if excluded_files:
+            with indent(4):
+                self.project.puts(colored.white(u"✸ Excluded {} files ({}) from {}".format(
+                    excluded_files, utils.format_size(excluded_bytes), self.name)))
+
     def collect_and_run(self, stdin):
         self.project.create_workspace()
         destination = tempfile.mkdtemp(dir=self.project.get_workspace())
@@ -464,39 +610,35 @@ class Lambda(base.BaseResource):
             else:
                 print(out.decode('utf-8'))
 
-    def get_zip_file(self):
-        """Returns a zip file file-like object with all the required source
-        on it."""
+    def write_zip_file(self, filename):
+        """Builds a zip file with all the required source of this lambda into
+        ``filename``. The zip is streamed to a temporary file next to
+        ``filename`` and renamed once it is complete, so ``filename`` never
+        contains a partially written artifact."""
 
         self.project.create_workspace()
         destination = tempfile.mkdtemp(dir=self.project.get_workspace())
 
         try:
-            self._collect_lambda_content(destination)
+            with self.project.profiler.section('collect'):
+                self._collect_lambda_content(destination)
         except subprocess.CalledProcessError as exc:
             shutil.rmtree(destination)
             raise exceptions.LambdaBuildProcessError(exc, self)
 
-        with tempfile.SpooledTemporaryFile(0, 'wb') as tmp:
-            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
-                for basedir, dirs, files in os.walk(destination):
-                    relative = os.path.relpath(basedir, destination)
-                    for filename in files:
-                        source = os.path.join(destination, basedir, filename)
-                        # resolve symlinks if present when packaging
-                        source = os.path.realpath(source)
-                        relative_destination = os.path.join(relative, filename)
-                        if six.PY2:
-                            source = source.decode('utf-8', errors='strict')
-                            relative_destination = relative_destination.decode('utf-8', errors='strict')
-                        zf.write(source, relative_destination)
-
-            tmp.seek(0)
-            output = six.BytesIO(tmp.read())
-
-        output.seek(0)
-        shutil.rmtree(destination)
-        return output
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        try:
+            with self.project.profiler.section('zip') as node:
+                with os.fdopen(fd, 'wb') as f:
+                    utils.zip_directory(destination, f)
+                node['info']['size'] = os.path.getsize(tmp)
+            with self.project.profiler.section('write'):
+                os.rename(tmp, filename)
+        except Exception:
+            os.remove(tmp)
+            raise
+        finally:
+            shutil.rmtree(destination)
 
     def _collect_lambda_file_content(self, destination):
         filename = '{}.{}'.format(self.code_filename, self.extension)
@@ -505,6 +647,20 @@ class Lambda(base.BaseResource):
     def _get_build_command(self, destination):
         return self.settings.get('build', self._get_default_build_command(destination))
 
+    def get_staging_mode(self):
+        """Returns how files are staged into the build directory of this
+        lambda. Build commands (e.g. ``npm install``) could modify hard linked
+        files in place, writing through to the source code, so lambdas which
+        run any are staged by copying their files instead."""
+        mode = self.project.staging_mode
+        if mode == 'hardlink':
+            commands = self._get_build_command('{target}')
+            if isinstance(commands, six.string_types) or hasattr(commands, '__call__'):
+                commands = [commands]
+            if any([isinstance(command, six.string_types) for command in commands]):
+                return 'copy'
+        return mode
+
     def _collect_lambda_content(self, destination, **kwargs):
         """Collects all required files to be included in the .zip file of the
         lambda. Returns a temporal directory path
@@ -524,32 +680,57 @@ class Lambda(base.BaseResource):
             elif isinstance(commands, six.string_types):
                 commands = [commands]
 
+            if self.project.staging_mode != self.get_staging_mode():
+                with indent(4):
+                    self.project.puts(colored.yellow(
+                        u"{} runs build commands, so its files are copied instead of hard linked.".format(self.name)
+                    ))
+
             for command in commands:
-                command = command.format(
-                    target=destination,
-                    pip_path=self._pip_path(),
-                    npm_path=self._npm_path(),
-                    gradle_path=self._gradle_path(),
-                    pip_install_extra=self._pip_install_extra(),
-                    npm_install_extra=self._npm_install_extra(),
-                    gradle_build_extra=self._gradle_build_extra(),
-                    project_path=self.project.path,
-                    project_name=self.project.name,
-                    lambda_name=self.name,
-                    go_target_os=go_target_os,
-                    go_target_arch=go_target_arch,
-                )
-                if self.project.debug:
-                    with indent(4):
-                        self.project.puts(colored.white(command))
-                out = subprocess.check_output(
+                if hasattr(command, '__call__'):
+                    with self.project.profiler.section(command.__name__):
+                        command(destination)
+                    continue
+                self._run_build_command(
                     command,
-                    shell=True,
-                    stderr=subprocess.STDOUT
+                    destination,
+                    go_target_os=go_target_os,
+                    go_target_arch=go_target_arch
                 )
-                if self.project.debug and out:
-                    with indent(4):
-                        self.project.puts(out.decode("utf-8"))
+
+    def _run_build_command(self, command, destination, **kwargs):
+        """Formats ``command`` using ``_format_build_command`` and runs it.
+        It is profiled under the unformatted ``command``, so sections of
+        different builds (and lambdas) using it can be compared."""
+        formatted = self._format_build_command(command, destination, **kwargs)
+        if self.project.debug:
+            with indent(4):
+                self.project.puts(colored.white(formatted))
+        with self.project.profiler.section(command):
+            out = subprocess.check_output(
+                formatted,
+                shell=True,
+                stderr=subprocess.STDOUT
+            )
+        if self.project.debug and out:
+            with indent(4):
+                self.project.puts(out.decode("utf-8"))
+
+    def _format_build_command(self, command, destination, go_target_arch='amd64', go_target_os='linux'):
+        return command.format(
+            target=destination,
+            pip_path=self._pip_path(),
+            npm_path=self._npm_path(),
+            gradle_path=self._gradle_path(),
+            pip_install_extra=self._pip_install_extra(),
+            npm_install_extra=self._npm_install_extra(),
+            gradle_build_extra=self._gradle_build_extra(),
+            project_path=self.project.path,
+            project_name=self.project.name,
+            lambda_name=self.name,
+            go_target_os=go_target_os,
+            go_target_arch=go_target_arch,
+        )
 
     def _collect_folder(self, source, destination):
         for basedir, dirs, files in os.walk(source):
@@ -583,6 +764,43 @@ class Lambda(base.BaseResource):
         )
         return ' '.join([e for e in extra if e])
 
+    def _use_dependency_cache(self):
+        """Returns if this lambda should install its dependencies through the
+        project dependency cache. The ``dependencies-cache`` setting can be
+        defined in the lambda, its app or the project."""
+        if not getattr(self.project, 'dependency_cache', None):
+            return False
+        for settings in (self.settings, self.app and self.app.settings or {}, self.project.settings):
+            if 'dependencies-cache' in settings:
+                return self._get_true_false('dependencies-cache', settings=settings)
+        return True
+
+    def _get_dependencies_key(self):
+        """Returns the key of the dependency set of this lambda within the
+        dependency cache, or ``None`` if its dependencies can't be cached."""
+        raise NotImplementedError
+
+    def _get_dependencies_digest(self, parts):
+        digest = hashlib.sha1()
+        for part in [BUILD_CACHE_VERSION, self.__class__.__name__, self.get_runtime()] + parts:
+            digest.update(six.text_type(part).encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _install_dependencies(self, target):
+        """Installs the dependencies of this lambda into ``target``."""
+        raise NotImplementedError
+
+    def _install_cached_dependencies(self, destination):
+        """Copies the dependency set of this lambda into ``destination``,
+        installing it into the dependency cache first if it is not present."""
+        key = self._get_dependencies_key()
+        path = self.project.dependency_cache.get(key, self._install_dependencies)
+        if self.project.debug:
+            with indent(4):
+                self.project.puts(colored.white(u"✸ Using dependency set {}".format(key[:8])))
+        utils.copy_tree(path, destination, mode=self.get_staging_mode())
+
     def _npm_path(self):
         return self.project.settings.get('npm-path', 'npm')
 
@@ -607,17 +825,52 @@ class PythonLambda(Lambda):
     }
     extension = 'py'
 
+    _install_requirements_commands = (
+        '{pip_path} install --install-option="--prefix=" -r requirements.txt -q -t {target} {pip_install_extra}',
+        'cd {target} && find . -name "*.pyc" -delete',
+    )
+
+    # Requirement lines which point to other files. Their content is not part
+    # of the requirements file, so it can't be used as dependency cache key.
+    _uncacheable_requirements = (
+        '-r', '--requirement', '-c', '--constraint', '-e', '--editable', '.', '/', 'file:'
+    )
+
     def _get_default_build_command(self, destination):
         code_root = os.path.join(self.get_root(), self.settings['code'])
         requirements_path = os.path.join(code_root, 'requirements.txt')
 
         commands = []
-        commands.append('cp -Rf * {target}')
+        commands.append(self._stage_code)
         if os.path.isfile(requirements_path):
-            commands.append('{pip_path} install --install-option="--prefix=" -r requirements.txt -q -t {target} {pip_install_extra}')
-            commands.append('cd {target} && find . -name "*.pyc" -delete')
+            if self._use_dependency_cache() and self._get_dependencies_key():
+                commands.append(self._install_cached_dependencies)
+            else:
+                commands.extend(self._install_requirements_commands)
         return commands
 
+    def _get_dependencies_key(self):
+        """Returns a hash of the normalized requirements of this lambda, its
+        runtime and how pip is invoked. Returns ``None`` if the requirements
+        can't be cached."""
+        requirements = []
+        with open(os.path.join(self.get_root(), self.settings['code'], 'requirements.txt'), 'r') as f:
+            for line in f:
+                line = line.split(' #', 1)[0].strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith(self._uncacheable_requirements):
+                    return None
+                requirements.append(' '.join(line.split()))
+
+        return self._get_dependencies_digest(
+            [self._pip_path(), self._pip_install_extra()] + sorted(requirements)
+        )
+
+    def _install_dependencies(self, target):
+        for command in self._install_requirements_commands:
+            self._run_build_command(command, target)
+
     def _get_default_run_command(self):
         return 'touch __init__.py && python _gloader.py {handler} {name} {memory} {timeout}'
 
@@ -638,16 +891,65 @@ class NodeLambda(Lambda):
     }
     extension = 'js'
 
+    _install_package_command = 'cd {target} && {npm_path} install {npm_install_extra}'
+
+    # Files npm install depends on, besides the configuration of the user.
+    _package_files = ('package.json', 'package-lock.json', 'npm-shrinkwrap.json', '.npmrc')
+
+    # Dependencies pointing to local paths can't be installed out of the
+    # lambda directory, and neither can packages with install scripts.
+    _uncacheable_versions = ('file:', 'link:', '.', '/', '~/')
+    _uncacheable_scripts = ('preinstall', 'install', 'postinstall')
+
     def _get_default_build_command(self, destination):
         code_root = os.path.join(self.get_root(), self.settings['code'])
         package_json_path = os.path.join(code_root, 'package.json')
 
         commands = []
-        commands.append('cp -Rf * {target}')
+        commands.append(self._stage_code)
         if os.path.isfile(package_json_path):
-            commands.append('cd {target} && {npm_path} install {npm_install_extra}')
+            if self._use_dependency_cache() and self._get_dependencies_key():
+                commands.append(self._install_cached_dependencies)
+            else:
+                commands.append(self._install_package_command)
         return commands
 
+    def _get_dependencies_key(self):
+        """Returns a hash of ``package.json``, ``package-lock.json`` (if
+        present), the runtime and how npm is invoked. Returns ``None`` if the
+        dependencies can't be cached."""
+        code_root = os.path.join(self.get_root(), self.settings['code'])
+        with open(os.path.join(code_root, 'package.json'), 'r') as f:
+            try:
+                package = json.load(f)
+            except ValueError:
+                return None
+
+        if not isinstance(package, dict):
+            return None
+        if any([script in (package.get('scripts') or {}) for script in self._uncacheable_scripts]):
+            return None
+        for field in ('dependencies', 'devDependencies', 'optionalDependencies'):
+            for version in (package.get(field) or {}).values():
+                if six.text_type(version).startswith(self._uncacheable_versions):
+                    return None
+
+        parts = [self._npm_path(), self._npm_install_extra(), json.dumps(package, sort_keys=True)]
+        for filename in self._package_files[1:]:
+            path = os.path.join(code_root, filename)
+            parts.append(utils.get_tree_hash(path) if os.path.isfile(path) else '')
+        return self._get_dependencies_digest(parts)
+
+    def _install_dependencies(self, target):
+        code_root = os.path.join(self.get_root(), self.settings['code'])
+        for filename in self._package_files:
+            if os.path.isfile(os.path.join(code_root, filename)):
+                shutil.copyfile(os.path.join(code_root, filename), os.path.join(target, filename))
+        self._run_build_command(self._install_package_command, target)
+        # Like staging, never include .npmrc (which might contain credentials) in the lambda.
+        if os.path.isfile(os.path.join(target, '.npmrc')):
+            os.remove(os.path.join(target, '.npmrc'))
+
     def _get_default_run_command(self):
         return 'node _gloader.js {handler} {name} {memory} {timeout}'
 
@@ -663,6 +965,7 @@ class JavaLambda(Lambda):
         'java8': 'java8',
     }
     extension = 'java'
+    build_key_exclude = ('build', '.gradle')
 
     def _get_loader_requirements(self):
             return [['java/build/libs/java.jar', '_gloader.jar']]
@@ -1,5 +1,6 @@
 import re
-from collections import defaultdict, Counter
+import json
+from collections import defaultdict
 
 import six
 import troposphere
@@ -8,13 +9,38 @@ from troposphere import sqs, sns, awslambda
 from . import base
 from gordon import exceptions
 from gordon import utils
-from gordon.actions import Ref
 from gordon.contrib.s3.resources import (
     S3BucketNotificationConfiguration,
     NotificationConfiguration, KeyFilter
 )
 
 
+def get_overlapping_filters(filters, suffix=False):
+    """Returns all pairs of ``(value, notification_id)`` ``filters`` which
+    overlap, this is, where one value is a prefix (or a suffix if ``suffix``)
+    of the other one. Values are stored in a trie, so this only takes time
+    proportional to the length of all values plus the number of pairs."""
+    trie = {}
+    for value, notification_id in filters:
+        node = trie
+        for char in (value[::-1] if suffix else value):
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append((value, notification_id))
+
+    overlapping = []
+    stack = [(trie, [])]
+    while stack:
+        node, ancestors = stack.pop()
+        here = node.get(None, [])
+        for i, current in enumerate(here):
+            for other in ancestors + here[:i]:
+                overlapping.append((other, current))
+        for char, child in six.iteritems(node):
+            if char is not None:
+                stack.append((child, ancestors + here if here else ancestors))
+    return sorted(overlapping)
+
+
 class BaseNotification(object):
 
     def __init__(self, bucket_notification_configuration, **kwargs):
@@ -52,7 +78,7 @@ class BaseNotification(object):
         # Validate that filters are a subset of (prefix, suffix) and keys
         # are not duplicated.
         _filters = self.settings.get('key_filters', {})
-        if set(_filters.values()) > set(('prefix', 'suffix')):
+        if set(_filters) - set(('prefix', 'suffix')):
             raise exceptions.ResourceValidationError(
                 """You can't create filters for '{}'.""".format(
                     ', '.join(_filters)
@@ -264,6 +290,7 @@ class BucketNotificationConfiguration(base.BaseResource):
             )
 
         self._validate_notifications()
+        self.project.registry.index('s3-bucket', self.get_bucket_key(), self)
 
     def get_bucket_arn(self):
         bucket_name = self.get_bucket_name()
@@ -275,27 +302,33 @@ class BucketNotificationConfiguration(base.BaseResource):
             return bucket
         return bucket
 
+    def get_bucket_key(self):
+        """Returns a string which identifies the bucket of this resource,
+        either by its name or by the reference to it."""
+        bucket = self.get_bucket_name()
+        if hasattr(bucket, 'to_dict'):
+            return json.dumps(bucket.to_dict(), sort_keys=True)
+        return bucket
+
     def _validate_notifications(self):
         # Validate that all key prefix/suffix filters for a bucket
         # don't overlap one to each other.
         all_filters = defaultdict(list)
-        for notification_id, notification in six.iteritems(self._notifications):
+        for notification_id, notification in sorted(six.iteritems(self._notifications)):
             for name, value in notification.filters:
-                all_filters[name].append(value)
-
-        overlap_checks = {'prefix': 'startswith', 'suffix': 'endswith'}
-        for filter_type, values in six.iteritems(all_filters):
-            check = overlap_checks.get(filter_type)
-            # Don't check fields that are Ref instances
-            # since Refs aren't bound until apply
-            if isinstance(check, Ref):
-                continue
-            overlaps = [sum([int(getattr(v, check)(z)) for z in values]) for v in values]
-            if sum(overlaps) > len(values):
+                # Don't check values that are references since they aren't
+                # bound until apply
+                if isinstance(value, six.string_types):
+                    all_filters[name].append((value, notification_id))
+
+        for filter_type in ('prefix', 'suffix'):
+            overlapping = get_overlapping_filters(all_filters[filter_type], suffix=filter_type == 'suffix')
+            if overlapping:
                 raise exceptions.ResourceValidationError(
                     "One or more {} filters overlap one to each other {}.".format(
                         filter_type,
-                        ', '.join(values)
+                        ', '.join(["'{}' ({}) and '{}' ({})".format(a, a_id, b, b_id)
+                                   for (a, a_id), (b, b_id) in overlapping])
                     )
                 )
 
@@ -328,11 +361,12 @@ class BucketNotificationConfiguration(base.BaseResource):
     def validate(self):
         """Validate that there are no any other resources in the project which
         try to register notifications for the same bucket than this resource"""
-        for resource in \
-                (r for r in self.project.get_resources() if isinstance(r, self.__class__) and r.bucket == self.bucket):
+        for resource in self.project.registry.lookup('s3-bucket', self.get_bucket_key()):
+            if resource is self:
+                continue
             raise exceptions.ResourceValidationError(
                 ("Both resources '{}' and '{}', registers notifications for "
                  "the bucket '{}'. Because AWS API limitations we need you to "
                  "register all notifications of one bucket in the same "
-                 "resource.").format(self, resource, self.bucket)
+                 "resource.").format(self.in_project_name, resource.in_project_name, self.get_bucket_key())
             )
@@ -0,0 +1,360 @@
+import re
+import copy
+
+import six
+
+from . import exceptions
+from . import utils
+
+# Ways of grouping resources into resources stacks.
+MODES = ('single', 'app')
+
+# CloudFormation limits of each stack. One output is left for the hash of the
+# template gordon adds while applying it.
+MAX_RESOURCES = 500
+MAX_OUTPUTS = 199
+MAX_PARAMETERS = 200
+
+
+def _get_attribute_output(name, attribute):
+    """Returns the name of the output used to share attribute ``attribute`` of
+    resource ``name`` with other stacks."""
+    return name + re.sub(r'[^a-zA-Z0-9]', '', attribute)
+
+
+def _walk(value, visit):
+    """Calls ``visit`` with every dict within ``value`` (outermost first), and
+    replaces them with what it returns."""
+    if isinstance(value, dict):
+        value = visit(value)
+        if isinstance(value, dict):
+            return dict([(k, _walk(v, visit)) for k, v in six.iteritems(value)])
+        return value
+    elif isinstance(value, list):
+        return [_walk(v, visit) for v in value]
+    return value
+
+
+def get_references(value):
+    """Returns a set of ``(name, attribute)`` for every ``Ref`` (``attribute``
+    is ``None``), ``Fn::GetAtt`` and ``Fn::Sub`` reference within the
+    template fragment ``value``."""
+    references = set()
+
+    def _visit(node):
+        if 'Ref' in node and isinstance(node['Ref'], six.string_types):
+            references.add((node['Ref'], None))
+        elif 'Fn::GetAtt' in node:
+            name, attribute = _split_get_attr(node['Fn::GetAtt'])
+            if name:
+                references.add((name, attribute))
+        elif 'Fn::Sub' in node:
+            string, variables = _split_sub(node['Fn::Sub'])
+            for name in utils.SUB_VARIABLE.findall(string):
+                name, _, attribute = name.partition('.')
+                if name not in variables:
+                    references.add((name, attribute or None))
+        return node
+
+    _walk(value, _visit)
+    return references
+
+
+def _split_get_attr(data):
+    if isinstance(data, six.string_types):
+        data = data.split('.', 1)
+    if isinstance(data, list) and len(data) == 2 and isinstance(data[0], six.string_types):
+        return data[0], data[1]
+    return None, None
+
+
+def _split_sub(data):
+    if isinstance(data, list):
+        return data[0], data[1]
+    return data, {}
+
+
+def _rewrite(value, foreign):
+    """Replaces every ``Fn::GetAtt`` of a resource for which ``foreign`` is
+    true within ``value`` with a ``Ref`` to the parameter which will hold its
+    value."""
+
+    def _replace_sub_variable(variables):
+        def _replace(match):
+            name, _, attribute = match.group(1).partition('.')
+            if attribute and name not in variables and foreign(name):
+                return '${{{}}}'.format(_get_attribute_output(name, attribute))
+            return match.group(0)
+        return _replace
+
+    def _visit(node):
+        if 'Fn::GetAtt' in node:
+            name, attribute = _split_get_attr(node['Fn::GetAtt'])
+            if name and foreign(name):
+                return {'Ref': _get_attribute_output(name, attribute)}
+        elif 'Fn::Sub' in node:
+            string, variables = _split_sub(node['Fn::Sub'])
+            string = utils.SUB_VARIABLE.sub(_replace_sub_variable(variables), string)
+            if isinstance(node['Fn::Sub'], list):
+                return {'Fn::Sub': [string, node['Fn::Sub'][1]]}
+            return {'Fn::Sub': string}
+        return node
+
+    return _walk(copy.deepcopy(value), _visit)
+
+
+def _get_dependencies(resources):
+    """Returns a map of each resource to the set of resources it depends on,
+    either through references or ``DependsOn``."""
+    dependencies = {}
+    for name, resource in six.iteritems(resources):
+        depends_on = resource.get('DependsOn', [])
+        if isinstance(depends_on, six.string_types):
+            depends_on = [depends_on]
+        names = set([n for n, _ in get_references(resource)]) | set(depends_on)
+        dependencies[name] = set([n for n in names if n in resources and n != name])
+    return dependencies
+
+
+def _sort(nodes, dependencies, error):
+    """Returns ``nodes`` sorted so every node comes after the ones it depends
+    on. Nodes without pending dependencies are sorted alphabetically. If
+    there is a cycle, ``error`` is raised with the names of the nodes in
+    it."""
+    pending = dict([(n, set([d for d in dependencies[n] if d in nodes and d != n])) for n in nodes])
+    ordered = []
+    while pending:
+        ready = sorted([n for n, d in six.iteritems(pending) if not d])
+        if not ready:
+            raise error(', '.join(sorted(pending)))
+        node = ready[0]
+        ordered.append(node)
+        del pending[node]
+        for d in six.itervalues(pending):
+            d.discard(node)
+    return ordered
+
+
+def _chunk(ordered, references, referenced_by, outputs_of, parameters, size, max_outputs, max_parameters,
+           first_outputs=0):
+    """Splits the list of resources ``ordered`` in chunks of up to ``size``
+    resources, starting a new chunk before any of them would need more than
+    ``max_outputs`` outputs or ``max_parameters`` parameters.
+
+    ``references`` and ``referenced_by`` map every resource to the set of
+    ``(name, attribute)`` it references (including the ones of the outputs it
+    owns), and to the set of ``(referencer, attribute)`` referencing it.
+    ``outputs_of`` maps resources to the number of outputs they own, and
+    ``parameters`` to the template parameters they (or the outputs they own)
+    use. Every chunk includes the parameters in ``parameters[None]``, and the
+    first one ``first_outputs`` outputs without references."""
+    chunks = []
+
+    def _new_chunk(first):
+        chunks.append([])
+        state = {
+            'members': set(),
+            'imports': {},
+            'exports': {},
+            'outputs': first_outputs if first else 0,
+            'parameters': set(parameters.get(None, ())),
+        }
+        return state
+
+    state = _new_chunk(True)
+    for name in ordered:
+        members, imports, exports = state['members'], state['imports'], state['exports']
+
+        # References of ``name`` to resources out of the chunk become
+        # parameters, and the ones to ``name`` stop being imports.
+        new_imports = set([r for r in references[name] if r[0] not in members and r[0] != name])
+        new_imports = [r for r in new_imports if r not in imports]
+        gone_imports = [r for r in imports if r[0] == name]
+        # Resources out of the chunk referencing ``name`` need outputs, and
+        # the ones from ``name`` to other members don't any more.
+        new_exports = set([(name, a) for r, a in referenced_by[name] if r not in members and r != name])
+        gone_exports = [r for r in references[name] if r[0] in members and exports.get(r) == 1]
+        new_parameters = set(parameters.get(name, ())) - state['parameters']
+
+        count_parameters = len(imports) + len(new_imports) - len(gone_imports) + \
+            len(state['parameters']) + len(new_parameters)
+        count_outputs = len(exports) + len(new_exports) - len(gone_exports) + state['outputs'] + outputs_of.get(name, 0)
+        if members and (len(members) >= size or count_parameters > max_parameters or count_outputs > max_outputs):
+            state = _new_chunk(False)
+            members, imports, exports = state['members'], state['imports'], state['exports']
+
+        for reference in references[name]:
+            if reference[0] in members:
+                exports[reference] -= 1
+                if not exports[reference]:
+                    del exports[reference]
+            elif reference[0] != name:
+                imports[reference] = imports.get(reference, 0) + 1
+        for reference in [r for r in imports if r[0] == name]:
+            del imports[reference]
+        for referencer, attribute in referenced_by[name]:
+            if referencer not in members and referencer != name:
+                exports[(name, attribute)] = exports.get((name, attribute), 0) + 1
+        state['parameters'].update(parameters.get(name, ()))
+        state['outputs'] += outputs_of.get(name, 0)
+        members.add(name)
+        chunks[-1].append(name)
+    return [chunk for chunk in chunks if chunk]
+
+
+def _get_chunking_references(template, groups):
+    """Returns the ``references``, ``referenced_by``, ``outputs_of`` and
+    ``parameters`` ``_chunk`` needs to split ``template``. Outputs are owned
+    by the first resource they reference (as in ``split_template``), or by
+    their group if they don't reference any."""
+    resources = template.get('Resources', {})
+    template_parameters = template.get('Parameters', {})
+    references, referenced_by, outputs_of, parameters = {}, dict([(n, set()) for n in resources]), {}, {}
+    parameters[None] = set([n for n, _ in get_references(template.get('Conditions', {})) if n in template_parameters])
+    parameters[None].update([n for n in ('Stage', 'Region') if n in template_parameters])
+
+    for name, resource in six.iteritems(resources):
+        references[name] = get_references(resource)
+    for name, output in six.iteritems(template.get('Outputs', {})):
+        owners = sorted([n for n, _ in get_references(output) if n in resources])
+        owner = owners[0] if owners else groups.get(name, '')
+        references.setdefault(owner, set()).update(get_references(output))
+        outputs_of[owner] = outputs_of.get(owner, 0) + 1
+
+    for name, names in list(six.iteritems(references)):
+        # Parameters used by outputs without references end up in every chunk.
+        owner = name if name in resources else None
+        parameters.setdefault(owner, set()).update([n for n, a in names if not a and n in template_parameters])
+        if owner:
+            references[name] = set([(n, a) for n, a in names if n in resources])
+            for referenced, attribute in references[name]:
+                referenced_by[referenced].add((name, attribute))
+    return references, referenced_by, outputs_of, parameters
+
+
+def _check_limits(shard, fragment, max_outputs, max_parameters):
+    for key, limit in (('Resources', MAX_RESOURCES), ('Outputs', max_outputs), ('Parameters', max_parameters)):
+        if len(fragment.get(key, {})) > limit:
+            raise exceptions.ResourcesStackLimitError(shard or 'resources', len(fragment[key]), key.lower(), limit)
+
+
+def split_template(template, groups, max_resources=None, max_outputs=MAX_OUTPUTS, max_parameters=MAX_PARAMETERS):
+    """Splits the CloudFormation ``template`` (as a dictionary) into several
+    sibling templates, and returns a list of ``(name, template)`` sorted so
+    that every template only depends on previous ones.
+
+    ``groups`` maps the name of resources and outputs to the name of the
+    group they belong to (resources of the same group end up in the same
+    template). Resources not in ``groups`` belong to the group ``''``. If
+    ``max_resources`` is defined, groups with more resources are split into
+    several templates, which are also kept under ``max_outputs`` outputs and
+    ``max_parameters`` parameters. If any template still exceeds the limits of
+    CloudFormation, ``ResourcesStackLimitError`` is raised.
+
+    References to resources of other templates are replaced by parameters,
+    and those templates export the referenced values as outputs (``Name`` for
+    ``Ref``, and ``NameAttribute`` for ``Fn::GetAtt``). As templates are
+    applied sequentially, ``DependsOn`` between templates are removed."""
+    resources = template.get('Resources', {})
+    outputs = template.get('Outputs', {})
+    dependencies = _get_dependencies(resources)
+
+    # Split groups into shards of up to ``max_resources`` resources, sorting
+    # resources so that no shard depends on following shards of the same group.
+    members = {}
+    for name in resources:
+        members.setdefault(groups.get(name, ''), []).append(name)
+
+    if max_resources:
+        references, referenced_by, outputs_of, parameters = _get_chunking_references(template, groups)
+
+    shards, shard_of, first_shard = [], {}, {}
+    for group, names in sorted(six.iteritems(members)):
+        ordered = _sort(set(names), dependencies, exceptions.ResourcesStacksCycleError)
+        if max_resources:
+            chunks = _chunk(ordered, references, referenced_by, outputs_of, parameters,
+                            int(max_resources), max_outputs, max_parameters, outputs_of.get(group, 0))
+        else:
+            chunks = [ordered]
+        for i, chunk in enumerate(chunks):
+            shard = '-'.join([p for p in (group, str(i + 1) if len(chunks) > 1 else '') if p])
+            shards.append(shard)
+            first_shard.setdefault(group, shard)
+            for name in chunk:
+                shard_of[name] = shard
+
+    output_shard = {}
+    for name, output in six.iteritems(outputs):
+        referenced = sorted([n for n, _ in get_references(output) if n in shard_of])
+        if referenced:
+            output_shard[name] = shard_of[referenced[0]]
+        else:
+            output_shard[name] = first_shard.get(groups.get(name, ''), shards[0] if shards else '')
+
+    shard_dependencies = dict([(s, set()) for s in shards])
+    for name, names in six.iteritems(dependencies):
+        shard_dependencies[shard_of[name]].update([shard_of[n] for n in names])
+    for name, output in six.iteritems(outputs):
+        shard_dependencies[output_shard[name]].update(
+            [shard_of[n] for n, _ in get_references(output) if n in shard_of]
+        )
+    shards = _sort(set(shards), shard_dependencies, exceptions.ResourcesStacksCycleError)
+
+    templates = dict([(s, {'Resources': {}, 'Outputs': {}, 'Parameters': {}}) for s in shards])
+    imports = dict([(s, set()) for s in shards])
+    for shard in shards:
+        fragment = templates[shard]
+        for key in ('AWSTemplateFormatVersion', 'Description', 'Mappings', 'Conditions', 'Metadata'):
+            if key in template:
+                fragment[key] = copy.deepcopy(template[key])
+
+        def foreign(name, shard=shard):
+            return name in shard_of and shard_of[name] != shard
+
+        values = []
+        for name in [n for n in resources if shard_of[n] == shard]:
+            values.append(resources[name])
+            resource = _rewrite(resources[name], foreign)
+            depends_on = resource.pop('DependsOn', [])
+            depends_on = [n for n in ([depends_on] if isinstance(depends_on, six.string_types) else depends_on)
+                          if not foreign(n)]
+            if depends_on:
+                resource['DependsOn'] = depends_on
+            fragment['Resources'][name] = resource
+
+        for name in [n for n in outputs if output_shard[n] == shard]:
+            values.append(outputs[name])
+            fragment['Outputs'][name] = _rewrite(outputs[name], foreign)
+
+        imports[shard] = set([r for r in get_references(values) if foreign(r[0])])
+
+    # Export the values other templates reference as outputs, and add the
+    # parameters each template needs.
+    for shard in shards:
+        fragment = templates[shard]
+        parameters = set()
+        for name, attribute in imports[shard]:
+            owner = templates[shard_of[name]]['Outputs']
+            if attribute:
+                parameter = _get_attribute_output(name, attribute)
+                owner[parameter] = {'Value': {'Fn::GetAtt': [name, attribute]}}
+            else:
+                parameter = name
+                owner[parameter] = {'Value': {'Ref': name}}
+            parameters.add(parameter)
+
+        for name, attribute in get_references([fragment.get('Conditions', {}), fragment['Resources'],
+                                               fragment['Outputs']]):
+            if not attribute and name in template.get('Parameters', {}):
+                parameters.add(name)
+        parameters.update([n for n in ('Stage', 'Region') if n in template.get('Parameters', {})])
+
+        for name in parameters:
+            fragment['Parameters'][name] = copy.deepcopy(template.get('Parameters', {}).get(name, {'Type': 'String'}))
+
+    for shard, fragment in six.iteritems(templates):
+        if not fragment['Outputs']:
+            del fragment['Outputs']
+        _check_limits(shard, fragment, max_outputs, max_parameters)
+
+    return [(shard, templates[shard]) for shard in shards]
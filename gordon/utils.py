@@ -2,17 +2,18 @@
 import os
 import re
 import sys
+import stat
 import time
 import copy
 import json
+import shutil
 import hashlib
 import zipfile
+import threading
 from datetime import datetime
-from collections import Iterable
+from collections import Iterable, OrderedDict
 
 import six
-import boto3
-from botocore.exceptions import ClientError
 import yaml
 import jinja2
 import troposphere
@@ -45,8 +46,39 @@ CF_DELETE_STACK_REQUIRED_STATUS = (
 
 CF_FINAL_STATUS = CF_FINAL_SUCCEED_STATUS + CF_FINAL_ERRORED_STATUS
 
+# Output where gordon stores the hash of the template and parameters of
+# stacks. Unlike stack tags, outputs don't propagate to every resource.
+CF_TEMPLATE_HASH_OUTPUT = 'GordonTemplateHash'
 
-MILL_CHARS = ['|', '/', '-', '\\']
+# Value of parameters and outputs which won't be known until the project is
+# applied (e.g. outputs of stacks which don't exist yet) while planning.
+PLAN_PENDING_VALUE = '(known after apply)'
+
+# Reasons CloudFormation gives when a change set fails because it is empty.
+CF_EMPTY_CHANGE_SET_REASONS = (
+    "didn't contain changes",
+    'No updates are to be performed',
+)
+
+# Settings of ``s3-transfer``, with the ``TransferConfig`` argument and the
+# unit (in bytes) of each of them.
+S3_TRANSFER_SETTINGS = {
+    'multipart-threshold': ('multipart_threshold', 1024 * 1024),
+    'multipart-chunksize': ('multipart_chunksize', 1024 * 1024),
+    'max-concurrency': ('max_concurrency', 1),
+    'max-bandwidth': ('max_bandwidth', 1024 * 1024),
+}
+
+# Ways of placing files in the staging directory of lambdas.
+STAGING_MODES = ('copy', 'hardlink', 'reflink')
+
+# ioctl which makes a file share the data of other one on copy-on-write file
+# systems (btrfs, xfs...). Defined in linux/fs.h.
+FICLONE = 0x40049409
+
+# Timestamp of every entry in the zip files gordon builds. 1980-01-01 is the
+# earliest date the zip format can represent.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
 
 def get_cf_color(status):
@@ -57,31 +89,344 @@ def get_cf_color(status):
     return colored.green
 
 
-def mill(iterable):
-    for i, elem in enumerate(iterable):
-        yield MILL_CHARS[i % len(MILL_CHARS)], elem
-
-
-def get_zip_hash(obj):
-    """Return a consistent hash of the content of a zip file ``obj``."""
-    digest = hashlib.sha1()
-    zfile = zipfile.ZipFile(obj, 'r')
-    for path in sorted(zfile.namelist()):
-        digest.update(six.text_type(path).encode('utf-8'))
-        digest.update(zfile.read(path))
-    return digest.hexdigest()
-
-
 def get_file_hash(filename):
+    """Returns a hash of ``filename``. Zip files gordon builds are
+    reproducible, so their hash is just a digest of their bytes."""
+    digest = hashlib.sha1()
     if filename.endswith('.zip'):
-        return get_zip_hash(filename)
+        _update_file_digest(digest, filename)
+        return digest.hexdigest()
 
     with open(filename, 'r') as f:
-        digest = hashlib.sha1()
         digest.update(six.text_type(filename).encode('utf-8'))
         digest.update(six.text_type(f.read()).encode('utf-8'))
         return digest.hexdigest()
 
+
+def zip_directory(path, fileobj):
+    """Writes a zip file with the content of ``path`` into ``fileobj``. The
+    output is byte-for-byte reproducible: entries are sorted and have a fixed
+    timestamp and permissions, so identical directories produce identical
+    zip files."""
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zfile:
+        for basedir, dirs, files in os.walk(path, followlinks=True):
+            dirs.sort()
+            relative = os.path.relpath(basedir, path)
+            for filename in sorted(files):
+                # resolve symlinks if present when packaging
+                source = os.path.realpath(os.path.join(basedir, filename))
+                if not os.path.exists(source):
+                    continue
+                arcname = os.path.normpath(os.path.join(relative, filename))
+                if six.PY2:
+                    source = source.decode('utf-8', errors='strict')
+                    arcname = arcname.decode('utf-8', errors='strict')
+                write_zip_entry(zfile, source, arcname)
+
+
+def write_zip_entry(zfile, source, arcname):
+    """Adds ``source`` to ``zfile`` as ``arcname`` with a fixed timestamp and
+    either ``0644`` or ``0755`` permissions."""
+    source_stat = os.stat(source)
+    info = _get_zip_info(arcname, 0o755 if source_stat.st_mode & 0o111 else 0o644)
+    info.file_size = source_stat.st_size
+    with open(source, 'rb') as f:
+        if sys.version_info >= (3, 6):
+            # Stream the file into the archive, so memory usage doesn't
+            # depend on the size of the file.
+            with zfile.open(info, 'w') as entry:
+                shutil.copyfileobj(f, entry, 1024 * 1024)
+        else:
+            zfile.writestr(info, f.read())
+
+
+def write_zip_data(zfile, arcname, data, mode=0o644):
+    """Adds ``data`` to ``zfile`` as ``arcname`` with a fixed timestamp."""
+    zfile.writestr(_get_zip_info(arcname, mode), data)
+
+
+def _get_zip_info(arcname, mode):
+    info = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+    info.create_system = 3
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = (stat.S_IFREG | mode) << 16
+    return info
+
+
+def get_tree_hash(path, digest=None, exclude=(), ignore=None):
+    """Returns a hash of the content of ``path``. If ``path`` is a directory
+    the hash includes the relative path, permissions and content of every file
+    within it, traversed in a stable order. Top level directories included in
+    ``exclude`` and files matched by the ``IgnorePatterns`` ``ignore`` are
+    ignored."""
+    digest = digest or hashlib.sha1()
+    if os.path.isfile(path):
+        _update_file_digest(digest, path)
+        return digest.hexdigest()
+
+    for basedir, dirs, files in os.walk(path, followlinks=True):
+        if basedir == path:
+            dirs[:] = [d for d in dirs if d not in exclude]
+        relative = os.path.relpath(basedir, path)
+        if ignore:
+            dirs[:] = [d for d in dirs if not ignore.match(_join_relative(relative, d), is_dir=True)]
+            files = [f for f in files if not ignore.match(_join_relative(relative, f))]
+        dirs.sort()
+        for filename in sorted(files):
+            source = os.path.join(basedir, filename)
+            digest.update(six.text_type(_join_relative(relative, filename)).encode('utf-8'))
+            digest.update(six.text_type(os.stat(source).st_mode & 0o111).encode('utf-8'))
+            _update_file_digest(digest, source)
+    return digest.hexdigest()
+
+
+def _join_relative(relative, name):
+    return name if relative == '.' else '/'.join(relative.split(os.sep) + [name])
+
+
+class IgnorePatterns(object):
+    """Matches paths against gitignore-style patterns:
+
+    - Blank lines and lines starting with ``#`` are ignored.
+    - ``!`` negates a pattern, re-including paths excluded by previous ones.
+    - Patterns ending with ``/`` only match directories.
+    - Patterns containing ``/`` are anchored to the root. Other patterns
+      match at any level.
+    - ``*`` and ``?`` don't match ``/``. ``**`` matches across directories.
+
+    The last pattern matching a path decides if it is ignored or not."""
+
+    def __init__(self, patterns=()):
+        self.patterns = []
+        self._rules = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    __nonzero__ = __bool__
+
+    def add(self, pattern):
+        pattern = pattern.rstrip('\r\n')
+        if not pattern.endswith('\\ '):
+            pattern = pattern.rstrip()
+        if not pattern or pattern.startswith('#'):
+            return
+
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        if pattern[:2] in ('\\#', '\\!'):
+            pattern = pattern[1:]
+
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            return
+
+        regex = self._translate(pattern.lstrip('/'))
+        if '/' not in pattern:
+            regex = '(?:.*/)?' + regex
+        self.patterns.append(('!' if negate else '') + pattern + ('/' if dir_only else ''))
+        self._rules.append((re.compile('^{}$'.format(regex)), negate, dir_only))
+
+    def load(self, filename):
+        """Adds all patterns defined in ``filename``, if it exists."""
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    self.add(line)
+
+    def match(self, path, is_dir=False):
+        """Returns if ``path`` (relative to the root, using ``/`` as
+        separator) is ignored."""
+        ignored = False
+        for regex, negate, dir_only in self._rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                ignored = not negate
+        return ignored
+
+    def _translate(self, pattern):
+        regex, i = '', 0
+        while i < len(pattern):
+            char = pattern[i]
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+                continue
+            elif pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+                continue
+            elif char == '*':
+                regex += '[^/]*'
+            elif char == '?':
+                regex += '[^/]'
+            elif char == '[' and self._find_class_end(pattern, i) > 0:
+                end = self._find_class_end(pattern, i)
+                group = pattern[i + 1:end]
+                if group.startswith('!'):
+                    group = '^' + group[1:]
+                regex += '[{}]'.format(group.replace('\\', '\\\\'))
+                i = end
+            elif char == '\\' and i + 1 < len(pattern):
+                i += 1
+                regex += re.escape(pattern[i])
+            else:
+                regex += re.escape(char)
+            i += 1
+        return regex
+
+    def _find_class_end(self, pattern, start):
+        """Returns the position of the ``]`` closing the character class
+        which starts at ``start``, or ``-1`` if there isn't one."""
+        i = start + 1
+        if pattern[i:i + 1] == '!':
+            i += 1
+        if pattern[i:i + 1] == ']':
+            i += 1
+        return pattern.find(']', i)
+
+
+def stage_tree(source, destination, ignore=None, mode='copy'):
+    """Copies the content of ``source`` into ``destination`` skipping files
+    matched by the ``IgnorePatterns`` ``ignore``. Like the ``*`` shell glob,
+    hidden files and directories in the root of ``source`` are not copied.
+    Files are staged using ``stage_file`` and ``mode``, and symlinks using
+    ``stage_link``.
+    Returns the number of files and bytes which were excluded."""
+    excluded_files, excluded_bytes = 0, 0
+    for basedir, dirs, files in os.walk(source, followlinks=True):
+        relative = os.path.relpath(basedir, source)
+        target = os.path.join(destination, relative)
+        if relative == '.':
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            files = [f for f in files if not f.startswith('.')]
+        elif not os.path.isdir(target):
+            os.makedirs(target)
+
+        for name in list(dirs):
+            if ignore and ignore.match(_join_relative(relative, name), is_dir=True):
+                dirs.remove(name)
+                for _, _, ignored_files in os.walk(os.path.join(basedir, name), followlinks=True):
+                    excluded_files += len(ignored_files)
+                excluded_bytes += get_tree_size(os.path.join(basedir, name))
+            elif stage_link(os.path.join(basedir, name), os.path.join(target, name), source):
+                dirs.remove(name)
+
+        for name in files:
+            if ignore and ignore.match(_join_relative(relative, name)):
+                excluded_files += 1
+                if os.path.exists(os.path.join(basedir, name)):
+                    excluded_bytes += os.path.getsize(os.path.join(basedir, name))
+            elif not stage_link(os.path.join(basedir, name), os.path.join(target, name), source):
+                stage_file(os.path.join(basedir, name), os.path.join(target, name), mode=mode)
+    return excluded_files, excluded_bytes
+
+
+def stage_link(source, destination, root):
+    """If ``source`` is a symlink to a path within ``root`` (or a broken one),
+    recreates it as ``destination`` and returns ``True``. Links within the
+    staged tree, like the ones in ``node_modules/.bin``, must keep pointing to
+    their relative target. Links to paths outside ``root`` would be broken
+    once staged, so their target is staged instead."""
+    if not os.path.islink(source) or not hasattr(os, 'symlink'):
+        return False
+
+    target = os.path.realpath(source)
+    root = os.path.realpath(root)
+    if os.path.exists(target) and target != root and not target.startswith(root + os.sep):
+        return False
+
+    if os.path.isdir(destination) and not os.path.islink(destination):
+        shutil.rmtree(destination)
+    elif os.path.lexists(destination):
+        os.remove(destination)
+    os.symlink(os.readlink(source), destination)
+    return True
+
+
+def stage_file(source, destination, mode='copy'):
+    """Places the content of ``source`` in ``destination``. ``mode`` is one of
+    ``STAGING_MODES``: ``hardlink`` and ``reflink`` share the data of
+    ``source`` instead of copying it, and fall back to a copy if the file
+    system doesn't support it (e.g. across devices)."""
+    if os.path.lexists(destination):
+        # Never write through an existing link to other file.
+        os.remove(destination)
+
+    source = os.path.realpath(source)
+    if mode == 'hardlink':
+        try:
+            os.link(source, destination)
+            return
+        except (OSError, AttributeError):
+            pass
+    elif mode == 'reflink' and _reflink(source, destination):
+        return
+    shutil.copy(source, destination)
+
+
+def _reflink(source, destination):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except (IOError, OSError):
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+    shutil.copymode(source, destination)
+    return True
+
+
+def _update_file_digest(digest, filename, chunk_size=1024 * 1024):
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+
+def get_tree_size(path):
+    """Returns the total size in bytes of all files within ``path``."""
+    size = 0
+    for basedir, dirs, files in os.walk(path, followlinks=True):
+        for filename in files:
+            size += os.path.getsize(os.path.join(basedir, filename))
+    return size
+
+
+def copy_tree(source, destination, mode='copy'):
+    """Copies the content of ``source`` into ``destination``, merging it with
+    any existing content. Files are staged using ``stage_file`` and ``mode``,
+    and symlinks using ``stage_link``."""
+    for basedir, dirs, files in os.walk(source, followlinks=True):
+        target = os.path.join(destination, os.path.relpath(basedir, source))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in list(dirs):
+            if stage_link(os.path.join(basedir, name), os.path.join(target, name), source):
+                dirs.remove(name)
+        for filename in files:
+            if not stage_link(os.path.join(basedir, filename), os.path.join(target, filename), source):
+                stage_file(os.path.join(basedir, filename), os.path.join(target, filename), mode=mode)
+
+
+def format_size(size):
+    """Returns a human readable representation of ``size`` bytes."""
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit) if unit != 'B' else '{} {}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f} GB'.format(size)
+
+
 def validate_lamba_env_var_name(name):
     """
     There is no limit to the number of environment variables you can create as long as the total
@@ -137,6 +482,17 @@ def validate_code_bucket(name):
     return name
 
 
+def get_true_false(settings, field, default='t'):
+    """Returns if the setting ``field`` is true (``true``, ``True``, ``t``...)."""
+    return str(settings.get(field, default)).lower()[0] == 't'
+
+
+def get_workspace():
+    """Returns the directory where gordon stores temporary build files and
+    caches."""
+    return os.path.join(os.path.expanduser("~"), '.gordon')
+
+
 def setup_region(region, settings=None):
     """Returns which region should be used and sets ``AWS_DEFAULT_REGION`` in
     order to configure ``boto3``."""
@@ -210,32 +566,57 @@ def convert_cloudformation_types(data):
     return cf_data
 
 
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+
 def fix_troposphere_references(template):
     """"Tranverse the troposphere ``template`` looking missing references.
-    Fix them by adding a new parameter for those references."""
+    Fix them by adding a new parameter for those references.
+
+    Resources, outputs and conditions are walked once. Missing references can
+    be either explicit (``Ref``) or implicit in ``Sub`` strings (``${Name}``).
+    """
+    known = set(template.parameters) | set(template.resources)
 
-    def _fix_references(value):
+    def _add_parameter(name, type_='String'):
+        if name not in known and not name.startswith('AWS::'):
+            known.add(name)
+            template.add_parameter(troposphere.Parameter(name, Type=type_))
+
+    def _fix_sub(data):
+        if isinstance(data, list):
+            string, variables = data[0], data[1]
+        else:
+            string, variables = data, {}
+        if isinstance(string, six.string_types):
+            for name in SUB_VARIABLE.findall(string):
+                if name not in variables and '.' not in name:
+                    _add_parameter(name)
+
+    stack = list(template.conditions.values()) + list(template.resources.values()) + \
+        list(template.outputs.values())
+    stack.reverse()
+    while stack:
+        value = stack.pop()
         if isinstance(value, troposphere.Ref):
             name = value.data['Ref']
-            if name not in (list(template.parameters.keys()) + list(template.resources.keys())) and not name.startswith('AWS::'):
-                template.add_parameter(
-                    troposphere.Parameter(
-                        name,
-                        Type=getattr(value, '_type', 'String'),
-                    )
-                )
-
-        elif isinstance(value, troposphere.Join):
-            for v in value.data['Fn::Join'][1]:
-                _fix_references(v)
-
+            if isinstance(name, six.string_types):
+                _add_parameter(name, getattr(value, '_type', 'String'))
+            continue
+        elif isinstance(value, troposphere.Sub):
+            _fix_sub(value.data['Fn::Sub'])
+            children = [value.data['Fn::Sub']]
+        elif isinstance(value, troposphere.AWSHelperFn):
+            children = [value.data]
         elif isinstance(value, troposphere.BaseAWSObject):
-            for _, v in six.iteritems(value.properties):
-                _fix_references(v)
-
-    for _, resource in six.iteritems(template.resources):
-        for _, value in six.iteritems(resource.properties):
-            _fix_references(value)
+            children = list(value.properties.values())
+        elif isinstance(value, (list, tuple)):
+            children = value
+        elif isinstance(value, dict):
+            children = list(value.values())
+        else:
+            continue
+        stack.extend(reversed(children))
 
     return template
 
@@ -258,9 +639,47 @@ def valid_cloudformation_name(*elements):
     return ''.join(elements)
 
 
+# boto3 sessions are not thread-safe, but the clients they create can be shared
+# between threads.
+_boto3_lock = threading.Lock()
+
+
+def get_boto3_client(service_name):
+    """Returns a boto3 client for ``service_name``. Unlike ``boto3.client``,
+    it can be called from several threads at once."""
+    import boto3
+    with _boto3_lock:
+        return boto3.client(service_name)
+
+
+def get_transfer_config(settings):
+    """Returns the boto3 ``TransferConfig`` used to upload files to S3, given
+    the ``s3-transfer`` settings of the project. Sizes are in MB, and
+    bandwidth in MB per second."""
+    from boto3.s3.transfer import TransferConfig
+
+    kwargs = {}
+    for name, value in six.iteritems(settings or {}):
+        if name not in S3_TRANSFER_SETTINGS:
+            raise exceptions.ValidationError(
+                "s3-transfer settings must be one of: {}".format(', '.join(sorted(S3_TRANSFER_SETTINGS)))
+            )
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = 0
+        if value < 1:
+            raise exceptions.ValidationError("s3-transfer {} must be a positive number".format(name))
+        argument, unit = S3_TRANSFER_SETTINGS[name]
+        kwargs[argument] = value * unit
+    return TransferConfig(**kwargs)
+
+
 def get_cf_stack(name):
     """Returns the CloudFormation stack with name ``name``. If it doesn't exit
     returns None."""
+    import boto3
+    from botocore.exceptions import ClientError
     client = boto3.client('cloudformation')
     try:
         return client.describe_stacks(StackName=name)['Stacks'][0]
@@ -277,7 +696,32 @@ def filter_context_for_template(context, template_body):
     return dict(parameters)
 
 
+def get_template_hash(template_body, parameters):
+    """Returns a hash of ``template_body`` and the ``parameters`` a stack is
+    created or updated with."""
+    digest = hashlib.sha1(six.text_type(template_body).encode('utf-8'))
+    digest.update(json.dumps(parameters, sort_keys=True, default=six.text_type).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def add_template_hash(template_body, template_hash):
+    """Returns ``template_body`` with an output holding ``template_hash``, so
+    the template and parameters a stack was created or updated with can be
+    checked using ``describe_stacks``."""
+    template = json.loads(template_body, object_pairs_hook=OrderedDict)
+    template.setdefault('Outputs', OrderedDict())[CF_TEMPLATE_HASH_OUTPUT] = {'Value': template_hash}
+    return json.dumps(template, separators=(',', ':'))
+
+
+def get_stack_outputs(stack):
+    """Returns the outputs of ``stack`` by key, without the ones gordon adds
+    for itself."""
+    return OrderedDict([(o['OutputKey'], o['OutputValue']) for o in (stack or {}).get('Outputs', [])
+                        if o['OutputKey'] != CF_TEMPLATE_HASH_OUTPUT])
+
+
 def upload_to_s3(bucket, key, data):
+    import boto3
     s3 = boto3.resource('s3')
     s3.Bucket(bucket).put_object(Key=key, Body=data)
     return 'https://s3.amazonaws.com/{}/{}'.format(bucket, key)
@@ -292,13 +736,15 @@ def get_template_s3_key(filename):
     )
 
 
-def create_stack(name, template_filename, bucket, context, timeout_in_minutes, **kwargs):
-    """Creates a new CloudFormation stack with name ``name`` using as template
-    ``template_filename`` and ``context`` as parameters."""
-
-    client = boto3.client('cloudformation')
+def get_template_arguments(template_filename, bucket, context):
+    """Returns the parameters ``template_filename`` gets from ``context`` and
+    the arguments used to send it to CloudFormation: its URL once uploaded
+    to ``bucket``, or the body itself if there is no bucket. The template
+    sent includes the hash of both as output (see ``add_template_hash``)."""
     with open(template_filename, 'r') as f:
         template_body = f.read()
+    parameters = filter_context_for_template(context, template_body)
+    template_body = add_template_hash(template_body, get_template_hash(template_body, parameters))
 
     extra = {}
     if bucket:
@@ -309,8 +755,16 @@ def create_stack(name, template_filename, bucket, context, timeout_in_minutes, *
         )
     else:
         extra['TemplateBody'] = template_body
+    return parameters, extra
 
-    parameters = filter_context_for_template(context, template_body)
+
+def create_stack(name, template_filename, bucket, context, timeout_in_minutes, **kwargs):
+    """Creates a new CloudFormation stack with name ``name`` using as template
+    ``template_filename`` and ``context`` as parameters."""
+    import boto3
+
+    client = boto3.client('cloudformation')
+    parameters, extra = get_template_arguments(template_filename, bucket, context)
     stack = client.create_stack(
         StackName=name,
         Parameters=[{'ParameterKey': k, 'ParameterValue': v} for k, v in six.iteritems(parameters)],
@@ -331,21 +785,11 @@ def create_stack(name, template_filename, bucket, context, timeout_in_minutes, *
 def update_stack(name, template_filename, bucket, context, **kwargs):
     """Updates the stack ``name`` using ``template_filename`` as template and
     ``context`` as parameters"""
+    import boto3
+    from botocore.exceptions import ClientError
 
     client = boto3.client('cloudformation')
-    with open(template_filename, 'r') as f:
-        template_body = f.read()
-
-    extra = {}
-    if bucket:
-        extra['TemplateURL'] = upload_to_s3(
-            bucket, get_template_s3_key(template_filename),
-            template_body
-        )
-    else:
-        extra['TemplateBody'] = template_body
-
-    parameters = filter_context_for_template(context, template_body)
+    parameters, extra = get_template_arguments(template_filename, bucket, context)
     try:
         stack = client.update_stack(
             StackName=name,
@@ -362,36 +806,80 @@ def update_stack(name, template_filename, bucket, context, **kwargs):
     return get_cf_stack(stack['StackId'])
 
 
-def wait_for_cf_status(stack_id, spin_every=50, every=1000, limit=60 * 15 * 1000):
-    """Waits up to ``limit`` seconds in ``every`` intervals until the stack
-    with ID ``stack_id`` reached one of the ``FINAL_STATUS``.
-    """
-    clean_output = False
-    stack_status = 'N/A'
-    for m, i in mill(range(0, limit, spin_every)):
-        if not (i % every):
-            stack = get_cf_stack(name=stack_id)
-            if stack:
-                stack_status = stack['StackStatus']
-
-        if i:
-            puts("\r{}".format(" " * 80), newline=False)
-            puts("\r    {} waiting... {}".format(get_cf_color(stack_status)(stack_status), m), newline=False)
-            sys.stdout.flush()
-        if stack_status in CF_FINAL_SUCCEED_STATUS:
-            if clean_output:
-                puts("")
-            return stack
-        elif stack_status in CF_FINAL_ERRORED_STATUS:
-            raise exceptions.AbnormalCloudFormationStatusError(stack, stack_status)
-        clean_output = True
-        time.sleep(spin_every / 1000.0)
-    puts("")
-
-
-def create_or_update_cf_stack(name, template_filename, bucket=None, context=None, **kwargs):
+def get_new_stack_events(client, stack_id, last_event_id=None, since=None):
+    """Returns the events of the stack ``stack_id`` newer than the event
+    ``last_event_id`` (or that happened after ``since``), oldest first.
+    Events are returned newest first, so only the pages with new events are
+    requested."""
+    events = []
+    for page in client.get_paginator('describe_stack_events').paginate(StackName=stack_id):
+        for event in page['StackEvents']:
+            if event['EventId'] == last_event_id or (since and event['Timestamp'] < since):
+                return events[::-1]
+            events.append(event)
+    return events[::-1]
+
+
+def wait_for_cf_status(stack_id, timeout=60 * 15, min_delay=1, max_delay=15):
+    """Waits up to ``timeout`` seconds until the stack with ID ``stack_id``
+    reaches one of the ``CF_FINAL_STATUS``, streaming its events as they
+    happen. Events are polled every ``min_delay`` seconds while the stack is
+    changing, backing off up to ``max_delay`` seconds while it isn't (or if
+    CloudFormation throttles us)."""
+    import boto3
+    from botocore.exceptions import ClientError
+
+    stack = get_cf_stack(name=stack_id)
+    if stack['StackStatus'] in CF_FINAL_STATUS:
+        return _check_cf_status(stack)
+
+    client = boto3.client('cloudformation')
+    since = stack.get('LastUpdatedTime') or stack.get('CreationTime')
+    last_event_id = None
+    delay = min_delay
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            events = get_new_stack_events(client, stack['StackId'], last_event_id=last_event_id, since=since)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'Throttling':
+                raise
+            events = []
+
+        for event in events:
+            last_event_id = event['EventId']
+            status = event['ResourceStatus']
+            puts(u"{} {} {} {}".format(
+                event['Timestamp'].strftime('%H:%M:%S'),
+                get_cf_color(status)(status),
+                event['ResourceType'],
+                event['LogicalResourceId']
+            ))
+            if event.get('ResourceStatusReason') and 'FAILED' in status:
+                with indent(2):
+                    puts(colored.red(event['ResourceStatusReason']))
+
+            if event['ResourceType'] == 'AWS::CloudFormation::Stack' and \
+               event['PhysicalResourceId'] == stack['StackId'] and status in CF_FINAL_STATUS:
+                return _check_cf_status(get_cf_stack(name=stack['StackId']))
+
+        delay = min_delay if events else min(delay * 2, max_delay)
+        time.sleep(delay)
+
+    raise exceptions.CloudFormationWaitTimeoutError(stack['StackId'], int(timeout))
+
+
+def _check_cf_status(stack):
+    if stack['StackStatus'] in CF_FINAL_ERRORED_STATUS:
+        raise exceptions.AbnormalCloudFormationStatusError(stack, stack['StackStatus'])
+    return stack
+
+
+def create_or_update_cf_stack(name, template_filename, bucket=None, context=None, wait_timeout=60 * 15, **kwargs):
     """Creates or updates the stack called ``name`` using ``template_filename``
-    as template and ``context`` as parameters."""
+    as template and ``context`` as parameters.
+    If the stack was created or updated using the same template and
+    parameters, it is not updated again."""
     context = context or {}
     stack = get_cf_stack(name)
 
@@ -400,15 +888,178 @@ def create_or_update_cf_stack(name, template_filename, bucket=None, context=None
     elif stack and stack['StackStatus'] in CF_DELETE_STACK_REQUIRED_STATUS:
         raise exceptions.AbnormalCloudFormationStatusError(stack['StackId'], stack['StackStatus'])
 
+    with open(template_filename, 'r') as f:
+        template_body = f.read()
+    if is_stack_up_to_date(stack, template_body, context):
+        puts(colored.green(u'✓ No updates are to be performed.'))
+        return stack
+
+    if stack and stack['StackStatus'] == 'REVIEW_IN_PROGRESS':
+        # Stacks created by ``gordon plan`` which were never applied can only
+        # be created through a change set.
+        change_set_id = create_change_set(name, get_change_set_name(), template_filename, bucket=bucket,
+                                          context=context)
+        wait_for_change_sets([change_set_id], timeout=wait_timeout)
+        return execute_change_set(change_set_id, wait_timeout=wait_timeout)
+
     if stack:
         stack = update_stack(name, template_filename, bucket=bucket, context=context, **kwargs)
     else:
         stack = create_stack(name, template_filename, bucket=bucket, context=context, **kwargs)
 
-    return wait_for_cf_status(stack['StackId'])
+    return wait_for_cf_status(stack['StackId'], timeout=wait_timeout)
+
+
+def is_stack_up_to_date(stack, template_body, context):
+    """Returns if ``stack`` was successfully created or updated using
+    ``template_body`` and the same parameters it would get from
+    ``context``."""
+    if not stack or stack['StackStatus'] not in ('CREATE_COMPLETE', 'UPDATE_COMPLETE'):
+        return False
+    template_hash = get_template_hash(template_body, filter_context_for_template(context, template_body))
+    outputs = dict([(o['OutputKey'], o['OutputValue']) for o in stack.get('Outputs', [])])
+    return outputs.get(CF_TEMPLATE_HASH_OUTPUT) == template_hash
+
+
+def get_change_set_name():
+    return datetime.utcnow().strftime('gordon-%Y%m%d%H%M%S')
+
+
+def create_change_set(name, change_set_name, template_filename, bucket=None, context=None, **kwargs):
+    """Creates the change set ``change_set_name`` with the changes updating
+    (or creating) the stack ``name`` using ``template_filename`` as template
+    and ``context`` as parameters would make. Change sets are computed by
+    CloudFormation asynchronously, so it returns its ID right away."""
+    import boto3
+
+    context = context or {}
+    stack = get_cf_stack(name)
+    if stack and stack['StackStatus'] in CF_IN_PROGRESS_STATUS:
+        raise exceptions.CloudFormationStackInProgressError(stack['StackId'], stack['StackStatus'])
+    elif stack and stack['StackStatus'] in CF_DELETE_STACK_REQUIRED_STATUS:
+        raise exceptions.AbnormalCloudFormationStatusError(stack['StackId'], stack['StackStatus'])
+
+    client = boto3.client('cloudformation')
+    parameters, extra = get_template_arguments(template_filename, bucket, context)
+    # Stacks created by a change set which was never executed wait in
+    # REVIEW_IN_PROGRESS until one is.
+    if stack and stack['StackStatus'] != 'REVIEW_IN_PROGRESS':
+        extra['ChangeSetType'] = 'UPDATE'
+    else:
+        extra['ChangeSetType'] = 'CREATE'
+        extra['Tags'] = [{'Key': 'GordonVersion', 'Value': get_version()}]
+
+    change_set = client.create_change_set(
+        StackName=name,
+        ChangeSetName=change_set_name,
+        Parameters=[{'ParameterKey': k, 'ParameterValue': v} for k, v in six.iteritems(parameters)],
+        Capabilities=['CAPABILITY_IAM'],
+        **extra
+    )
+    return change_set['Id']
+
+
+def describe_change_set(client, change_set_id):
+    """Returns the description of the change set ``change_set_id``, including
+    all its changes."""
+    change_set = client.describe_change_set(ChangeSetName=change_set_id)
+    while change_set.get('NextToken'):
+        page = client.describe_change_set(ChangeSetName=change_set_id, NextToken=change_set['NextToken'])
+        change_set['Changes'].extend(page.get('Changes', []))
+        change_set['NextToken'] = page.get('NextToken')
+    return change_set
+
+
+def wait_for_change_sets(change_set_ids, timeout=60 * 15, min_delay=1, max_delay=15):
+    """Waits up to ``timeout`` seconds until all ``change_set_ids`` are
+    computed, polling the pending ones together, and returns their
+    descriptions by ID. Change sets without changes are deleted, and returned
+    with an empty list of changes."""
+    import boto3
+    from botocore.exceptions import ClientError
+
+    client = boto3.client('cloudformation')
+    pending = list(change_set_ids)
+    change_sets = {}
+    delay = min_delay
+    start = time.time()
+    while pending:
+        for change_set_id in list(pending):
+            try:
+                change_set = describe_change_set(client, change_set_id)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'Throttling':
+                    raise
+                continue
+
+            if change_set['Status'] in ('CREATE_PENDING', 'CREATE_IN_PROGRESS'):
+                continue
+            pending.remove(change_set_id)
+
+            if change_set['Status'] == 'FAILED':
+                reason = change_set.get('StatusReason', '')
+                if not any([r in reason for r in CF_EMPTY_CHANGE_SET_REASONS]):
+                    raise exceptions.ChangeSetError(change_set['StackName'], reason)
+                client.delete_change_set(ChangeSetName=change_set_id)
+                change_set['Changes'] = []
+            change_sets[change_set_id] = change_set
+
+        if pending:
+            if time.time() - start >= timeout:
+                raise exceptions.CloudFormationWaitTimeoutError(', '.join(pending), int(timeout))
+            delay = min(delay * 2, max_delay)
+            time.sleep(delay)
+    return change_sets
+
+
+def get_change_set_changes(change_set):
+    """Returns a summary of the changes to resources of ``change_set``: what
+    will happen to them (``Add``, ``Modify`` or ``Remove``), if they will be
+    replaced, and which of their properties change."""
+    changes = []
+    for change in change_set.get('Changes', []):
+        if change.get('Type') != 'Resource':
+            continue
+        change = change['ResourceChange']
+        changes.append({
+            'Action': change['Action'],
+            'LogicalResourceId': change['LogicalResourceId'],
+            'ResourceType': change['ResourceType'],
+            'Replacement': change.get('Replacement', 'False'),
+            'Properties': sorted(set([
+                d['Target']['Name'] for d in change.get('Details', [])
+                if d.get('Target', {}).get('Attribute') == 'Properties' and d['Target'].get('Name')
+            ]))
+        })
+    return sorted(changes, key=lambda c: c['LogicalResourceId'])
+
+
+def execute_change_set(change_set_id, wait_timeout=60 * 15):
+    """Executes the change set ``change_set_id`` and waits until its stack is
+    updated. Change sets can only be executed if their stack didn't change
+    since they were created."""
+    import boto3
+
+    client = boto3.client('cloudformation')
+    change_set = client.describe_change_set(ChangeSetName=change_set_id)
+    if change_set['ExecutionStatus'] != 'AVAILABLE':
+        raise exceptions.InvalidPlanError(
+            "change set of {} is {}".format(change_set['StackName'], change_set['ExecutionStatus'])
+        )
+
+    client.execute_change_set(ChangeSetName=change_set_id)
+    # Stacks don't leave their previous status the moment the change set is
+    # executed, so wait until it is before waiting for the stack.
+    delay = 1
+    while change_set['ExecutionStatus'] == 'AVAILABLE':
+        time.sleep(delay)
+        delay = min(delay * 2, 15)
+        change_set = client.describe_change_set(ChangeSetName=change_set_id)
+    return wait_for_cf_status(change_set['StackId'], timeout=wait_timeout)
 
 
 def delete_s3_bucket(bucket_name, dry_run=True, quiet=False):
+    import boto3
     s3client = boto3.client('s3')
     versions = s3client.list_object_versions(Bucket=bucket_name).get('Versions', [])
     objects = [{'Key': o['Key'], 'VersionId': o['VersionId']} for o in versions]
@@ -428,6 +1079,8 @@ def delete_s3_bucket(bucket_name, dry_run=True, quiet=False):
 
 
 def delete_cf_stack(name, dry_run=True):
+    import boto3
+    from botocore.exceptions import ClientError
     client = boto3.client('cloudformation')
     try:
         stack = client.describe_stack_resources(StackName=name)
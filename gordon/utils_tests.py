@@ -12,6 +12,11 @@ import tempfile
 import six
 import boto3
 
+try:
+    from mock import patch
+except ImportError:
+    from unittest.mock import patch
+
 from gordon.bin import main as gordon
 from gordon.utils import cd, generate_stack_name, delete_s3_bucket, Capturing
 
@@ -61,14 +66,21 @@ class BaseBuildTest(unittest.TestCase):
     def setUp(self):
         super(BaseBuildTest, self).setUp()
         self.addCleanup(self._clean_build_path)
+        # Every test builds using an empty workspace, so the result doesn't
+        # depend on what previous builds left in the build or dependency caches.
+        self.workspace = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workspace, True)
+        workspace_patcher = patch('gordon.utils.get_workspace', return_value=self.workspace)
+        workspace_patcher.start()
+        self.addCleanup(workspace_patcher.stop)
 
     @property
     def _test_name(self):
         return self.__class__.__module__.split('.', 1)[0]
 
-    def _test_project_step(self, filename):
+    def _test_project_step(self, filename, build_args=()):
         with cd(os.path.join(self.test_path, filename)):
-            code = gordon(['gordon', 'build'])
+            code = gordon(['gordon', 'build'] + list(build_args))
             self.assertEqual(code, 0)
 
     def _clean_build_path(self):
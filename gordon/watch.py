@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from clint.textui import colored, indent, puts
+
+from . import exceptions
+from .core import ProjectBuild, SETTINGS_FILE
+from .resources.lambdas import IGNORE_FILENAME
+
+# Seconds without changes gordon waits for before rebuilding the project, so
+# a burst of changes (e.g. saving several files at once) triggers one build.
+DEBOUNCE = 0.3
+
+# Seconds between scans of the polling watcher.
+POLLING_INTERVAL = 1.0
+
+# Constants from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF
+)
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class BaseWatcher(object):
+    """Reports which files change within ``roots``. Directories for which
+    ``skip(path)`` is true are not watched."""
+
+    def __init__(self, roots, skip=None):
+        self.roots = roots
+        self.skip = skip or (lambda path: False)
+
+    def _walk(self):
+        for root in self.roots:
+            for basedir, dirs, files in os.walk(root):
+                dirs[:] = [d for d in dirs if not self.skip(os.path.join(basedir, d))]
+                yield basedir, files
+
+    def wait(self, debounce=DEBOUNCE):
+        """Blocks until some file changes, and returns the paths of all files
+        which changed until no more changes happened for ``debounce``
+        seconds."""
+        changed = set()
+        while not changed:
+            changed |= self._poll(None)
+        while True:
+            more = self._poll(debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def _poll(self, timeout):
+        """Returns the paths which changed, waiting up to ``timeout`` seconds
+        (or forever if ``None``) for changes to happen."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(BaseWatcher):
+    """Watcher based on Linux's inotify."""
+
+    def __init__(self, *args, **kwargs):
+        super(InotifyWatcher, self).__init__(*args, **kwargs)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+        for basedir, _ in self._walk():
+            self._add_watch(basedir)
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, path.encode(sys.getfilesystemencoding()), INOTIFY_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, 'Too many directories to watch. Increase fs.inotify.max_user_watches')
+            return
+        self._watches[wd] = path
+
+    def _add_tree(self, path):
+        for basedir, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not self.skip(os.path.join(basedir, d))]
+            self._add_watch(basedir)
+
+    def _poll(self, timeout):
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed = set()
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so anything might have changed.
+                changed.update(self.roots)
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if wd not in self._watches:
+                continue
+
+            path = os.path.join(self._watches[wd], name) if name else self._watches[wd]
+            if mask & IN_ISDIR:
+                if self.skip(path):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(BaseWatcher):
+    """Watcher which periodically compares the modification time and size of
+    all files. Used where inotify is not available."""
+
+    def __init__(self, roots, skip=None, interval=POLLING_INTERVAL):
+        super(PollingWatcher, self).__init__(roots, skip=skip)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for basedir, files in self._walk():
+            for filename in files:
+                path = os.path.join(basedir, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def _poll(self, timeout):
+        time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+        snapshot = self._scan()
+        changed = set([p for p in set(snapshot) | set(self._snapshot) if snapshot.get(p) != self._snapshot.get(p)])
+        self._snapshot = snapshot
+        return changed
+
+
+def get_watcher(roots, skip=None):
+    """Returns an ``InotifyWatcher`` if inotify is available, or a
+    ``PollingWatcher`` otherwise."""
+    try:
+        return InotifyWatcher(roots, skip=skip)
+    except (OSError, AttributeError):
+        return PollingWatcher(roots, skip=skip)
+
+
+class ProjectWatch(object):
+    """Builds a project, and incrementally rebuilds it every time any of its
+    files change. Only lambdas whose code changed are packaged again, and only
+    templates whose content changed are written again. Changes to settings
+    files reload the whole project."""
+
+    def __init__(self, path, stdin, **kwargs):
+        self.path = path
+        self.stdin = stdin
+        kwargs['incremental'] = True
+        self.kwargs = kwargs
+        self.project = None
+
+    def _load(self):
+        return ProjectBuild(path=self.path, stdin=self.stdin, **self.kwargs)
+
+    def build(self):
+        self._reload()
+        watcher = get_watcher(self._get_roots(), skip=self._skip)
+        puts(colored.blue("Watching for changes ({})".format(watcher.__class__.__name__)))
+        try:
+            while True:
+                changed = watcher.wait()
+                reload, lambdas = self.get_affected(changed)
+                if reload:
+                    puts(colored.blue("Settings changed. Reloading project"))
+                    self._reload()
+                    watcher.close()
+                    watcher = get_watcher(self._get_roots(), skip=self._skip)
+                elif lambdas:
+                    puts(colored.blue("Changes in {}".format(
+                        ', '.join(sorted([lambda_.in_project_name for lambda_ in lambdas])))))
+                    for lambda_ in lambdas:
+                        # Their code changed, so their build keys must be computed again.
+                        self.project.packaged_artifacts.pop(lambda_.build_key, None)
+                        lambda_.build_key = None
+                        lambda_.packaged = False
+                    self._build()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    def _reload(self):
+        try:
+            self.project = self._load()
+        except exceptions.BaseGordonException as exc:
+            self._error(exc)
+        else:
+            self._build()
+
+    def _build(self):
+        try:
+            self.project.build()
+        except exceptions.BaseGordonException as exc:
+            self._error(exc)
+
+    def _error(self, exc):
+        with indent(2):
+            puts(colored.red(exc.get_hint()))
+
+    def _get_roots(self):
+        """Returns the directories to watch: the project, and apps defined
+        outside of it (excluding gordon's contrib apps)."""
+        roots = [self.path]
+        for app in (self.project.applications if self.project else []):
+            path = os.path.abspath(app.path)
+            if not self._within(path, self.path) and not self._within(path, self.project.root):
+                roots.append(path)
+        return roots
+
+    def _skip(self, path):
+        return os.path.basename(path).startswith('.') or self._within(path, os.path.join(self.path, '_build'))
+
+    def _within(self, path, directory):
+        return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+    def get_affected(self, changed):
+        """Returns if the project must be reloaded because any of the
+        ``changed`` paths affects settings, and the list of lambdas whose
+        code is within any of them."""
+        if not self.project:
+            return True, []
+
+        lambdas = set()
+        for path in changed:
+            name = os.path.basename(path)
+            if name in (SETTINGS_FILE, IGNORE_FILENAME) or path in self._get_roots():
+                return True, []
+            for lambda_ in self.project.get_resources('lambdas'):
+                code = os.path.abspath(os.path.join(lambda_.get_root(), lambda_.settings['code']))
+                if self._within(path, code):
+                    lambdas.add(lambda_)
+        return False, list(lambdas)
@@ -3,7 +3,7 @@ import sys
 from setuptools import setup, find_packages
 
 install_requires = [
-    'boto3>=1.2.3,<2.0',
+    'boto3>=1.10.0,<2.0',
     'clint>0.5,<1.0',
     'PyYAML>=3,<4.0',
     'troposphere>=1.6',
@@ -1,5 +1,7 @@
 import os
+import json
 
+from gordon.utils import get_file_hash
 from gordon.utils_tests import BaseIntegrationTest, BaseBuildTest
 
 
@@ -18,3 +20,43 @@ class BuildTest(BaseBuildTest):
         self.assertBuild('0001_project', '0001_p.json')
         self.assertBuild('0001_project', '0002_pr_r.json')
         self.assertBuild('0001_project', '0003_r.json')
+
+    def test_0001_project_parallel(self):
+        self._test_project_step('0001_project', build_args=['--jobs', '2'])
+        self.assertBuild('0001_project', '0001_p.json')
+        self.assertBuild('0001_project', '0002_pr_r.json')
+        self.assertBuild('0001_project', '0003_r.json')
+
+    def test_0001_project_incremental(self):
+        self._test_project_step('0001_project')
+        self._test_project_step('0001_project', build_args=['--incremental'])
+        self.assertBuild('0001_project', '0001_p.json')
+        self.assertBuild('0001_project', '0002_pr_r.json')
+        self.assertBuild('0001_project', '0003_r.json')
+
+    def test_0001_project_artifact_hashes(self):
+        build_path = os.path.join(self.test_path, '0001_project', '_build')
+        for build_args in ([], ['--incremental']):
+            self._test_project_step('0001_project', build_args=build_args)
+            with open(os.path.join(build_path, 'manifest.json'), 'r') as f:
+                files = json.loads(f.read())['files']
+            artifacts = [name for name in files if name.endswith('.zip')]
+            self.assertTrue(artifacts)
+            for name in artifacts:
+                self.assertEqual(files[name]['sha1'], get_file_hash(os.path.join(build_path, name)))
+
+    def test_0001_project_profile(self):
+        self._test_project_step('0001_project', build_args=['--profile'])
+        self.assertBuild('0001_project', '0003_r.json')
+        with open(os.path.join(self.test_path, '0001_project', '_build', 'profile.json'), 'r') as f:
+            profile = json.loads(f.read())
+        self.assertEqual(
+            [section['name'] for section in profile['children']][-2:],
+            ['validate', 'build']
+        )
+
+    def test_0002_project(self):
+        self._test_project_step('0002_project')
+        self.assertBuild('0002_project', '0003_r-contrib-lambdas.json')
+        self.assertBuild('0002_project', '0004_r-contrib-helpers.json')
+        self.assertFalse(os.path.exists(os.path.join(self.test_path, '0002_project', '_build', '0003_r.json')))
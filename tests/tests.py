@@ -1,18 +1,42 @@
-import unittest
+import io
+import os
 import json
+import sys
+import hashlib
+import shutil
+import tempfile
+import subprocess
+import time
+import unittest
+import zipfile
+from datetime import datetime, timedelta
+
+import six
+import troposphere
+from troposphere import sqs
 
 try:
-    from mock import patch, Mock
+    from mock import patch, Mock, mock_open
 except ImportError:
-    from unittest.mock import patch, Mock
+    from unittest.mock import patch, Mock, mock_open
 
-from gordon.actions import Parameter, ActionsTemplate, GetAttr, UploadToS3
-from gordon import exceptions, protocols
+from gordon.actions import (Parameter, Output, Ref, ActionsTemplate, GetAttr, BaseAction, UploadToS3,
+                            InjectContextAndUploadToS3, UploadProgress)
+from gordon import exceptions, protocols, utils
+from gordon.cache import BuildCache, DependencyCache, Cache
+from gordon.core import ProjectBuild, ProjectRun, ProjectApply, ProjectPlan, PLAN_VERSION
+from gordon.stacks import split_template
+from gordon.registry import ResourceRegistry, SortedResources
+from gordon.regions import MultiRegion, parse_regions
+from gordon.resources.lambdas import Lambda, NodeLambda
+from gordon.profiler import Profiler
+from gordon.resources.s3 import BucketNotificationConfiguration, get_overlapping_filters
+from gordon.watch import InotifyWatcher, PollingWatcher, ProjectWatch
 
 
 class TestProtocols(unittest.TestCase):
 
-    @patch('gordon.protocols.boto3.client')
+    @patch('boto3.client')
     def test_kinesis_protocols(self, client_mock):
         paginate = client_mock.return_value.get_paginator.return_value.paginate
         paginate.return_value = [
@@ -36,7 +60,7 @@ class TestProtocols(unittest.TestCase):
         self.assertRaises(exceptions.ProtocolMultipleMatcheslError, protocols.kinesis_endswith, 'c')
         self.assertEqual(protocols.kinesis_endswith('b'), 'abb')
 
-    @patch('gordon.protocols.boto3.client')
+    @patch('boto3.client')
     def test_dynamodb_protocols(self, client_mock):
         paginate = client_mock.return_value.get_paginator.return_value.paginate
         paginate.return_value = [
@@ -60,7 +84,7 @@ class TestProtocols(unittest.TestCase):
         self.assertRaises(exceptions.ProtocolMultipleMatcheslError, protocols.dynamodb_endswith, 'c')
         self.assertEqual(protocols.dynamodb_endswith('b'), 'abb')
 
-    @patch('gordon.protocols.boto3.client')
+    @patch('boto3.client')
     def test_dynamodb_stream_protocols(self, client_mock):
         client_mock.return_value.list_streams.return_value = {
             'Streams': [
@@ -146,23 +170,21 @@ class TestActions(unittest.TestCase):
 
         self.assertEqual(at.apply(context, project), {'version': '1234', 'pi': '3.1416'})
 
-    @patch('gordon.actions.boto3.resource')
-    @patch('gordon.actions.boto3.client')
+    @patch('gordon.actions.os.path.getsize', Mock(return_value=10))
     @patch('gordon.actions.utils.get_file_hash')
-    def test_upload_to_s3(self, get_file_hash_mock, client_mock, resource_mock):
+    def test_upload_to_s3(self, get_file_hash_mock):
         client = Mock()
-        resource = Mock()
-        client_mock.return_value = client
-        resource_mock.return_value = resource
+        context = Mock()
+        config = Mock(multipart_threshold=5, max_bandwidth=None)
+        project = Mock(region='eu-west-1', build_path='_build', transfer_config=config)
+        project.get_s3_client.return_value = client
+        project.get_artifact_hash.return_value = None
 
         #
         # New file
         #
-        client.head_object.side_effect = Exception()
+        client.head_object.side_effect = [Exception(), {'VersionId': 'version123'}]
         get_file_hash_mock.return_value = '123'
-        resource.Object.return_value.version_id = 'version123'
-        context = Mock()
-        project = Mock(region='eu-west-1', build_path='_build')
 
         u = UploadToS3(name='name', bucket='bucket', key='key', filename='filename.zip')
         output = u.apply(context, project)
@@ -171,43 +193,59 @@ class TestActions(unittest.TestCase):
             output,
             {'s3url': 'https://s3-eu-west-1.amazonaws.com/bucket/key', 's3version': 'version123'}
         )
-        resource.Object.assert_called_once_with(
-            'bucket', 'key'
-        )
-        resource.Object.return_value.upload_file.assert_called_once_with(
+        client.upload_file.assert_called_once_with(
             '_build/filename.zip',
-            ExtraArgs={'Metadata': {'sha1': '123'}}
+            'bucket',
+            'key',
+            ExtraArgs={'Metadata': {'sha1': '123'}},
+            Config=config,
+            Callback=project.upload_progress.callback.return_value
         )
+        project.upload_progress.start.assert_called_once_with('filename.zip', 10)
+        project.upload_progress.finish.assert_called_once_with('filename.zip')
 
         #
-        # Existing file, but different hash
+        # Existing file, but different hash. Files below the multipart
+        # threshold are uploaded in a single request, which returns their version.
         #
-        resource.Object.reset_mock()
-        resource.Object.return_value.upload_file.reset_mock()
-        client.head_object.side_effect = None
-        client.head_object.return_value = {'Metadata': {'sha1': '122'}}
+        client.upload_file.reset_mock()
+        client.head_object.side_effect = [{'Metadata': {'sha1': '122'}}]
+        client.put_object.return_value = {'VersionId': 'version124'}
+        config.multipart_threshold = 64
 
         u = UploadToS3(name='name', bucket='bucket', key='key', filename='filename.zip')
-        output = u.apply(context, project)
+        with patch('gordon.actions.open', mock_open(read_data=b'zip'), create=True) as open_mock:
+            output = u.apply(context, project)
 
         self.assertEqual(
             output,
-            {'s3url': 'https://s3-eu-west-1.amazonaws.com/bucket/key', 's3version': 'version123'}
+            {'s3url': 'https://s3-eu-west-1.amazonaws.com/bucket/key', 's3version': 'version124'}
         )
-        resource.Object.assert_called_once_with(
-            'bucket', 'key'
-        )
-        resource.Object.return_value.upload_file.assert_called_once_with(
-            '_build/filename.zip',
-            ExtraArgs={'Metadata': {'sha1': '123'}}
+        client.upload_file.assert_not_called()
+        client.put_object.assert_called_once_with(
+            Bucket='bucket', Key='key', Body=open_mock.return_value, Metadata={'sha1': '123'}
         )
+        project.upload_progress.callback.return_value.assert_called_with(10)
 
         #
-        # Existing file, same hash
+        # Uploads with limited bandwidth always go through upload_file.
         #
-        resource.Object.reset_mock()
-        resource.Object.return_value.upload_file.reset_mock()
+        client.put_object.reset_mock()
+        client.head_object.side_effect = [{'Metadata': {'sha1': '122'}}, {'VersionId': 'version125'}]
+        config.max_bandwidth = 1024
+
+        u = UploadToS3(name='name', bucket='bucket', key='key', filename='filename.zip')
+        output = u.apply(context, project)
 
+        self.assertEqual(output['s3version'], 'version125')
+        self.assertEqual(client.upload_file.call_count, 1)
+        client.put_object.assert_not_called()
+
+        #
+        # Existing file, same hash
+        #
+        client.upload_file.reset_mock()
+        client.head_object.side_effect = None
         client.head_object.return_value = {'Metadata': {'sha1': '123'}, 'VersionId': 'version123'}
 
         u = UploadToS3(name='name', bucket='bucket', key='key', filename='filename.zip')
@@ -217,5 +255,1170 @@ class TestActions(unittest.TestCase):
             output,
             {'s3url': 'https://s3-eu-west-1.amazonaws.com/bucket/key', 's3version': 'version123'}
         )
-        resource.Object.assert_not_called()
-        resource.Object.return_value.upload_file.assert_not_called()
+        client.upload_file.assert_not_called()
+
+    @patch('gordon.actions.utils.get_file_hash')
+    def test_inject_context_and_upload_to_s3_recorded_hash(self, get_file_hash_mock):
+        client = Mock()
+        project = Mock(region='eu-west-1', build_path='_build')
+        project.get_s3_client.return_value = client
+        project.get_artifact_hash.return_value = 'abc'
+        digest = hashlib.sha1(b'abc')
+        digest.update(b'.context')
+        digest.update(b'{"stage": "dev"}')
+        client.head_object.return_value = {'Metadata': {'sha1': digest.hexdigest()}, 'VersionId': 'version123'}
+
+        u = InjectContextAndUploadToS3(name='name', bucket='bucket', key='key', filename='filename.zip',
+                                       context_to_inject={'stage': Ref(name='Stage')})
+        with patch.object(u, 'prepare_file') as prepare_file:
+            output = u.apply({'Stage': 'dev'}, project)
+
+        self.assertEqual(output['s3version'], 'version123')
+        project.get_artifact_hash.assert_called_once_with('_build/filename.zip')
+        get_file_hash_mock.assert_not_called()
+        prepare_file.assert_not_called()
+        client.upload_file.assert_not_called()
+
+    def test_transfer_config(self):
+        config = utils.get_transfer_config({'multipart-chunksize': 16, 'max-concurrency': '4'})
+        self.assertEqual(config.multipart_chunksize, 16 * 1024 * 1024)
+        self.assertEqual(config.max_concurrency, 4)
+        self.assertRaises(exceptions.ValidationError, utils.get_transfer_config, {'chunksize': 16})
+        self.assertRaises(exceptions.ValidationError, utils.get_transfer_config, {'max-concurrency': 0})
+
+    @patch('time.time')
+    def test_upload_progress(self, time_mock):
+        lines = []
+        time_mock.return_value = 0
+        progress = UploadProgress(puts_function=lambda line: lines.append(str(line)), interval=2)
+        progress.start('a.zip', 1024)
+        progress.start('b.zip', 3072)
+        progress.callback('a.zip')(512)
+        time_mock.return_value = 3
+        progress.callback('b.zip')(512)
+        progress.finish('a.zip')
+        self.assertEqual(lines, [u'\u2191 1.0 KB of 4.0 KB (25%) a.zip 50%, b.zip 17%'])
+
+    def test_actions_template_parallelizable(self):
+        class SleepAction(BaseAction):
+            properties = (('name', '', True), ('delay', 0, True))
+
+            def apply(self, context, project):
+                time.sleep(self.delay)
+                project.puts(self.name)
+                if self.name == 'fail':
+                    raise exceptions.ValidationError(self.name)
+                return {'delay': self.delay}
+
+        project = Mock(jobs=3)
+        at = ActionsTemplate(parallelizable=True)
+        for name, delay in (('a', 0.2), ('b', 0), ('c', 0.1)):
+            at.add(SleepAction(name=name, delay=delay))
+            at.add_output(Output(name=name, value=GetAttr(action=name, attr='delay')))
+
+        self.assertEqual(at.apply({}, project), {'a': 0.2, 'b': 0, 'c': 0.1})
+        self.assertEqual([c[0][0] for c in project.puts.call_args_list], ['a', 'b', 'c'])
+
+        project.puts.reset_mock()
+        at.add(SleepAction(name='fail', delay=0))
+        at.add(SleepAction(name='d', delay=0.1))
+        self.assertRaises(exceptions.ValidationError, at.apply, {}, project)
+        self.assertEqual([c[0][0] for c in project.puts.call_args_list][:4], ['a', 'b', 'c', 'fail'])
+
+    def test_lambdas_pre_resources_template_parallelizable(self):
+        template = ActionsTemplate()
+        Lambda.register_type_pre_resources_template(Mock(), template)
+        self.assertTrue(template.parallelizable)
+
+    @patch('gordon.actions.utils.get_file_hash')
+    def test_upload_to_s3_plan(self, get_file_hash_mock):
+        client = Mock()
+        get_file_hash_mock.return_value = '123'
+        project = Mock(region='eu-west-1', build_path='_build')
+        project.get_s3_client.return_value = client
+        project.get_artifact_hash.return_value = None
+
+        client.head_object.return_value = {'Metadata': {'sha1': '122'}, 'VersionId': 'version122'}
+        u = UploadToS3(name='name', bucket='bucket', key='key', filename='filename.zip')
+        self.assertEqual(u.plan(Mock(), project)['s3version'], utils.PLAN_PENDING_VALUE)
+
+        client.head_object.return_value = {'Metadata': {'sha1': '123'}, 'VersionId': 'version123'}
+        u = UploadToS3(name='name', bucket='bucket', key='key', filename='filename.zip')
+        self.assertEqual(u.plan(Mock(), project)['s3version'], 'version123')
+        client.upload_file.assert_not_called()
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.cache = BuildCache(os.path.join(self.path, 'cache'), max_size=10)
+
+    def _artifact(self, name, content):
+        filename = os.path.join(self.path, name)
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return filename
+
+    def test_get_and_put(self):
+        destination = os.path.join(self.path, 'destination.zip')
+        self.assertFalse(self.cache.get('a', destination))
+        self.assertFalse(os.path.exists(destination))
+
+        self.cache.put('a', self._artifact('a.zip', b'aaaa'))
+        self.assertTrue(self.cache.get('a', destination))
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), b'aaaa')
+        self.assertEqual(self.cache.size(), 4)
+
+    def test_get_entry_pruned_after_copying_it(self):
+        destination = os.path.join(self.path, 'destination.zip')
+        self.cache.put('a', self._artifact('a.zip', b'aaaa'))
+        with patch('gordon.cache.os.utime', side_effect=OSError('No such file or directory')):
+            self.assertTrue(self.cache.get('a', destination))
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), b'aaaa')
+
+    def test_prune_evicts_least_recently_used(self):
+        for i, key in enumerate(('a', 'b', 'c')):
+            self.cache.put(key, self._artifact(key, b'xxxx'))
+            os.utime(os.path.join(self.cache.path, '{}.zip'.format(key)), (i, i))
+
+        # Using "a" makes it the most recently used artifact.
+        self.cache.get('a', os.path.join(self.path, 'destination.zip'))
+
+        evicted = self.cache.prune()
+        self.assertEqual([key for key, _, _ in evicted], ['b'])
+        self.assertEqual(sorted([key for key, _, _ in self.cache.entries()]), ['a', 'c'])
+
+        self.cache.clear()
+        self.assertEqual(self.cache.entries(), [])
+
+
+class TestDependencyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.cache = DependencyCache(os.path.join(self.path, 'dependencies'))
+        self.installs = []
+
+    def _install(self, target):
+        self.installs.append(target)
+        with open(os.path.join(target, 'dependency.py'), 'w') as f:
+            f.write('X = 1')
+
+    def test_dependency_sets_are_installed_once(self):
+        first = self.cache.get('a', self._install)
+        second = self.cache.get('a', self._install)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.installs), 1)
+        self.assertTrue(os.path.isfile(os.path.join(first, 'dependency.py')))
+        self.assertEqual([key for key, _, _ in self.cache.entries()], ['a'])
+
+    def test_failed_installs_are_not_cached(self):
+        def install(target):
+            raise RuntimeError()
+
+        self.assertRaises(RuntimeError, self.cache.get, 'a', install)
+        self.assertEqual(os.listdir(self.cache.path), [])
+        self.cache.get('a', self._install)
+        self.assertEqual(len(self.installs), 1)
+
+    def test_prune_evicts_least_recently_used_sets(self):
+        for i, key in enumerate(('a', 'b', 'c')):
+            entry = self.cache.get(key, self._install)
+            os.utime(entry, (i, i))
+        size = self.cache.entries()[0][1]
+
+        evicted = self.cache.prune(max_size=size * 2)
+        self.assertEqual([key for key, _, _ in evicted], ['a'])
+        self.assertEqual([key for key, _, _ in self.cache.entries()], ['c', 'b'])
+        self.assertFalse(os.path.exists(os.path.join(self.cache.path, 'a')))
+
+        self.cache.clear()
+        self.assertEqual(self.cache.entries(), [])
+
+    @patch('gordon.cache.puts')
+    def test_cache_command_prunes_dependencies(self, puts):
+        self.cache.get('a', self._install)
+        with patch('gordon.utils.get_workspace', return_value=self.path):
+            Cache(path=self.path, prune=True, max_size=0).inspect()
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_node_dependencies_key(self):
+        lambda_ = Mock(settings={'code': 'code'}, _package_files=NodeLambda._package_files,
+                       _uncacheable_scripts=NodeLambda._uncacheable_scripts,
+                       _uncacheable_versions=NodeLambda._uncacheable_versions)
+        lambda_.get_root.return_value = self.path
+        os.mkdir(os.path.join(self.path, 'code'))
+
+        def key(dependencies):
+            with open(os.path.join(self.path, 'code', 'package.json'), 'w') as f:
+                json.dump({'dependencies': dependencies}, f)
+            return NodeLambda._get_dependencies_key(lambda_)
+
+        self.assertTrue(key({'lodash': '~4.17.1'}))
+        self.assertTrue(key({'lodash': '^4.17.1'}))
+        self.assertIsNone(key({'helpers': '~/helpers'}))
+        self.assertIsNone(key({'helpers': 'file:../helpers'}))
+
+
+class TestZip(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.source = os.path.join(self.path, 'source')
+        os.makedirs(os.path.join(self.source, 'b'))
+        for name in ('c.py', 'a.py', os.path.join('b', 'd.py')):
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(name)
+        os.chmod(os.path.join(self.source, 'c.py'), 0o700)
+
+    def _zip(self, name):
+        filename = os.path.join(self.path, name)
+        with open(filename, 'wb') as f:
+            utils.zip_directory(self.source, f)
+        return filename
+
+    def test_zip_directory_is_reproducible(self):
+        first = self._zip('first.zip')
+        for name in ('c.py', 'a.py', os.path.join('b', 'd.py')):
+            os.utime(os.path.join(self.source, name), (0, 0))
+        second = self._zip('second.zip')
+
+        with open(first, 'rb') as f, open(second, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+        self.assertEqual(utils.get_file_hash(first), utils.get_file_hash(second))
+
+        with zipfile.ZipFile(first) as zfile:
+            infos = zfile.infolist()
+        self.assertEqual([i.filename for i in infos], ['a.py', 'c.py', 'b/d.py'])
+        self.assertEqual([i.date_time for i in infos], [utils.ZIP_DATE_TIME] * 3)
+        self.assertEqual([(i.external_attr >> 16) & 0o777 for i in infos], [0o644, 0o755, 0o644])
+
+
+class TestIgnorePatterns(unittest.TestCase):
+
+    def test_match(self):
+        ignore = utils.IgnorePatterns([
+            '# comment', '__pycache__/', '*.pyc', '!keep.pyc', '/top.txt', 'docs/*.md', 'a/**/b'
+        ])
+        self.assertTrue(ignore.match('__pycache__', is_dir=True))
+        self.assertTrue(ignore.match('lib/__pycache__', is_dir=True))
+        self.assertFalse(ignore.match('lib/__pycache__'))
+        self.assertTrue(ignore.match('lib/code.pyc'))
+        self.assertFalse(ignore.match('lib/keep.pyc'))
+        self.assertTrue(ignore.match('top.txt'))
+        self.assertFalse(ignore.match('lib/top.txt'))
+        self.assertTrue(ignore.match('docs/index.md'))
+        self.assertFalse(ignore.match('docs/api/index.md'))
+        self.assertTrue(ignore.match('a/b'))
+        self.assertTrue(ignore.match('a/x/y/b'))
+        self.assertFalse(ignore.match('# comment'))
+
+    def test_stage_tree(self):
+        source, destination = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        self.addCleanup(shutil.rmtree, destination)
+        for name in ('code.py', '.hidden', os.path.join('lib', 'util.py'), os.path.join('tests', 'test.py')):
+            if not os.path.isdir(os.path.dirname(os.path.join(source, name))):
+                os.makedirs(os.path.dirname(os.path.join(source, name)))
+            with open(os.path.join(source, name), 'w') as f:
+                f.write('1234')
+
+        excluded = utils.stage_tree(source, destination, utils.IgnorePatterns(['tests/']))
+        self.assertEqual(excluded, (1, 4))
+        self.assertEqual(sorted(os.listdir(destination)), ['code.py', 'lib'])
+        self.assertEqual(os.listdir(os.path.join(destination, 'lib')), ['util.py'])
+
+    def test_stage_tree_symlinks(self):
+        path, destination = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.addCleanup(shutil.rmtree, destination)
+        source = os.path.join(path, 'code')
+        os.makedirs(os.path.join(source, 'node_modules', 'pkg', 'bin'))
+        os.makedirs(os.path.join(source, 'node_modules', '.bin'))
+        with open(os.path.join(source, 'node_modules', 'pkg', 'bin', 'cli.js'), 'w') as f:
+            f.write('cli')
+        with open(os.path.join(path, 'shared.py'), 'w') as f:
+            f.write('shared')
+        os.symlink(os.path.join('..', 'pkg', 'bin', 'cli.js'), os.path.join(source, 'node_modules', '.bin', 'cli'))
+        os.symlink(os.path.join('node_modules', 'pkg'), os.path.join(source, 'pkg'))
+        os.symlink(os.path.join('..', 'shared.py'), os.path.join(source, 'shared.py'))
+
+        utils.stage_tree(source, destination)
+
+        # Links within the tree are recreated...
+        self.assertEqual(os.readlink(os.path.join(destination, 'node_modules', '.bin', 'cli')),
+                         os.path.join('..', 'pkg', 'bin', 'cli.js'))
+        self.assertEqual(os.readlink(os.path.join(destination, 'pkg')), os.path.join('node_modules', 'pkg'))
+        # ... while links outside of it are resolved.
+        self.assertFalse(os.path.islink(os.path.join(destination, 'shared.py')))
+        with open(os.path.join(destination, 'shared.py'), 'r') as f:
+            self.assertEqual(f.read(), 'shared')
+
+        # Artifacts include the content behind the links.
+        zfile = io.BytesIO()
+        utils.zip_directory(destination, zfile)
+        with zipfile.ZipFile(zfile) as z:
+            self.assertEqual(z.read('node_modules/.bin/cli'), b'cli')
+            self.assertEqual(z.read('pkg/bin/cli.js'), b'cli')
+
+    def test_stage_file_hardlink(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        source, destination = os.path.join(path, 'source'), os.path.join(path, 'destination')
+        with open(source, 'w') as f:
+            f.write('source')
+
+        utils.stage_file(source, destination, mode='hardlink')
+        self.assertTrue(os.path.samefile(source, destination))
+
+        # Staging over a hardlink never modifies the file it points to.
+        other = os.path.join(path, 'other')
+        with open(other, 'w') as f:
+            f.write('other')
+        utils.stage_file(other, destination, mode='copy')
+        with open(source, 'r') as f:
+            self.assertEqual(f.read(), 'source')
+        with open(destination, 'r') as f:
+            self.assertEqual(f.read(), 'other')
+
+    def test_lambdas_running_build_commands_are_not_hard_linked(self):
+        lambda_ = Mock(project=Mock(staging_mode='hardlink'))
+        lambda_._get_build_command.return_value = [lambda_._stage_code]
+        self.assertEqual(Lambda.get_staging_mode(lambda_), 'hardlink')
+        lambda_._get_build_command.return_value = [lambda_._stage_code, 'cd {target} && npm install']
+        self.assertEqual(Lambda.get_staging_mode(lambda_), 'copy')
+        lambda_._get_build_command.return_value = 'make'
+        self.assertEqual(Lambda.get_staging_mode(lambda_), 'copy')
+
+    def test_build_commands_are_profiled_by_template(self):
+        lambda_ = Mock(project=Mock(profiler=Profiler(), debug=False))
+        lambda_._format_build_command.side_effect = lambda command, destination, **kwargs: command.format(
+            target=destination)
+        Lambda._run_build_command(lambda_, 'echo {target}', tempfile.gettempdir())
+        self.assertEqual([node['name'] for node in lambda_.project.profiler.root['children']], ['echo {target}'])
+
+
+class TestWatchers(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        os.makedirs(os.path.join(self.path, 'code'))
+        os.makedirs(os.path.join(self.path, '_build'))
+        self.filename = os.path.join(self.path, 'code', 'code.py')
+        with open(self.filename, 'w') as f:
+            f.write('1')
+
+    def _skip(self, path):
+        return os.path.basename(path) == '_build'
+
+    def _test_watcher(self, watcher):
+        self.addCleanup(watcher.close)
+        with open(os.path.join(self.path, '_build', 'ignored.json'), 'w') as f:
+            f.write('1')
+        with open(self.filename, 'w') as f:
+            f.write('22')
+        self.assertEqual(watcher.wait(debounce=0.05), set([self.filename]))
+
+    def test_polling_watcher(self):
+        self._test_watcher(PollingWatcher([self.path], skip=self._skip, interval=0.01))
+
+    def test_inotify_watcher(self):
+        try:
+            watcher = InotifyWatcher([self.path], skip=self._skip)
+        except (OSError, AttributeError):
+            self.skipTest('inotify is not available')
+        self._test_watcher(watcher)
+
+    def _watch(self, use_cache):
+        project = os.path.join(self.path, 'project')
+        shutil.copytree(os.path.join(os.path.dirname(__file__), 'cron', '0001_project'), project)
+        code = os.path.join(project, 'cron', 'example.py')
+
+        def wait():
+            if watcher.wait.call_count > 1:
+                raise KeyboardInterrupt()
+            with zipfile.ZipFile(os.path.join(project, '_build', 'code', 'cron_example.zip')) as zfile:
+                self.assertNotIn(b'return 2', zfile.read('code.py'))
+            with open(code, 'w') as f:
+                f.write('def handler(event, context):\n    return 2\n')
+            return set([code])
+
+        watcher = Mock()
+        watcher.wait.side_effect = wait
+        with patch('gordon.utils.get_workspace', return_value=os.path.join(self.path, 'workspace')), \
+                patch('gordon.watch.get_watcher', return_value=watcher), patch('gordon.watch.puts'):
+            ProjectWatch(path=project, stdin=None, use_cache=use_cache).build()
+
+        with zipfile.ZipFile(os.path.join(project, '_build', 'code', 'cron_example.zip')) as zfile:
+            self.assertIn(b'return 2', zfile.read('code.py'))
+
+    def test_project_watch_rebuilds_changed_lambdas(self):
+        self._watch(use_cache=False)
+
+    def test_project_watch_rebuilds_changed_lambdas_with_cache(self):
+        self._watch(use_cache=True)
+
+
+class TestProjectRun(unittest.TestCase):
+
+    path = os.path.join(os.path.dirname(__file__), 'base', '0001_project')
+
+    def test_only_loads_target_app_lambdas(self):
+        project = ProjectRun(path=self.path, stdin=None, lambda_name='contrib_helpers.sleep')
+        self.assertEqual([app.name for app in project.applications], ['contrib_helpers'])
+        self.assertEqual(
+            [lambda_.in_project_name for lambda_ in project.get_resources('lambdas')],
+            ['lambda:contrib_helpers:sleep']
+        )
+        self.assertEqual(list(project.get_resources('cloudformation')), [])
+        self.assertEqual(project._get_lambda().name, 'sleep')
+
+    def test_falls_back_to_full_load(self):
+        project = ProjectRun(path=self.path, stdin=None, lambda_name='contrib_helpers.unknown')
+        self.assertEqual(
+            [app.name for app in project.applications],
+            ['contrib_helpers', 'contrib_lambdas']
+        )
+        self.assertEqual(project._get_lambda(), None)
+
+
+@patch('gordon.core.puts', Mock())
+class TestPackageLambdas(unittest.TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.path = os.path.join(root, 'project')
+        shutil.copytree(os.path.join(os.path.dirname(__file__), 'base', '0001_project'), self.path)
+        self.workspace = os.path.join(root, 'workspace')
+        os.mkdir(self.workspace)
+        workspace_patcher = patch('gordon.utils.get_workspace', return_value=self.workspace)
+        workspace_patcher.start()
+        self.addCleanup(workspace_patcher.stop)
+
+    def _build(self):
+        ProjectBuild(path=self.path, stdin=None, jobs=2, use_cache=False).build()
+
+    @patch('gordon.resources.lambdas.Lambda.write_zip_file', Mock(side_effect=OSError('No space left on device')))
+    def test_unexpected_errors_are_reported_per_lambda(self):
+        with self.assertRaises(exceptions.LambdaPackagingError) as cm:
+            self._build()
+        self.assertIn('lambda:contrib_helpers:sleep', cm.exception.get_hint())
+        self.assertIn('lambda:contrib_lambdas:version', cm.exception.get_hint())
+
+    @patch('gordon.core._get_fork_context', Mock(return_value=None))
+    def test_sequential_without_fork(self):
+        self._build()
+        self.assertTrue(os.path.exists(os.path.join(self.path, '_build', 'code', 'contrib_helpers_sleep.zip')))
+
+    @patch('gordon.core._get_fork_context', Mock(return_value=None))
+    @patch('gordon.resources.lambdas.Lambda.get_build_key')
+    def test_build_keys_are_only_computed_if_needed(self, get_build_key):
+        self._build()
+        self.assertFalse(get_build_key.called)
+
+    @patch('gordon.core._get_fork_context', Mock(return_value=None))
+    @patch('gordon.resources.lambdas.Lambda.get_build_key', Mock(return_value='same'))
+    def test_lambdas_with_the_same_build_key_are_built_once(self):
+        write_zip_file = Lambda.write_zip_file
+        with patch.object(Lambda, 'write_zip_file', autospec=True, side_effect=write_zip_file) as write:
+            project = ProjectBuild(path=self.path, stdin=None, jobs=2, use_cache=True)
+            project.build()
+        lambdas = list(project.get_resources('lambdas'))
+        self.assertGreater(len(lambdas), 1)
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(Lambda.get_build_key.call_count, len(lambdas))
+
+    @patch('gordon.core._get_fork_context', Mock(return_value=None))
+    @patch('gordon.resources.lambdas.Lambda.get_build_key', Mock(return_value='same'))
+    def test_build_after_failed_build(self):
+        project = ProjectBuild(path=self.path, stdin=None, use_cache=True)
+        with patch.object(project, '_build_resources_template', side_effect=exceptions.ValidationError('error')):
+            self.assertRaises(exceptions.ValidationError, project.build)
+        project.build()
+        for lambda_ in project.get_resources('lambdas'):
+            self.assertTrue(os.path.isfile(lambda_.get_zip_filename()))
+
+
+class TestStartup(unittest.TestCase):
+    """Importing ``boto3``, ``troposphere`` or ``pkg_resources`` takes longer
+    than anything else gordon does while starting. Commands must only import
+    them if they need them."""
+
+    script = """
+import os, sys, json
+from gordon.bin import main
+os.chdir(sys.argv[1])
+try:
+    main(['gordon'] + sys.argv[2:])
+except SystemExit:
+    pass
+sys.stdout.write(json.dumps(sorted(set([m.split('.')[0] for m in sys.modules]))))
+"""
+
+    def _get_imported_modules(self, path, *args):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        output = subprocess.check_output(
+            [sys.executable, '-c', self.script, path] + list(args),
+            env=env
+        )
+        return json.loads(output.decode('utf-8').splitlines()[-1])
+
+    def test_help(self):
+        modules = self._get_imported_modules(tempfile.gettempdir(), '--help')
+        for module in ('boto3', 'botocore', 'troposphere', 'jinja2', 'yaml', 'pkg_resources'):
+            self.assertNotIn(module, modules)
+
+    def test_startproject(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        modules = self._get_imported_modules(path, 'startproject', 'demo')
+        self.assertTrue(os.path.isfile(os.path.join(path, 'demo', 'settings.yml')))
+        self.assertNotIn('boto3', modules)
+        self.assertNotIn('botocore', modules)
+
+    def test_build(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        project = os.path.join(path, 'project')
+        shutil.copytree(os.path.join(os.path.dirname(__file__), 'base', '0001_project'), project)
+        modules = self._get_imported_modules(project, 'build')
+        self.assertTrue(os.path.isdir(os.path.join(project, '_build')))
+        self.assertNotIn('boto3', modules)
+        self.assertNotIn('botocore', modules)
+
+
+class TestResourceRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ResourceRegistry()
+        for name in ('lambda:app:b', 'lambda:app:a', 'lambda:other:a', 'events:app:a'):
+            self.registry.register(name, utils.valid_cloudformation_name(name), Mock(name=name))
+
+    def test_lookups(self):
+        self.assertIn('lambda:app:a', self.registry)
+        self.assertEqual(self.registry.get_cf_name('lambda:app:a'), 'LambdaAppA')
+        self.assertIs(self.registry.get_by_cf_name('LambdaAppA'), self.registry.get('lambda:app:a'))
+        self.assertEqual(self.registry.get('lambda:app:c'), None)
+        self.assertRaises(exceptions.ResourceNotFoundError, self.registry.get_cf_name, 'lambda:app:c')
+
+    def test_duplicates(self):
+        self.assertRaises(exceptions.DuplicateResourceNameError, self.registry.register, 'lambda:app:a', 'X', None)
+        self.assertRaises(exceptions.DuplicateResourceNameError, self.registry.register, 'x', 'LambdaAppA', None)
+
+    def test_find(self):
+        self.assertEqual(self.registry.find('lambda:app:'), ['lambda:app:a', 'lambda:app:b'])
+        self.assertEqual(self.registry.find('lambda:'), ['lambda:app:a', 'lambda:app:b', 'lambda:other:a'])
+        self.assertEqual(self.registry.find('kinesis:'), [])
+        self.assertEqual(self.registry.similar('events:app:x'), ['events:app:a'])
+        self.assertEqual(len(self.registry.similar('kinesis:app:x')), 4)
+
+    def test_sorted_resources(self):
+        resources = SortedResources()
+        for name, order in (('b', 1), ('a', 2), ('c', 3), ('a', 4)):
+            resource = Mock(order=order)
+            resource.name = name
+            resources.append(resource)
+        self.assertEqual([r.order for r in resources], [2, 4, 1, 3])
+
+
+class TestBucketNotificationConfiguration(unittest.TestCase):
+
+    def setUp(self):
+        self.project = Mock()
+        self.project.registry = ResourceRegistry()
+        self.project.register_resource_reference = self.project.registry.register
+
+    def _create(self, name, bucket, *filters):
+        notifications = {}
+        for i, key_filters in enumerate(filters):
+            notifications['n{}'.format(i)] = {
+                'queue': 'queue', 'events': ['s3:ObjectCreated:*'], 'key_filters': key_filters
+            }
+        return BucketNotificationConfiguration(
+            name=name,
+            settings={'bucket': bucket, 'notifications': notifications},
+            project=self.project
+        )
+
+    def test_get_overlapping_filters(self):
+        filters = [('a/', 1), ('a/b/', 2), ('b/', 3), ('a/b/c', 4), ('a/', 5), ('ab', 6)]
+        self.assertEqual(get_overlapping_filters(filters), [
+            (('a/', 1), ('a/', 5)),
+            (('a/', 1), ('a/b/', 2)),
+            (('a/', 1), ('a/b/c', 4)),
+            (('a/', 5), ('a/b/', 2)),
+            (('a/', 5), ('a/b/c', 4)),
+            (('a/b/', 2), ('a/b/c', 4)),
+        ])
+        self.assertEqual(get_overlapping_filters([('.jpg', 1), ('.png', 2), ('x.png', 3)], suffix=True), [
+            (('.png', 2), ('x.png', 3)),
+        ])
+
+    def test_overlapping_filters(self):
+        self._create('ok', 'bucket', {'prefix': 'a/'}, {'prefix': 'b/'}, {'prefix': troposphere.Ref('Prefix')})
+        with self.assertRaises(exceptions.ResourceValidationError) as context:
+            self._create('ko', 'bucket2', {'prefix': 'a/'}, {'prefix': 'b/'}, {'prefix': 'a/b/'})
+        self.assertIn("'a/' (n0) and 'a/b/' (n2)", context.exception.get_hint())
+
+    def test_same_bucket(self):
+        first = self._create('first', 'bucket', {'prefix': 'a/'})
+        other = self._create('other', 'other-bucket', {'prefix': 'a/'})
+        first.validate()
+        second = self._create('second', 'bucket', {'prefix': 'b/'})
+        self.assertRaises(exceptions.ResourceValidationError, first.validate)
+        self.assertRaises(exceptions.ResourceValidationError, second.validate)
+        other.validate()
+
+        ref = self._create('ref', troposphere.Ref('Bucket'), {'prefix': 'a/'})
+        ref.validate()
+        self._create('ref2', troposphere.Ref('Bucket'), {'prefix': 'a/'})
+        self.assertRaises(exceptions.ResourceValidationError, ref.validate)
+
+
+class TestFixTroposphereReferences(unittest.TestCase):
+
+    def test_fix_references(self):
+        template = troposphere.Template()
+        template.add_parameter(troposphere.Parameter('Existing', Type='String'))
+        queue = template.add_resource(sqs.Queue(
+            'Queue',
+            QueueName=troposphere.Join('-', [troposphere.Ref('InJoin'), troposphere.Ref(troposphere.AWS_REGION)]),
+            RedrivePolicy=sqs.RedrivePolicy(
+                deadLetterTargetArn=troposphere.If('Condition', troposphere.Ref('InIf'), troposphere.Ref('Existing')),
+                maxReceiveCount=troposphere.Select(0, [troposphere.Ref('InList')]),
+            ),
+        ))
+        template.add_resource(sqs.QueuePolicy(
+            'Policy',
+            Queues=[troposphere.Ref(queue)],
+            PolicyDocument={'Statement': [{'Resource': troposphere.Sub(
+                '${Implicit}-${!Literal}-${Queue.Arn}-${Variable}-${AWS::Region}',
+                Variable=troposphere.Ref('InSubVariable')
+            )}]},
+        ))
+        template.add_output(troposphere.Output('Output', Value=troposphere.GetAtt(queue, 'Arn')))
+        template.add_output(troposphere.Output('Other', Value=troposphere.Ref('InOutput')))
+        template.add_condition('Condition', troposphere.Equals(troposphere.Ref('InCondition'), 'yes'))
+
+        utils.fix_troposphere_references(template)
+        self.assertEqual(
+            sorted(template.parameters.keys()),
+            ['Existing', 'Implicit', 'InCondition', 'InIf', 'InJoin', 'InList', 'InOutput', 'InSubVariable']
+        )
+
+    def test_fix_references_2000_resources(self):
+        template = troposphere.Template()
+        for i in range(2000):
+            # Bypass troposphere's limit of resources per template.
+            template.resources['Queue{}'.format(i)] = sqs.Queue(
+                'Queue{}'.format(i),
+                QueueName=troposphere.Sub('${{Stage}}-${{Name{}}}'.format(i % 50)),
+                RedrivePolicy=sqs.RedrivePolicy(
+                    deadLetterTargetArn=troposphere.GetAtt('Queue{}'.format((i + 1) % 2000), 'Arn'),
+                    maxReceiveCount=troposphere.Ref('Queue{}'.format((i + 1) % 2000)),
+                ),
+            )
+
+        # Resources referencing each other are still walked once, and every
+        # missing reference is added once.
+        sub_variable = Mock(wraps=utils.SUB_VARIABLE)
+        with patch('gordon.utils.SUB_VARIABLE', sub_variable), \
+                patch.object(template, 'add_parameter', wraps=template.add_parameter) as add_parameter:
+            utils.fix_troposphere_references(template)
+        self.assertEqual(sub_variable.findall.call_count, 2000)
+        self.assertEqual(add_parameter.call_count, 51)
+        self.assertEqual(len(template.parameters), 51)
+        self.assertIn('Stage', template.parameters)
+
+
+class TestSplitTemplate(unittest.TestCase):
+
+    def _template(self):
+        return {
+            'Parameters': {'Stage': {'Type': 'String'}, 'Name': {'Type': 'String'}},
+            'Resources': {
+                'Role': {'Type': 'AWS::IAM::Role'},
+                'Function': {
+                    'Type': 'AWS::Lambda::Function',
+                    'DependsOn': ['Role'],
+                    'Properties': {'Role': {'Fn::GetAtt': ['Role', 'Arn']}, 'FunctionName': {'Ref': 'Name'}},
+                },
+                'Alias': {
+                    'Type': 'AWS::Lambda::Alias',
+                    'Properties': {
+                        'FunctionName': {'Ref': 'Function'},
+                        'Description': {'Fn::Sub': '${Role.Arn} ${Function} ${AWS::Region}'},
+                    },
+                },
+            },
+            'Outputs': {'Output': {'Value': {'Ref': 'Alias'}}},
+        }
+
+    def test_split_by_group(self):
+        templates = split_template(self._template(), {'Role': 'a', 'Function': 'b', 'Alias': 'c', 'Output': 'c'})
+        self.assertEqual([name for name, _ in templates], ['a', 'b', 'c'])
+        a, b, c = [template for _, template in templates]
+
+        self.assertEqual(list(a['Resources']), ['Role'])
+        self.assertEqual(a['Outputs'], {'RoleArn': {'Value': {'Fn::GetAtt': ['Role', 'Arn']}}})
+        self.assertEqual(sorted(a['Parameters']), ['Stage'])
+
+        self.assertNotIn('DependsOn', b['Resources']['Function'])
+        self.assertEqual(b['Resources']['Function']['Properties']['Role'], {'Ref': 'RoleArn'})
+        self.assertEqual(sorted(b['Parameters']), ['Name', 'RoleArn', 'Stage'])
+        self.assertEqual(b['Outputs'], {'Function': {'Value': {'Ref': 'Function'}}})
+
+        self.assertEqual(
+            c['Resources']['Alias']['Properties']['Description'],
+            {'Fn::Sub': '${RoleArn} ${Function} ${AWS::Region}'}
+        )
+        self.assertEqual(sorted(c['Parameters']), ['Function', 'RoleArn', 'Stage'])
+        self.assertEqual(c['Outputs'], {'Output': {'Value': {'Ref': 'Alias'}}})
+
+    def test_split_by_size(self):
+        templates = split_template(self._template(), {}, max_resources=2)
+        self.assertEqual([(name, sorted(t['Resources'])) for name, t in templates], [
+            ('1', ['Function', 'Role']),
+            ('2', ['Alias']),
+        ])
+        self.assertEqual(templates[0][1]['Resources']['Function']['DependsOn'], ['Role'])
+
+    def test_split_by_outputs_and_parameters(self):
+        template = {'Parameters': {'Stage': {'Type': 'String'}}, 'Resources': {}, 'Outputs': {}}
+        for i in range(6):
+            template['Parameters']['Name{}'.format(i)] = {'Type': 'String'}
+            template['Resources']['Queue{}'.format(i)] = {
+                'Type': 'AWS::SQS::Queue',
+                'Properties': {'QueueName': {'Ref': 'Name{}'.format(i)}},
+            }
+            template['Outputs']['Queue{}Arn'.format(i)] = {'Value': {'Fn::GetAtt': ['Queue{}'.format(i), 'Arn']}}
+
+        templates = split_template(template, {}, max_resources=10, max_outputs=2)
+        self.assertEqual([sorted(t['Resources']) for _, t in templates],
+                         [['Queue0', 'Queue1'], ['Queue2', 'Queue3'], ['Queue4', 'Queue5']])
+
+        templates = split_template(template, {}, max_resources=10, max_parameters=4)
+        self.assertEqual([sorted(t['Parameters']) for _, t in templates], [
+            ['Name0', 'Name1', 'Name2', 'Stage'],
+            ['Name3', 'Name4', 'Name5', 'Stage'],
+        ])
+
+    def test_split_exceeding_limits(self):
+        with self.assertRaises(exceptions.ResourcesStackLimitError) as cm:
+            split_template(self._template(), {'Role': 'a', 'Function': 'a', 'Alias': 'a'}, max_parameters=1)
+        self.assertIn('Resources stack a would have 2 parameters', cm.exception.get_hint())
+
+    def test_cycles(self):
+        template = self._template()
+        template['Resources']['Role']['Properties'] = {'Path': {'Ref': 'Alias'}}
+        self.assertRaises(
+            exceptions.ResourcesStacksCycleError,
+            split_template, template, {'Role': 'a', 'Function': 'a', 'Alias': 'b'}
+        )
+
+
+class TestCreateOrUpdateStack(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, self.filename)
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps({'Parameters': {'Stage': {'Type': 'String'}}, 'Resources': {}}))
+        self.context = {'Stage': 'dev', 'Other': 'ignored'}
+
+    def _stack(self, template_hash):
+        return {
+            'StackId': 'id',
+            'StackStatus': 'UPDATE_COMPLETE',
+            'Outputs': [{'OutputKey': 'GordonTemplateHash', 'OutputValue': template_hash}],
+        }
+
+    @patch('gordon.utils.get_version', Mock(return_value='0.0.0'))
+    @patch('boto3.client')
+    def test_unchanged_stack_is_not_updated(self, boto3_client):
+        with open(self.filename, 'r') as f:
+            template_hash = utils.get_template_hash(f.read(), {'Stage': 'dev'})
+        client = boto3_client.return_value
+        client.describe_stacks.return_value = {'Stacks': [self._stack(template_hash)]}
+
+        stack = utils.create_or_update_cf_stack('stack', self.filename, context=self.context)
+        self.assertEqual(stack['StackId'], 'id')
+        self.assertFalse(client.update_stack.called)
+
+    @patch('gordon.utils.puts', Mock())
+    @patch('gordon.utils.get_version', Mock(return_value='0.0.0'))
+    @patch('boto3.client')
+    def test_changed_stack_is_updated(self, boto3_client):
+        client = boto3_client.return_value
+        client.describe_stacks.return_value = {'Stacks': [self._stack('other')]}
+        client.update_stack.return_value = {'StackId': 'id'}
+
+        utils.create_or_update_cf_stack('stack', self.filename, context=self.context)
+        kwargs = client.update_stack.call_args[1]
+        self.assertNotIn('Tags', kwargs)
+        template = json.loads(kwargs['TemplateBody'])
+        with open(self.filename, 'r') as f:
+            self.assertEqual(
+                template['Outputs'],
+                {'GordonTemplateHash': {'Value': utils.get_template_hash(f.read(), {'Stage': 'dev'})}}
+            )
+
+    def test_stack_outputs(self):
+        stack = self._stack('hash')
+        stack['Outputs'].append({'OutputKey': 'Output', 'OutputValue': 'value'})
+        self.assertEqual(utils.get_stack_outputs(stack), {'Output': 'value'})
+
+
+class TestChangeSets(unittest.TestCase):
+
+    @patch('time.sleep', Mock())
+    @patch('boto3.client')
+    def test_wait_for_change_sets(self, boto3_client):
+        client = boto3_client.return_value
+        responses = {
+            'a': [
+                {'StackName': 'a', 'Status': 'CREATE_IN_PROGRESS', 'Changes': []},
+                {'StackName': 'a', 'Status': 'CREATE_COMPLETE', 'Changes': [{'Type': 'Resource'}]},
+            ],
+            'b': [
+                {'StackName': 'b', 'Status': 'FAILED', 'Changes': [],
+                 'StatusReason': "The submitted information didn't contain changes."},
+            ],
+        }
+        client.describe_change_set.side_effect = lambda ChangeSetName: responses[ChangeSetName].pop(0)
+
+        change_sets = utils.wait_for_change_sets(['a', 'b'])
+        self.assertEqual(change_sets['a']['Changes'], [{'Type': 'Resource'}])
+        self.assertEqual(change_sets['b']['Changes'], [])
+        client.delete_change_set.assert_called_once_with(ChangeSetName='b')
+
+    @patch('boto3.client')
+    def test_failed_change_set(self, boto3_client):
+        client = boto3_client.return_value
+        client.describe_change_set.return_value = {
+            'StackName': 'a', 'Status': 'FAILED', 'StatusReason': 'Template error', 'Changes': []
+        }
+        self.assertRaises(exceptions.ChangeSetError, utils.wait_for_change_sets, ['a'])
+
+    def test_get_change_set_changes(self):
+        change_set = {'Changes': [
+            {'Type': 'Resource', 'ResourceChange': {
+                'Action': 'Modify', 'LogicalResourceId': 'Role', 'ResourceType': 'AWS::IAM::Role',
+                'Replacement': 'True', 'Details': [
+                    {'Target': {'Attribute': 'Properties', 'Name': 'RoleName'}},
+                    {'Target': {'Attribute': 'Properties', 'Name': 'Path'}},
+                    {'Target': {'Attribute': 'Tags'}},
+                ]
+            }},
+            {'Type': 'Resource', 'ResourceChange': {
+                'Action': 'Add', 'LogicalResourceId': 'Function', 'ResourceType': 'AWS::Lambda::Function',
+            }},
+        ]}
+        self.assertEqual(utils.get_change_set_changes(change_set), [
+            {'Action': 'Add', 'LogicalResourceId': 'Function', 'ResourceType': 'AWS::Lambda::Function',
+             'Replacement': 'False', 'Properties': []},
+            {'Action': 'Modify', 'LogicalResourceId': 'Role', 'ResourceType': 'AWS::IAM::Role',
+             'Replacement': 'True', 'Properties': ['Path', 'RoleName']},
+        ])
+
+
+@patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'eu-west-1'})
+class TestApplyPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        os.makedirs(os.path.join(self.path, '_build'))
+        with open(os.path.join(self.path, 'settings.yml'), 'w') as f:
+            f.write('project: test\n')
+        with open(os.path.join(self.path, '_build', '0001_r.json'), 'w') as f:
+            f.write(json.dumps({'Parameters': {'Stage': {'Type': 'String'}, 'Version': {'Type': 'String'}}}))
+
+    def _project(self, parameters, changes, change_set='change-set'):
+        project = ProjectApply(path=self.path, stdin=None, stage='dev', plan=True)
+        plan = {
+            'version': PLAN_VERSION,
+            'stage': 'dev',
+            'region': 'eu-west-1',
+            'templates': project.get_templates_hash(),
+            'steps': {'0001_r.json': {
+                'stack': 'test-dev-r', 'change_set': change_set, 'changes': changes, 'parameters': parameters
+            }}
+        }
+        with open(project.plan_path, 'w') as f:
+            json.dump(plan, f)
+        project._plan = project._load_plan()
+        return project
+
+    def _apply(self, project, version):
+        project.apply_cloudformation_template('r', '0001_r.json', {'Stage': 'dev', 'Version': version})
+
+    @patch('gordon.utils.execute_change_set')
+    def test_executes_change_set(self, execute_change_set):
+        project = self._project({'Stage': 'dev', 'Version': '1'}, [{'Action': 'Add'}])
+        self._apply(project, '1')
+        execute_change_set.assert_called_once_with('change-set', wait_timeout=15 * 60)
+
+    @patch('gordon.core.puts', Mock())
+    @patch('gordon.utils.execute_change_set')
+    @patch('gordon.utils.get_cf_stack')
+    def test_skips_empty_change_set(self, get_cf_stack, execute_change_set):
+        project = self._project({'Stage': 'dev', 'Version': '1'}, [], change_set=None)
+        self._apply(project, '1')
+        get_cf_stack.assert_called_once_with('test-dev-r')
+        self.assertFalse(execute_change_set.called)
+
+    @patch('gordon.utils.execute_change_set')
+    def test_executes_change_set_without_resource_changes(self, execute_change_set):
+        # It updates the hash of the stack, so it isn't planned again.
+        project = self._project({'Stage': 'dev', 'Version': '1'}, [])
+        self._apply(project, '1')
+        execute_change_set.assert_called_once_with('change-set', wait_timeout=15 * 60)
+
+    @patch('gordon.core.puts', Mock())
+    @patch('gordon.utils.create_or_update_cf_stack')
+    def test_pending_parameters_are_applied_directly(self, create_or_update_cf_stack):
+        project = self._project({'Stage': 'dev', 'Version': utils.PLAN_PENDING_VALUE}, [{'Action': 'Modify'}])
+        self._apply(project, '2')
+        self.assertEqual(create_or_update_cf_stack.call_args[1]['context']['Version'], '2')
+
+    @patch('gordon.core.puts', Mock())
+    @patch('gordon.utils.create_or_update_cf_stack')
+    def test_changed_outputs_are_applied_directly(self, create_or_update_cf_stack):
+        project = self._project({'Stage': 'dev', 'Version': '1'}, [{'Action': 'Modify'}])
+        self._apply(project, '2')
+        self.assertEqual(create_or_update_cf_stack.call_args[1]['context']['Version'], '2')
+
+    def test_changed_parameters(self):
+        project = self._project({'Stage': 'dev', 'Version': '1'}, [{'Action': 'Modify'}])
+        project._validate_plan({'Stage': 'dev', 'Version': '1'})
+        with self.assertRaises(exceptions.InvalidPlanError) as cm:
+            project._validate_plan({'Stage': 'dev', 'Version': '2'})
+        self.assertIn('Version of 0001_r.json', cm.exception.get_hint())
+
+        # Parameters which come from outputs of other templates can't be
+        # validated before applying them.
+        with open(os.path.join(self.path, '_build', '0000_p.json'), 'w') as f:
+            f.write(json.dumps({'Parameters': {}, 'Outputs': {'Version': {'Value': '1'}}}))
+        project._validate_plan({'Stage': 'dev', 'Version': '2'})
+
+    def test_outdated_plan(self):
+        project = self._project({'Stage': 'dev', 'Version': '1'}, [])
+        with open(os.path.join(self.path, '_build', '0002_r.json'), 'w') as f:
+            f.write('{}')
+        self.assertRaises(exceptions.InvalidPlanError, project._load_plan)
+
+
+@patch.dict(os.environ, {'AWS_DEFAULT_REGION': 'eu-west-1'})
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        os.makedirs(os.path.join(self.path, '_build'))
+        with open(os.path.join(self.path, 'settings.yml'), 'w') as f:
+            f.write('project: test\naws-account-id: 123456789012\n')
+        templates = {
+            '0001_p.json': {
+                'Parameters': {'Stage': {'Type': 'String'}},
+                'Resources': {'CodeBucket': {'Type': 'AWS::S3::Bucket'}},
+                'Outputs': {'CodeBucket': {'Value': {'Ref': 'CodeBucket'}}},
+            },
+            '0002_r.json': {
+                'Parameters': {'Stage': {'Type': 'String'}, 'CodeBucket': {'Type': 'String'}},
+                'Resources': {'Function': {'Type': 'AWS::Lambda::Function'}},
+            },
+        }
+        for filename, template in six.iteritems(templates):
+            with open(os.path.join(self.path, '_build', filename), 'w') as f:
+                f.write(json.dumps(template))
+
+    @patch('gordon.core.puts', Mock())
+    @patch('gordon.utils.get_version', Mock(return_value='0.0.0'))
+    @patch('boto3.resource')
+    @patch('boto3.client')
+    def test_plan_never_applied_project(self, boto3_client, boto3_resource):
+        from botocore.exceptions import ClientError
+
+        client = boto3_client.return_value
+        client.describe_stacks.side_effect = ClientError(
+            {'Error': {'Code': 'ValidationError', 'Message': 'Stack does not exist'}}, 'DescribeStacks')
+        client.create_change_set.return_value = {'Id': 'change-set'}
+        client.describe_change_set.return_value = {
+            'StackName': 'test-dev-p', 'Status': 'CREATE_COMPLETE', 'Changes': [
+                {'Type': 'Resource', 'ResourceChange': {
+                    'Action': 'Add', 'LogicalResourceId': 'CodeBucket', 'ResourceType': 'AWS::S3::Bucket'}}
+            ]
+        }
+
+        project = ProjectPlan(path=self.path, stdin=None, stage='dev')
+        project.plan()
+
+        # The bucket templates are uploaded to doesn't exist yet, so the only
+        # change set is sent with its template body.
+        client.create_change_set.assert_called_once()
+        self.assertIn('TemplateBody', client.create_change_set.call_args[1])
+        self.assertFalse(boto3_resource.called)
+
+        with open(project.plan_path, 'r') as f:
+            steps = json.load(f)['steps']
+        self.assertEqual(steps['0001_p.json']['change_set'], 'change-set')
+        self.assertEqual(steps['0001_p.json']['changes'][0]['LogicalResourceId'], 'CodeBucket')
+        self.assertEqual(steps['0002_r.json']['change_set'], None)
+        self.assertEqual(steps['0002_r.json']['pending'], ['CodeBucket'])
+        self.assertTrue(steps['0002_r.json']['new'])
+
+    @patch('gordon.core.puts', Mock())
+    @patch('gordon.utils.get_version', Mock(return_value='0.0.0'))
+    @patch('boto3.resource', Mock())
+    @patch('boto3.client')
+    def test_plan_without_changes(self, boto3_client):
+        client = boto3_client.return_value
+        client.describe_stacks.return_value = {'Stacks': [{
+            'StackId': 'id', 'StackStatus': 'UPDATE_COMPLETE',
+            'Outputs': [{'OutputKey': 'CodeBucket', 'OutputValue': 'bucket'}],
+        }]}
+        client.create_change_set.return_value = {'Id': 'change-set'}
+        client.describe_change_set.return_value = {
+            'StackName': 'test-dev-p', 'Status': 'FAILED', 'Changes': [],
+            'StatusReason': "The submitted information didn't contain changes."
+        }
+
+        project = ProjectPlan(path=self.path, stdin=None, stage='dev')
+        project.plan()
+
+        with open(project.plan_path, 'r') as f:
+            steps = json.load(f)['steps']
+        # Empty change sets are deleted, so apply --plan can't execute them.
+        self.assertEqual(steps['0001_p.json']['change_set'], None)
+        self.assertEqual(steps['0002_r.json']['parameters']['CodeBucket'], 'bucket')
+        self.assertEqual(steps['0002_r.json']['change_set'], None)
+
+
+class FakeRegionCommand(object):
+
+    def __init__(self, region, **kwargs):
+        self.region = region
+
+    def apply(self):
+        sys.stdout.write('applying\nin {}\n'.format(self.region))
+        if self.region == 'eu-west-1':
+            raise exceptions.ValidationError('boom')
+
+
+class TestMultiRegion(unittest.TestCase):
+
+    def test_parse_regions(self):
+        self.assertEqual(parse_regions('eu-west-1, us-east-1,,eu-west-1'), ['eu-west-1', 'us-east-1'])
+
+    @patch('gordon.regions.get_command_class', Mock(return_value=FakeRegionCommand))
+    @patch('gordon.regions.puts')
+    def test_run(self, puts):
+        command = MultiRegion(path='.', stdin=None, command='FakeRegionCommand', func='apply',
+                              region=['us-east-1', 'eu-west-1'])
+        self.assertRaises(exceptions.RegionsFailedError, command.apply)
+
+        lines = [str(c[0][0]) for c in puts.call_args_list]
+        self.assertEqual(
+            [l for l in lines if l.startswith('[us-east-1]')],
+            ['[us-east-1] applying', '[us-east-1] in us-east-1']
+        )
+        self.assertEqual(
+            [l for l in lines if l.startswith('[eu-west-1]')],
+            ['[eu-west-1] applying', '[eu-west-1] in eu-west-1']
+        )
+        self.assertTrue(any([l.startswith(u'\u2713 us-east-1') for l in lines]))
+        self.assertTrue(any([l.startswith(u'\u2717 eu-west-1 failed with code 24') for l in lines]))
+
+    @patch('gordon.core._get_fork_context', Mock(return_value=None))
+    @patch('gordon.regions.get_command_class', Mock(return_value=FakeRegionCommand))
+    @patch('gordon.regions.puts')
+    def test_run_sequentially_without_fork(self, puts):
+        command = MultiRegion(path='.', stdin=None, command='FakeRegionCommand', func='apply',
+                              region=['us-east-1', 'eu-west-1'])
+        with patch('sys.stdout', new_callable=six.StringIO) as stdout:
+            self.assertRaises(exceptions.RegionsFailedError, command.apply)
+
+        self.assertEqual(stdout.getvalue(), 'applying\nin us-east-1\napplying\nin eu-west-1\n')
+        lines = [str(c[0][0]) for c in puts.call_args_list]
+        self.assertTrue(any([l.startswith(u'\u2713 us-east-1') for l in lines]))
+        self.assertTrue(any([l.startswith(u'\u2717 eu-west-1 failed with code 24') for l in lines]))
+
+
+class TestWaitForCfStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.start = datetime(2017, 1, 1)
+
+    def _event(self, i, status, resource_type='AWS::Lambda::Function', physical_id='function'):
+        return {
+            'EventId': str(i),
+            'Timestamp': self.start + timedelta(seconds=i),
+            'ResourceStatus': status,
+            'ResourceType': resource_type,
+            'LogicalResourceId': 'Resource',
+            'PhysicalResourceId': physical_id,
+        }
+
+    @patch('gordon.utils.puts')
+    @patch('time.sleep')
+    @patch('boto3.client')
+    def test_wait_streams_events(self, boto3_client, sleep, puts):
+        client = boto3_client.return_value
+        client.describe_stacks.side_effect = [
+            {'Stacks': [{'StackId': 'id', 'StackStatus': 'UPDATE_IN_PROGRESS', 'LastUpdatedTime': self.start}]},
+            {'Stacks': [{'StackId': 'id', 'StackStatus': 'UPDATE_COMPLETE', 'Outputs': []}]},
+        ]
+        old = self._event(-1, 'UPDATE_COMPLETE', 'AWS::CloudFormation::Stack', 'id')
+        pages = [
+            [{'StackEvents': [self._event(0, 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack', 'id'), old]}],
+            [{'StackEvents': [self._event(0, 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack', 'id'), old]}],
+            [{'StackEvents': [self._event(2, 'UPDATE_COMPLETE'), self._event(1, 'UPDATE_IN_PROGRESS')]},
+             {'StackEvents': [self._event(0, 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack', 'id')]}],
+            [{'StackEvents': [self._event(3, 'UPDATE_COMPLETE', 'AWS::CloudFormation::Stack', 'id'),
+                              self._event(2, 'UPDATE_COMPLETE')]}],
+        ]
+        client.get_paginator.return_value.paginate.side_effect = pages
+
+        stack = utils.wait_for_cf_status('id')
+        output = [str(c[0][0]) for c in puts.call_args_list]
+
+        self.assertEqual(stack['StackStatus'], 'UPDATE_COMPLETE')
+        self.assertEqual(len(output), 4)
+        self.assertIn('UPDATE_COMPLETE AWS::CloudFormation::Stack', output[-1])
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 2, 1])
+
+    @patch('gordon.utils.puts', Mock())
+    @patch('time.sleep')
+    @patch('boto3.client')
+    def test_wait_fails(self, boto3_client, sleep):
+        client = boto3_client.return_value
+        client.describe_stacks.side_effect = [
+            {'Stacks': [{'StackId': 'id', 'StackStatus': 'CREATE_IN_PROGRESS', 'CreationTime': self.start}]},
+            {'Stacks': [{'StackId': 'id', 'StackStatus': 'ROLLBACK_COMPLETE'}]},
+        ]
+        client.get_paginator.return_value.paginate.return_value = [
+            {'StackEvents': [self._event(1, 'ROLLBACK_COMPLETE', 'AWS::CloudFormation::Stack', 'id')]}
+        ]
+        self.assertRaises(exceptions.AbnormalCloudFormationStatusError, utils.wait_for_cf_status, 'id')
+
+    @patch('time.time')
+    @patch('time.sleep')
+    @patch('boto3.client')
+    def test_wait_timeout(self, boto3_client, sleep, time_):
+        time_.side_effect = [0, 0, 100]
+        client = boto3_client.return_value
+        client.describe_stacks.return_value = {
+            'Stacks': [{'StackId': 'id', 'StackStatus': 'CREATE_IN_PROGRESS', 'CreationTime': self.start}]
+        }
+        client.get_paginator.return_value.paginate.return_value = []
+        self.assertRaises(exceptions.CloudFormationWaitTimeoutError, utils.wait_for_cf_status, 'id', timeout=60)